@@ -0,0 +1,268 @@
+"""
+Backfill the pipeline over a range of service dates.
+
+Every service_date + operator in the range is a job
+(pipeline.run_partition), and its checkpoints land in the
+date-partitioned pipeline dataset:
+{PIPELINE_FOLDER}{stage}/service_date=.../schedule_gtfs_dataset_key=.../
+
+Jobs run in a local process pool, but how many run at once is
+bounded by their estimated memory, not just the number of CPUs.
+A job's estimate is its share of trips times the size of the
+input parquets, times how much parquet expands once it's in memory.
+Biggest jobs are scheduled first, and smaller ones fill in around them.
+
+Ex: python backfill.py --start-date 2024-10-01 --end-date 2024-12-31 --operators LADOT "Big Blue Bus"
+"""
+import argparse
+import concurrent.futures
+import datetime
+import os
+import pandas as pd
+
+import create_table
+import pipeline
+import utils
+from update_vars import OUTPUT_FOLDER, PIPELINE_FOLDER, analysis_date
+
+# Parquet (compressed, columnar) to pandas / geopandas in memory,
+# plus the intermediate copies a stage makes
+MEMORY_EXPANSION = 10
+
+# Fraction of the machine's memory the backfill can use
+MEMORY_FRACTION = 0.6
+
+def total_memory_bytes() -> int:
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        # Not available (ex: Windows), assume 8 GB
+        return 8 * 1024 ** 3
+
+
+def operator_keys(operators: list) -> list:
+    """
+    Operators can be given as readable names (like operators_list)
+    or schedule_gtfs_dataset_keys.
+    """
+    name_to_key = {v: k for k, v in utils.OPERATOR_NAMES_DICT.items()}
+
+    return [name_to_key.get(o, o) for o in operators]
+
+
+def backfill_jobs(
+    start_date: str,
+    end_date: str,
+    operators: list = None,
+    stages: dict = pipeline.STAGES,
+    folder_path: str = OUTPUT_FOLDER,
+    memory_expansion: float = MEMORY_EXPANSION
+) -> pd.DataFrame:
+    """
+    1 row per service_date + operator in the date range,
+    with n_trips and est_bytes (estimated memory), largest first.
+    """
+    trips = create_table.get_calitp_table(
+        "trips",
+        folder_path = folder_path,
+        columns = pipeline.PARTITION_COLS + ["trip_instance_key"]
+    )
+
+    service_dates = pd.to_datetime(trips.service_date)
+    trips = trips[
+        (service_dates >= pd.Timestamp(start_date)) &
+        (service_dates <= pd.Timestamp(end_date))
+    ]
+
+    if operators is not None:
+        trips = trips[
+            trips.schedule_gtfs_dataset_key.isin(operator_keys(operators))
+        ]
+
+    jobs = (trips.groupby(pipeline.PARTITION_COLS, observed=True)
+            .trip_instance_key
+            .nunique()
+            .reset_index(name="n_trips")
+           )
+
+    # Source tables hold every date and operator,
+    # a job reads roughly its share of trips from each
+    source_tables = sorted({
+        t for stage in stages.values() for t in stage["sources"]
+    })
+    source_bytes = sum(
+        os.path.getsize(create_table.get_hackathon_table_filepath(t, folder_path))
+        for t in source_tables
+    )
+
+    total_trips = max(trips.trip_instance_key.nunique(), 1)
+
+    jobs = jobs.assign(
+        est_bytes = (
+            jobs.n_trips / total_trips * source_bytes * memory_expansion
+        ).astype("int64")
+    )
+
+    return jobs.sort_values("est_bytes", ascending=False).reset_index(drop=True)
+
+
+def format_progress(
+    n_done: int,
+    n_jobs: int,
+    bytes_done: int,
+    bytes_total: int,
+    start: datetime.datetime
+) -> str:
+    """
+    Throughput in jobs/hour, and an ETA from the
+    estimated bytes left at the rate bytes have been processed so far
+    (jobs are uneven, so counting jobs alone would be off).
+    """
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+    jobs_per_hour = n_done / elapsed * 3_600 if elapsed > 0 else 0
+
+    if bytes_done > 0:
+        eta = datetime.timedelta(
+            seconds = round(elapsed * (bytes_total - bytes_done) / bytes_done)
+        )
+    else:
+        eta = "unknown"
+
+    return (
+        f"{n_done}/{n_jobs} jobs, "
+        f"{jobs_per_hour:.1f} jobs/hour, ETA {eta}"
+    )
+
+
+def run_backfill(
+    jobs: pd.DataFrame,
+    stages: dict = pipeline.STAGES,
+    pipeline_folder: str = PIPELINE_FOLDER,
+    max_workers: int = None,
+    memory_budget_bytes: int = None,
+) -> pd.DataFrame:
+    """
+    Submit jobs (largest first) while the estimated memory of
+    running jobs fits in memory_budget_bytes and there's a free worker.
+    A job bigger than the whole budget still runs, but on its own.
+    Returns 1 row per job and stage with its status.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if memory_budget_bytes is None:
+        memory_budget_bytes = int(total_memory_bytes() * MEMORY_FRACTION)
+
+    pending = jobs.to_dict(orient="records")
+    bytes_total = int(jobs.est_bytes.sum())
+
+    running = {}
+    results = []
+    n_done = 0
+    bytes_done = 0
+    start = datetime.datetime.now()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+
+        while pending or running:
+            in_flight = sum(job["est_bytes"] for job in running.values())
+
+            # Largest job that fits, or anything if nothing is running
+            for job in list(pending):
+                if len(running) >= max_workers:
+                    break
+
+                if not running or in_flight + job["est_bytes"] <= memory_budget_bytes:
+                    partition = {c: job[c] for c in pipeline.PARTITION_COLS}
+                    future = pool.submit(
+                        pipeline.run_partition, partition, stages, pipeline_folder
+                    )
+                    running[future] = job
+                    in_flight += job["est_bytes"]
+                    pending.remove(job)
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for future in finished:
+                job = running.pop(future)
+                results += future.result()
+
+                n_done += 1
+                bytes_done += job["est_bytes"]
+
+                print(
+                    f"{job['service_date']} {job['schedule_gtfs_dataset_key']}: "
+                    f"{format_progress(n_done, len(jobs), bytes_done, bytes_total, start)}"
+                )
+
+    return pd.DataFrame(results)
+
+
+def read_backfill(
+    stage: str = "speeds",
+    start_date: str = None,
+    end_date: str = None,
+    pipeline_folder: str = PIPELINE_FOLDER,
+) -> pd.DataFrame:
+    """
+    Read a stage's output across dates from the partitioned dataset.
+    Stage outputs keep their own service_date and operator columns,
+    so read each finished partition's checkpoint and stack them.
+    """
+    stage_folder = f"{pipeline_folder}{stage}/"
+
+    date_folders = sorted(
+        d for d in os.listdir(stage_folder) if d.startswith("service_date=")
+    )
+
+    if start_date is not None:
+        date_folders = [
+            d for d in date_folders
+            if d.split("=")[1] >= str(pd.Timestamp(start_date).date())
+        ]
+    if end_date is not None:
+        date_folders = [
+            d for d in date_folders
+            if d.split("=")[1] <= str(pd.Timestamp(end_date).date())
+        ]
+
+    dfs = [
+        pipeline.read_checkpoint(f"{stage_folder}{d}/{o}/")
+        for d in date_folders
+        for o in sorted(os.listdir(f"{stage_folder}{d}"))
+        if pipeline.read_manifest(f"{stage_folder}{d}/{o}/").get("status") == "done"
+    ]
+
+    return pd.concat(dfs, axis=0, ignore_index=True) if dfs else pd.DataFrame()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Backfill speeds over a date range.")
+    parser.add_argument("--start-date", default=analysis_date)
+    parser.add_argument("--end-date", default=analysis_date)
+    parser.add_argument("--operators", nargs="*", default=None,
+                        help="operator names or schedule_gtfs_dataset_keys")
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--memory-gb", type=float, default=None,
+                        help="memory budget, defaults to 60% of the machine")
+    args = parser.parse_args()
+
+    start = datetime.datetime.now()
+
+    jobs = backfill_jobs(args.start_date, args.end_date, args.operators)
+    print(f"{len(jobs)} jobs, estimated {jobs.est_bytes.sum() / 1024 ** 3:.1f} GB")
+
+    status_df = run_backfill(
+        jobs,
+        max_workers = args.max_workers,
+        memory_budget_bytes = (
+            int(args.memory_gb * 1024 ** 3) if args.memory_gb is not None else None
+        )
+    )
+
+    end = datetime.datetime.now()
+    print(status_df.groupby(["stage", "status"]).size())
+    print(f"execution time: {end - start}")
@@ -1,7 +1,16 @@
-import branca
+"""
+Plotting helpers for comparing speeds, vp, shapes, stops.
+
+folium and branca are only needed to render maps,
+so they are imported inside the functions that use them.
+Pipeline modules should not import this module.
+"""
 import geopandas as gpd
 import numpy as np
-import pandas as pd
+
+import map_layers
+import utils
+from update_vars import WGS84
 
 def speed_stats(gdf):
     min_speed = gdf.speed_mph.min()
@@ -22,26 +31,95 @@ def speed_stats(gdf):
 
 def speed_map(
     speed_gdf: gpd.GeoDataFrame,
-    static: bool = False
+    static: bool = False,
+    speed_col: str = "speed_mph",
+    aggregate: bool = False,
+    lod: str = None
 ):
+    """
+    speed_gdf can be trip-segment speeds, or the segment rollup
+    from speed_rollups.read_speed_rollup with speed_col = "p50_speed_mph".
+    
+    For large outputs (operator-day, district), use
+    aggregate = True to map 1 row per stop pair (median speed), and
+    lod = "district" / "city" / "street" to simplify the segments and
+    keep only the columns the map needs (see map_layers).
+    """
+    import branca
+    
     COLORSCALE = branca.colormap.step.RdBu_10.scale(vmin=0, vmax=80)
     drop_cols = speed_gdf.select_dtypes("datetime").columns
     
     gdf = speed_gdf[(
-        speed_gdf.speed_mph.notna()) & 
-        (speed_gdf.speed_mph < np.inf)
+        speed_gdf[speed_col].notna()) & 
+        (speed_gdf[speed_col] < np.inf)
     ].drop(
         columns = drop_cols
     ).set_geometry(
         "segment_geometry"
     )
     
+    if aggregate:
+        gdf = map_layers.aggregate_by_stop_pair(gdf)
+        speed_col = "p50_speed_mph"
+    
+    if lod is not None:
+        gdf = map_layers.simplify_for_lod(
+            gdf, lod, 
+            keep_cols = map_layers.MAP_COLS + [speed_col]
+        )
+    
     if static:
-        m = gdf.plot("speed_mph", cmap="RdBu", scheme="quantiles", k=10, vmin=0, vmax=80)
+        m = gdf.plot(speed_col, cmap="RdBu", scheme="quantiles", k=10, vmin=0, vmax=80)
 
     else:
         m = gdf.explore(
-            "speed_mph", cmap=COLORSCALE,
+            speed_col, cmap=COLORSCALE,
             tiles = "CartoDB Positron"
         )
-    return m 
\ No newline at end of file
+    return m 
+
+
+def plot_vp_shape_stops(
+    vp: gpd.GeoDataFrame,
+    shapes: gpd.GeoDataFrame,
+    stops: gpd.GeoDataFrame,
+    vp_as_line: bool = True
+) -> "folium.Map":
+    """
+    vp: raw vp that's long will get condensed into a linestring path
+    shapes: shapes linestring
+    stops: any stop gdf, either stops or stop_times_direction
+    """
+    import folium
+
+    if vp_as_line:
+        vp_condensed = utils.condense_by_trip(
+            vp.to_crs(WGS84),
+            group_cols = ["trip_id"],
+            sort_cols = ["trip_id", "location_timestamp_local"],
+            geometry_col = "geometry",
+            array_cols = ["location_timestamp_local"]
+        )
+    else:
+        vp_condensed = vp.to_crs(WGS84)
+
+    m = vp_condensed.drop(columns = "location_timestamp_local").explore(
+        vp_condensed.index,
+        tiles = "CartoDB Positron",
+        categorical=True, legend=False, name = "vp"
+    )
+
+    m = stops.to_crs(WGS84).explore(
+        "stop_sequence", m=m, categorical=True, legend=False,
+        name="stops"
+    )
+
+    m = shapes[["shape_id", "geometry"]].to_crs(WGS84).explore(
+        "shape_id", color = "orange", name="Shape",
+        m=m
+    )
+
+    folium.LayerControl().add_to(m)
+
+    return m
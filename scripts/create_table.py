@@ -11,9 +11,16 @@ import pandas as pd
 
 from typing import Literal, Union
 
+import geo_io
+import geo_threads
+import gtfs_rt_ingest
 import partridge_gtfs_wrangling
 import neighbor
+import schema
 import utils
+import vp_coverage
+import vp_pack
+import vp_thinning
 from update_vars import (OUTPUT_FOLDER,
                          gtfs_tables_list, 
                          PROJECT_CRS
@@ -27,19 +34,68 @@ def get_hackathon_table_filepath(
     """
     Get local filepaths for each of the 
     hackathon-prepped Cal-ITP tables.
+    vp_rt (vp from gtfs_rt_ingest) is a folder of partitioned files.
     """
+    if table_name == "vp_rt":
+        return f"{folder_path}{table_name}/"
+    
     return f"{folder_path}{table_name}.parquet"
 
 
+def get_key_dictionary(
+    folder_path: str = OUTPUT_FOLDER
+) -> dict:
+    """
+    Build the shared key dictionary from trips and stops.
+    Every key value that shows up in stop_times, shapes, vp
+    should also be present in trips or stops.
+    """
+    trips = pd.read_parquet(
+        get_hackathon_table_filepath("trips", folder_path),
+        columns = ["schedule_gtfs_dataset_key", "trip_instance_key", "trip_id", "shape_id"]
+    )
+    
+    stops = pd.read_parquet(
+        get_hackathon_table_filepath("stops", folder_path),
+        columns = ["stop_id"]
+    )
+    
+    return schema.build_key_dictionary([trips, stops])
+
+
 def get_calitp_table(
     table_name: Literal[gtfs_tables_list] = "", 
     folder_path: str = OUTPUT_FOLDER,
+    key_dictionary: dict = None,
+    return_coords: bool = False,
     **kwargs
-) -> Union[pd.DataFrame, gpd.GeoDataFrame]:
+) -> Union[pd.DataFrame, gpd.GeoDataFrame, tuple]:
     """
     Import any of the 6 available GTFS tables.
     stop_times_direction is a combination of stop_times + trips (route info) + stop (geometry)
+    
+    If key_dictionary is provided, key columns are returned as categoricals
+    sharing the same categories, so merges across tables happen on integer codes.
+    
+    If return_coords is True, geometry isn't parsed into shapely objects.
+    Returns the df without geometry, and the coordinate arrays for each
+    geometry column (see geo_io.read_coords). Rows are not deduplicated,
+    so they line up with the coordinates.
+    Use geo_io.coords_to_geoseries to build the geometry if it's needed.
     """
+    if return_coords:
+        df, coords = geo_io.read_coords(
+            get_hackathon_table_filepath(table_name, folder_path),
+            **kwargs
+        )
+        
+        if key_dictionary is not None:
+            df = schema.encode_keys(
+                df, key_dictionary
+            ).pipe(schema.downcast_dtypes)
+        
+        return df, coords
+    
     if table_name in ["trips", "stop_times"]:                
 
         df = pd.read_parquet(
@@ -53,6 +109,18 @@ def get_calitp_table(
             get_hackathon_table_filepath(table_name, folder_path),
             **kwargs
         )
+    
+    elif table_name == "vp_rt":
+        
+        df = gtfs_rt_ingest.read_vp_partitions(
+            get_hackathon_table_filepath(table_name, folder_path),
+            **kwargs
+        )
+    
+    if key_dictionary is not None:
+        df = schema.encode_keys(
+            df, key_dictionary
+        ).pipe(schema.downcast_dtypes)
         
     return df.drop_duplicates().reset_index(drop=True)
 
@@ -68,37 +136,42 @@ def stop_times_projected_calitp_table(
     and project each stop position against shape geometry.
     """
     operator_trip_group = ["schedule_gtfs_dataset_key"] + trip_group
+    key_dictionary = get_key_dictionary(folder_path)
     
     trips = get_calitp_table(
         "trips", 
         folder_path = folder_path,
+        key_dictionary = key_dictionary,
         columns =  operator_trip_group + ["trip_instance_key", "shape_id"],
         **trip_kwargs
     )
 
     # trip_id can be repeated across operators
     # Once we move out of single operator, we use trip_instance_key / shape_array_key,
-    # which is present in our warehouse but would have to be created for a tool
+    # which is present in our warehouse (for partridge feeds, see schema.add_hash_keys)
     subset_trips = trips.trip_id.unique().tolist()
     subset_shapes = trips.shape_id.unique().tolist()
     
     stop_times = get_calitp_table(
         "stop_times", 
         folder_path = folder_path,
+        key_dictionary = key_dictionary,
         filters = [[("trip_id", "in", subset_trips)]],
-        columns = operator_trip_group + ["stop_id", "stop_sequence"]
+        columns = operator_trip_group + ["stop_id", "stop_sequence", "arrival_sec"]
     )
     
     stops = get_calitp_table(
         "stops",
         folder_path = folder_path,
-        filters = [[("stop_id", "in", stop_times.stop_id)]],
+        key_dictionary = key_dictionary,
+        filters = [[("stop_id", "in", stop_times.stop_id.unique().tolist())]],
         columns = ["schedule_gtfs_dataset_key", "service_date", "stop_id", "stop_name", "geometry"]
     ).to_crs(crs)
     
     shapes = get_calitp_table(
         "shapes",
         folder_path = folder_path,
+        key_dictionary = key_dictionary,
         filters = [[("shape_id", "in", subset_shapes)]],
         columns = ["schedule_gtfs_dataset_key", "service_date", "shape_id", "geometry"]
     ).to_crs(crs)
@@ -116,9 +189,12 @@ def stop_times_projected_calitp_table(
     
     # Get stop_pair and other  (we use stop_pair), but for simplicity, 
     # this illustrates what we do anyway    
+    # Trips that share a shape and stops are only projected once
     gdf = partridge_gtfs_wrangling.stop_times_preprocessing(
         gdf,
-        trip_group = operator_trip_group + ["trip_instance_key"]
+        trip_group = operator_trip_group + ["trip_instance_key"],
+        by_pattern = True,
+        shape_group = ["schedule_gtfs_dataset_key", "service_date", "shape_id"]
     )
 
     return gdf
@@ -127,43 +203,61 @@ def stop_times_projected_calitp_table(
 def vp_projected_table(
     crs: str = PROJECT_CRS,
     folder_path: str = OUTPUT_FOLDER,
+    key_dictionary: dict = None,
+    collapse_dwells: bool = False,
+    vp_table: Literal["vp", "vp_rt"] = "vp",
     **trip_kwargs,
 ) -> gpd.GeoDataFrame:
     """
     Get vp table
     and project each vehicle position against shape geometry.
+    If collapse_dwells is True, vp that sit in the same position
+    are collapsed into one dwell row (see dwell.py).
+    vp_table is vp, or vp_rt for vp ingested from GTFS-RT feeds
+    (see gtfs_rt_ingest.py).
     """        
     trip_cols = ["service_date", "schedule_gtfs_dataset_key", "trip_instance_key", "trip_id"]              
     
+    if key_dictionary is None:
+        key_dictionary = get_key_dictionary(folder_path)
+    
     # To merge with vp, we need to use `schedule_gtfs_dataset_key`
     # In the Cal-ITP warehouse, feed_key is used to merge schedule tables
     # and `schedule_gtfs_dataset_key` is present only in trips, used to merge operators from other RT tables
     trips = get_calitp_table(
         "trips", 
         folder_path = folder_path,
+        key_dictionary = key_dictionary,
         columns = trip_cols + ["shape_id"],
         **trip_kwargs
     )
     
     # trip_id can be repeated across operators
     # Once we move out of single operator, we use trip_instance_key / shape_array_key,
-    # which is present in our warehouse but would have to be created for a tool
+    # which is present in our warehouse (for partridge feeds, see schema.add_hash_keys)
     subset_trips = trips.trip_instance_key.unique().tolist()
     subset_shapes = trips.shape_id.unique().tolist()
     
     # vp would not have feed_key, it always has to be keyed with schedule_gtfs_dataset_key
     vp = get_calitp_table(
-        "vp",
+        vp_table,
         folder_path = folder_path,
+        key_dictionary = key_dictionary,
         filters = [[("trip_instance_key", "in", subset_trips)]],
         columns = trip_cols + ["location_timestamp_local", "geometry"]
-    ).to_crs(crs).sort_values(
+    )
+    
+    # vp is the biggest table to reproject, do it in chunks on threads
+    vp = vp.set_geometry(
+        geo_threads.to_crs(vp.geometry, crs)
+    ).sort_values(
         "location_timestamp_local"
     ).reset_index(drop=True)
     
     shapes = get_calitp_table(
         "shapes",
         folder_path = folder_path,
+        key_dictionary = key_dictionary,
         filters = [[("shape_id", "in", subset_shapes)]],
         columns = ["schedule_gtfs_dataset_key", "shape_id", "geometry"]
     ).to_crs(crs)
@@ -184,39 +278,103 @@ def vp_projected_table(
     
     gdf = partridge_gtfs_wrangling.vp_preprocessing(
         gdf, 
-        trip_group = trip_cols
+        trip_group = trip_cols,
+        collapse_dwells = collapse_dwells,
+        shape_group = ["schedule_gtfs_dataset_key", "shape_id"]
     )
     
     return gdf
 
 
 def stop_times_with_vp_table(
+    collapse_dwells: bool = False,
+    thin_vp: bool = False,
+    gate_coverage: bool = False,
+    coverage_path: str = None,
+    vp_pack_path: str = None,
+    stops_projected: gpd.GeoDataFrame = None,
     **kwargs
 ) -> gpd.GeoDataFrame:
     """
     Put together stop times with direction with vp.
     This is our processed df ready for deriving speeds.
+    
+    collapse_dwells reduces the vp the neighbor search has to consider,
+    and carries moving_timestamp_local so the vp before a stop
+    uses the time it departed, not the time it arrived.
+    
+    thin_vp drops vp that interpolating between the vp around them
+    already places within an error bound (see vp_thinning.py),
+    but keeps the vp flanking each stop.
+    
+    gate_coverage drops trips whose vp are too few, cover too little
+    of the shape, or have too long a gap (see vp_coverage.py)
+    before they're merged with stop_times. The coverage table for
+    every trip is written to coverage_path, if given.
+    
+    If vp_pack_path is given (see vp_pack.py), read the already projected 
+    and condensed vp for these trips from the pack instead.
+    Dwells are collapsed (or not) when the pack is written.
+    The pack is read already condensed, so thin_vp and gate_coverage
+    can't be applied to it, and using either with vp_pack_path raises a ValueError.
+    
+    stops_projected can be passed in (ex: a pipeline checkpoint),
+    otherwise it's read from stop_times_direction.
     """
-    # We created this in stop_times_direction.py
-    stops_projected = get_calitp_table(
-        "stop_times_direction", 
-        folder_path = OUTPUT_FOLDER,
-        **kwargs
-    )
+    if vp_pack_path is not None and (thin_vp or gate_coverage):
+        raise ValueError(
+            "thin_vp and gate_coverage can't be used with vp_pack_path"
+        )
 
-    vp_projected = vp_projected_table(
-        crs = PROJECT_CRS,
-        folder_path = OUTPUT_FOLDER,
-        **kwargs
-    )  
+    key_dictionary = get_key_dictionary(OUTPUT_FOLDER)
     
-    vp_nn = utils.condense_by_trip(
-        vp_projected,
-        group_cols = ["service_date", "trip_instance_key", "shape_geometry"],
-        sort_cols = ["service_date", "trip_instance_key", "vp_idx"],
-        geometry_col = "geometry",
-        array_cols = ["vp_idx", "vp_primary_direction", "location_timestamp_local"]
-    )
+    if stops_projected is None:
+        # We created this in stop_times_direction.py
+        stops_projected = get_calitp_table(
+            "stop_times_direction", 
+            folder_path = OUTPUT_FOLDER,
+            key_dictionary = key_dictionary,
+            **kwargs
+        )
+    else:
+        stops_projected = schema.encode_keys(stops_projected, key_dictionary)
+
+    if vp_pack_path is not None:
+        vp_nn = vp_pack.condensed_vp_from_pack(
+            vp_pack_path,
+            trip_instance_keys = stops_projected.trip_instance_key.unique()
+        ).pipe(schema.encode_keys, key_dictionary)
+        
+    else:
+        vp_projected = vp_projected_table(
+            crs = PROJECT_CRS,
+            folder_path = OUTPUT_FOLDER,
+            key_dictionary = key_dictionary,
+            collapse_dwells = collapse_dwells,
+            **kwargs
+        )  
+        
+        if gate_coverage:
+            vp_projected = vp_coverage.gate_vp_by_coverage(
+                vp_projected, coverage_path = coverage_path
+            )
+        
+        if thin_vp:
+            vp_projected = vp_thinning.thin_vp(vp_projected, stops_projected)
+
+        vp_array_cols = [
+            "vp_idx", "vp_primary_direction", "location_timestamp_local", "location_sec"
+        ]
+        if collapse_dwells:
+            vp_array_cols = vp_array_cols + ["moving_timestamp_local", "moving_sec"]
+
+        vp_nn = utils.condense_by_trip(
+            vp_projected,
+            group_cols = ["service_date", "trip_instance_key", "shape_geometry"],
+            sort_cols = ["service_date", "trip_instance_key", "vp_idx"],
+            geometry_col = "geometry",
+            array_cols = vp_array_cols
+        )
     
     vp_nn = vp_nn.assign(
         vp_primary_direction = vp_nn.apply(
@@ -1,74 +1,229 @@
 """
 Download 2 operators, save GTFS schedule tables.
 Also pre-process stop_times.
+
+gtfs_segments is only needed when we download or export feeds,
+so it's imported inside those functions.
+
+With --diff, the new feed is compared against the tables
+exported from the previous download (see feed_diff.py), and
+segments and stop_times_direction are only recomputed
+for the trips (and routes) that changed.
 """
-import gtfs_segments
+import argparse
+import geopandas as gpd
 import os
 
+import feed_diff
+import geo_io
 import partridge_gtfs_wrangling
-from update_vars import PARTRIDGE_FOLDER, operators_list
+import trip_patterns
+from update_vars import PARTRIDGE_FOLDER, PROJECT_CRS, operators_list
 
 def export_schedule_parquets(
     provider_name: str,
     readable_name: str,
     input_path: str,
     export_path: str,
-):
+    diff: bool = False
+) -> dict:
     """
-    Export trips, shapes, stops, stop_times 
+    Export trips, shapes, stops, stop_times
     GTFS schedule tables from gtfs.zip.
     We'll use this to help with our preprocessing steps.
+
+    If diff is True and a previous export exists, only tables
+    that changed are written, and segments are recomputed only for
+    routes with changed trips and merged into the existing segments.
+    Returns the feed diff (None if everything was exported).
     """
+    import gtfs_segments
+
     if not os.path.exists(export_path):
         os.makedirs(export_path)
-        
+
     feed = gtfs_segments.partridge_func.get_bus_feed(
         f"{input_path}/gtfs.zip"
     )
 
-    trips_df = feed[1].trips 
-    shapes_df = feed[1].shapes
-    stops_df = feed[1].stops
-    stop_times_df = feed[1].stop_times
-    
-    trips_df.to_parquet(f"{export_path}/trips.parquet")
-    shapes_df.to_parquet(f"{export_path}/shapes.parquet")
-    stops_df.to_parquet(f"{export_path}/stops.parquet")
-    stop_times_df.to_parquet(f"{export_path}/stop_times.parquet")
-
-    segments = gtfs_segments.gtfs_segments.process_feed(feed[1])
-    segments.to_parquet(f"{export_path}/segments.parquet")
-    
+    tables = {
+        "trips": feed[1].trips,
+        "shapes": feed[1].shapes,
+        "stops": feed[1].stops,
+        "stop_times": feed[1].stop_times,
+    }
+
+    previous_tables = (
+        feed_diff.read_previous_tables(export_path) if diff else None
+    )
+
+    if previous_tables is None:
+        changes = None
+        changed_tables = list(tables.keys())
+    else:
+        changes = feed_diff.diff_feed(previous_tables, tables)
+        changed_tables = changes["changed_tables"]
+
+    for t in changed_tables:
+        geo_io.write_geoparquet(tables[t], f"{export_path}/{t}.parquet")
+
+    segments_path = f"{export_path}/segments.parquet"
+
+    if changes is None or not os.path.exists(segments_path):
+        segments = gtfs_segments.gtfs_segments.process_feed(feed[1])
+
+    elif len(changes["affected_trips"]) + len(changes["removed_trips"]) == 0:
+        return changes
+
+    else:
+        existing_segments = gpd.read_parquet(segments_path)
+
+        if "route_id" in existing_segments.columns:
+            route_ids = feed_diff.affected_routes(
+                previous_tables["trips"], tables["trips"], changes
+            )
+            segments = feed_diff.merge_rows(
+                existing_segments,
+                gtfs_segments.gtfs_segments.process_feed(
+                    feed_diff.subset_feed(feed[1], route_ids)
+                ),
+                "route_id",
+                route_ids
+            )
+        else:
+            segments = gtfs_segments.gtfs_segments.process_feed(feed[1])
+
+    geo_io.write_geoparquet(segments, segments_path)
+
+    return changes
+
+
+def has_same_schema(
+    existing: gpd.GeoDataFrame,
+    recomputed: gpd.GeoDataFrame = None,
+    key_cols: list = ["trip_instance_key", "shape_array_key", "pattern_key"]
+) -> bool:
+    """
+    Check that an existing stop_times_direction can be merged with
+    newly preprocessed rows: same columns and same CRS.
+    With no recomputed rows (only removed trips), check
+    the key columns and the project CRS instead.
+    """
+    if recomputed is None:
+        return (
+            set(key_cols).issubset(existing.columns) and
+            existing.crs == PROJECT_CRS
+        )
+
+    return (
+        set(existing.columns) == set(recomputed.columns) and
+        existing.crs == recomputed.crs
+    )
+
+
+def export_stop_times_direction(
+    readable_name: str,
+    changes: dict = None
+):
+    """
+    Preprocess stop_times (see partridge_gtfs_wrangling) and save
+    stop_times_direction, as pattern stops + trips
+    (see partridge_gtfs_wrangling.write_stop_times_direction).
+    With changes from export_schedule_parquets, only affected trips
+    are preprocessed, and replace their rows (and removed trips' rows)
+    in the existing stop_times_direction.
+    """
+    has_existing = all(
+        os.path.exists(f"{PARTRIDGE_FOLDER}{readable_name}/{f}")
+        for f in partridge_gtfs_wrangling.STOP_TIMES_DIRECTION_FILES.values()
+    )
+
+    if changes is not None and has_existing:
+        replace_trips = changes["affected_trips"] + changes["removed_trips"]
+
+        if len(replace_trips) == 0:
+            return
+
+        existing = partridge_gtfs_wrangling.read_stop_times_direction(readable_name)
+
+        recomputed = partridge_gtfs_wrangling.get_stop_times_with_stop_geometry(
+            readable_name,
+            trip_ids = changes["affected_trips"]
+        ) if len(changes["affected_trips"]) > 0 else None
+
+        # Files written by an older version of the preprocessing can't
+        # be patched with new rows, so recompute everything instead
+        if not has_same_schema(existing, recomputed):
+            print(f"{readable_name} stop_times_direction is from an older schema, "
+                  "recomputing all trips")
+            changes = None
+
+    if changes is None or not has_existing:
+        stop_times_direction = partridge_gtfs_wrangling.get_stop_times_with_stop_geometry(
+            readable_name
+        )
+
+    else:
+        stop_times_direction = feed_diff.merge_rows(
+            existing,
+            recomputed,
+            "trip_id",
+            replace_trips
+        )
+
+        # pattern_key codes are only consistent within one run,
+        # so assign them again across old and recomputed trips
+        stop_times_direction = trip_patterns.add_pattern_key(
+            stop_times_direction,
+            trip_group = ["trip_instance_key"],
+            shape_group = ["shape_array_key"],
+            stop_col = "stop_id1"
+        ).sort_values(
+            ["trip_instance_key", "stop_sequence"]
+        ).reset_index(drop=True)
+
+    partridge_gtfs_wrangling.write_stop_times_direction(
+        stop_times_direction, readable_name
+    )
+
     return
 
+
 if __name__ == "__main__":
-    
+
+    import gtfs_segments
+
+    parser = argparse.ArgumentParser(description="Download and export GTFS schedule tables.")
+    parser.add_argument("--diff", action="store_true",
+                        help="only reprocess what changed since the last download")
+    args = parser.parse_args()
+
     for readable_name in operators_list:
-        
+
         print(f"Downloading {readable_name}")
         sources_df = gtfs_segments.fetch_gtfs_source(place=readable_name)
-        
+
         provider_name = sources_df.provider.iloc[0]
-    
+
         gtfs_segments.mobility.download_latest_data(sources_df, PARTRIDGE_FOLDER)
 
-        export_schedule_parquets(
+        changes = export_schedule_parquets(
             provider_name = provider_name,
             readable_name = readable_name,
             input_path = f"{PARTRIDGE_FOLDER}{provider_name}",
-            export_path = f"{PARTRIDGE_FOLDER}{readable_name}"
+            export_path = f"{PARTRIDGE_FOLDER}{readable_name}",
+            diff = args.diff
         )
-        
+
         print(f"Exported {provider_name} as {readable_name}")
 
-        stop_times_direction = partridge_gtfs_wrangling.get_stop_times_with_stop_geometry(
-            readable_name
-        ).pipe(
-            partridge_gtfs_wrangling.stop_times_preprocessing, 
-            trip_group = ["trip_id"]
-        )
-        
-        stop_times_direction.to_parquet(
-            f"{PARTRIDGE_FOLDER}{readable_name}/stop_times_direction.parquet"
-        )
+        if changes is not None:
+            print(
+                f"changed tables: {changes['changed_tables']}, "
+                f"affected trips: {len(changes['affected_trips'])}, "
+                f"removed trips: {len(changes['removed_trips'])}"
+            )
+
+        export_stop_times_direction(readable_name, changes)
+
         print(f"stop times preprocessing for {readable_name}")
@@ -0,0 +1,108 @@
+"""
+Detect dwells from consecutive vehicle positions.
+
+When a bus is stopped (at a stop, at a light, laying over),
+it keeps pinging at the same position along the shape.
+A run of pings with near-zero movement in vp_meters
+gets collapsed into 1 dwell event, which keeps the
+first ping's position and has 2 timestamps:
+- location_timestamp_local: when the bus arrived at the position
+- moving_timestamp_local: the last ping before it moved again
+"""
+import geopandas as gpd
+import numpy as np
+
+import group_kernels
+
+DWELL_METERS_THRESHOLD = 3
+
+def dwell_run_starts(
+    is_trip_start: np.ndarray,
+    vp_meters: np.ndarray,
+    meters_threshold: float = DWELL_METERS_THRESHOLD
+) -> np.ndarray:
+    """
+    A new run starts at the beginning of every trip
+    and whenever the vp is more than meters_threshold
+    along the shape from the first vp of the current run (the anchor).
+    Rows that are not run starts belong to the prior row's dwell.
+
+    Measuring from the anchor rather than the prior vp matters
+    for a bus crawling in traffic: pings 1 meter apart never
+    move more than the threshold from each other, but the bus
+    does cover real distance, so a new run starts every time
+    it gets more than meters_threshold from where the run began.
+
+    Runs are sequential within a trip, so we step through
+    rows, but every trip's current run is checked at once.
+    """
+    n = len(vp_meters)
+    is_run_start = np.asarray(is_trip_start, dtype=bool).copy()
+
+    trip_starts = np.flatnonzero(is_run_start)
+    trip_ends = np.append(trip_starts[1:], n)
+
+    anchor = trip_starts.copy()
+    current = trip_starts + 1
+
+    active = np.flatnonzero(current < trip_ends)
+
+    while len(active) > 0:
+        rows = current[active]
+        broke = np.abs(vp_meters[rows] - vp_meters[anchor[active]]) > meters_threshold
+
+        is_run_start[rows[broke]] = True
+        anchor[active[broke]] = rows[broke]
+
+        current[active] += 1
+        active = active[current[active] < trip_ends[active]]
+
+    return is_run_start
+
+
+def collapse_dwells(
+    gdf: gpd.GeoDataFrame,
+    trip_group: list = ["trip_id"],
+    meters_col: str = "vp_meters",
+    timestamp_col: str = "location_timestamp_local",
+    meters_threshold: float = DWELL_METERS_THRESHOLD
+) -> gpd.GeoDataFrame:
+    """
+    Collapse runs of vp with near-zero movement into single dwell events.
+
+    Sort once by trip and timestamp (group_kernels), find where each run starts,
+    and keep only the first row of each run. The last timestamp of
+    the run becomes moving_timestamp_local, and we keep
+    how many vp were collapsed and how long the dwell was.
+    """
+    order, is_trip_start, _ = group_kernels.sort_groups(
+        gdf, trip_group, [timestamp_col]
+    )
+    gdf = gdf.iloc[order].reset_index(drop=True)
+
+    is_run_start = dwell_run_starts(
+        is_trip_start,
+        gdf[meters_col].to_numpy(),
+        meters_threshold
+    )
+
+    start_idx = np.flatnonzero(is_run_start)
+    end_idx = np.append(start_idx[1:] - 1, len(gdf) - 1)
+
+    timestamps = gdf[timestamp_col].to_numpy()
+
+    gdf2 = gdf.iloc[start_idx].reset_index(drop=True)
+
+    gdf2 = gdf2.assign(
+        moving_timestamp_local = timestamps[end_idx],
+        n_vp = (end_idx - start_idx + 1).astype("int32"),
+    )
+
+    gdf2 = gdf2.assign(
+        dwell_sec = (
+            (gdf2.moving_timestamp_local - gdf2[timestamp_col])
+            / np.timedelta64(1, "s")
+        )
+    )
+
+    return gdf2
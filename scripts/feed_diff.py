@@ -0,0 +1,219 @@
+"""
+Compare a newly downloaded GTFS feed against the tables
+we exported from the previous version.
+
+Each table is hashed row by row (geometry as WKB) and
+rolled up by its key: trip_id for trips and stop_times,
+shape_id for shapes, stop_id for stops.
+Keys whose hash changed, or that were added or removed,
+tell us which trips have to be reprocessed:
+- trips whose own row or stop_times changed
+- trips on a changed shape
+- trips that serve a changed stop
+
+Everything downstream for the other trips stays as is,
+and recomputed rows are merged into the existing outputs.
+"""
+import geopandas as gpd
+import numpy as np
+import os
+import pandas as pd
+import shapely
+import types
+
+FEED_TABLE_KEYS = {
+    "trips": "trip_id",
+    "stop_times": "trip_id",
+    "shapes": "shape_id",
+    "stops": "stop_id",
+}
+
+GEO_TABLES = ["shapes", "stops"]
+
+def keyed_hashes(
+    df: pd.DataFrame,
+    key_col: str
+) -> pd.Series:
+    """
+    Hash every row (all columns, in sorted column order),
+    and add up the row hashes (wrapping uint64) by key,
+    so a key's hash doesn't depend on row order.
+    """
+    value_cols = sorted(df.columns)
+
+    values = pd.DataFrame({
+        c: (shapely.to_wkb(df[c].to_numpy()) if df[c].dtype == "geometry"
+            else df[c].to_numpy())
+        for c in value_cols
+    })
+
+    row_hash = pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+    codes, keys = pd.factorize(df[key_col].astype(str))
+
+    key_hash = np.zeros(len(keys), dtype="uint64")
+    np.add.at(key_hash, codes, row_hash)
+
+    return pd.Series(key_hash, index=keys)
+
+
+def diff_keys(
+    old_hashes: pd.Series,
+    new_hashes: pd.Series
+) -> dict:
+    """
+    Keys that were added, removed, or whose hash changed.
+    """
+    common = old_hashes.index.intersection(new_hashes.index)
+
+    return {
+        "added": new_hashes.index.difference(old_hashes.index).tolist(),
+        "removed": old_hashes.index.difference(new_hashes.index).tolist(),
+        "changed": common[
+            old_hashes.loc[common].to_numpy() != new_hashes.loc[common].to_numpy()
+        ].tolist(),
+    }
+
+
+def read_previous_tables(
+    export_path: str,
+    tables: list = list(FEED_TABLE_KEYS.keys())
+) -> dict:
+    """
+    Tables exported from the previous feed, or None if
+    any are missing (then everything is processed).
+    """
+    paths = {t: f"{export_path}/{t}.parquet" for t in tables}
+
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+
+    return {
+        t: gpd.read_parquet(p) if t in GEO_TABLES else pd.read_parquet(p)
+        for t, p in paths.items()
+    }
+
+
+def diff_feed(
+    old_tables: dict,
+    new_tables: dict
+) -> dict:
+    """
+    Compare the old and new feed tables.
+
+    Returns:
+    - tables: {table: {"added", "removed", "changed"}} of keys
+    - changed_tables: tables with any difference
+    - affected_trips: trip_ids in the new feed to reprocess
+    - removed_trips: trip_ids no longer in the feed
+    """
+    tables = {}
+
+    for t, key_col in FEED_TABLE_KEYS.items():
+        old_df, new_df = old_tables[t], new_tables[t]
+
+        if sorted(old_df.columns) != sorted(new_df.columns):
+            # Columns changed, treat every key as changed
+            old_keys = set(old_df[key_col].astype(str))
+            new_keys = set(new_df[key_col].astype(str))
+            tables[t] = {
+                "added": sorted(new_keys - old_keys),
+                "removed": sorted(old_keys - new_keys),
+                "changed": sorted(new_keys & old_keys),
+            }
+        else:
+            tables[t] = diff_keys(
+                keyed_hashes(old_df, key_col),
+                keyed_hashes(new_df, key_col)
+            )
+
+    new_trips = new_tables["trips"].assign(
+        trip_id = lambda x: x.trip_id.astype(str),
+        shape_id = lambda x: x.shape_id.astype(str)
+    )
+    new_stop_times = new_tables["stop_times"].assign(
+        trip_id = lambda x: x.trip_id.astype(str),
+        stop_id = lambda x: x.stop_id.astype(str)
+    )
+
+    shapes_diff = tables["shapes"]["added"] + tables["shapes"]["changed"]
+    stops_diff = tables["stops"]["added"] + tables["stops"]["changed"]
+
+    affected_trips = (
+        set(tables["trips"]["added"]) | set(tables["trips"]["changed"]) |
+        set(tables["stop_times"]["added"]) | set(tables["stop_times"]["changed"]) |
+        set(new_trips[new_trips.shape_id.isin(shapes_diff)].trip_id) |
+        set(new_stop_times[new_stop_times.stop_id.isin(stops_diff)].trip_id)
+    ) & set(new_trips.trip_id)
+
+    removed_trips = set(tables["trips"]["removed"]) | set(tables["stop_times"]["removed"])
+
+    return {
+        "tables": tables,
+        "changed_tables": [
+            t for t, d in tables.items() if any(len(v) > 0 for v in d.values())
+        ],
+        "affected_trips": sorted(affected_trips),
+        "removed_trips": sorted(removed_trips - set(new_trips.trip_id)),
+    }
+
+
+def affected_routes(
+    old_trips: pd.DataFrame,
+    new_trips: pd.DataFrame,
+    changes: dict
+) -> list:
+    """
+    route_ids of affected trips (new feed) and removed trips (old feed).
+    Segments are aggregated across a route's trips, so
+    they're recomputed for whole routes.
+    """
+    new_route = new_trips.trip_id.astype(str).isin(changes["affected_trips"])
+    old_route = old_trips.trip_id.astype(str).isin(changes["removed_trips"])
+
+    return sorted(
+        set(new_trips[new_route].route_id.astype(str)) |
+        set(old_trips[old_route].route_id.astype(str))
+    )
+
+
+def subset_feed(
+    feed,
+    route_ids: list
+):
+    """
+    A feed-like object with only the trips on these routes
+    (and their stop_times and shapes), to pass to gtfs_segments.
+    """
+    trips = feed.trips[feed.trips.route_id.astype(str).isin(route_ids)]
+
+    return types.SimpleNamespace(
+        **{t: getattr(feed, t) for t in ["agency", "routes", "stops", "calendar", "calendar_dates"]},
+        trips = trips,
+        stop_times = feed.stop_times[feed.stop_times.trip_id.isin(trips.trip_id)],
+        shapes = feed.shapes[feed.shapes.shape_id.isin(trips.shape_id)],
+    )
+
+
+def merge_rows(
+    existing: pd.DataFrame,
+    recomputed: pd.DataFrame,
+    key_col: str,
+    replace_keys: list
+) -> pd.DataFrame:
+    """
+    Drop the rows for replace_keys from existing, and add the recomputed rows.
+    Categorical columns (keys encoded against different dictionaries)
+    are combined as plain values.
+    """
+    keep = existing[~existing[key_col].astype(str).isin(replace_keys)]
+
+    dfs = [
+        df.assign(**{
+            c: df[c].astype(object) for c in df.columns
+            if isinstance(df[c].dtype, pd.CategoricalDtype)
+        })
+        for df in [keep, recomputed] if df is not None
+    ]
+
+    return pd.concat(dfs, axis=0, ignore_index=True)
@@ -0,0 +1,205 @@
+"""
+Read and write geoparquet with GeoArrow geometry encoding.
+
+With WKB (the default for to_parquet), every read parses each
+geometry blob into a shapely object, even when the next step
+only needs the x/y coordinates.
+
+GeoArrow stores points as x and y columns, and linestrings as
+offsets into x and y columns. Those can be read straight into
+numpy arrays (read_coords), and a GeoSeries is built only if needed
+(coords_to_geoseries).
+
+geopandas >= 1.0 writes GeoArrow (geometry_encoding="geoarrow").
+On older versions, for columns that mix geometry types,
+or for types other than points and linestrings, we fall back to WKB, and read_coords still works (it parses the WKB).
+"""
+import geopandas as gpd
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from typing import Union
+
+GEOMETRY_ENCODING = "geoarrow"
+
+# shapely type ids that read_coords decodes from GeoArrow: point, linestring
+GEOARROW_TYPE_IDS = [0, 1]
+
+def has_geoarrow_coords(gdf: gpd.GeoDataFrame) -> bool:
+    """
+    True if every geometry column holds only points or only linestrings.
+    """
+    for c in gdf.columns[gdf.dtypes == "geometry"]:
+        type_ids = np.unique(shapely.get_type_id(gdf[c].to_numpy()))
+        type_ids = type_ids[type_ids >= 0]
+
+        if len(type_ids) > 1 or not np.isin(type_ids, GEOARROW_TYPE_IDS).all():
+            return False
+
+    return True
+
+
+def write_geoparquet(
+    df: Union[pd.DataFrame, gpd.GeoDataFrame],
+    path: str,
+    geometry_encoding: str = GEOMETRY_ENCODING,
+    **kwargs
+):
+    """
+    to_parquet, using GeoArrow encoding for GeoDataFrames when we can.
+    read_coords only decodes GeoArrow points and linestrings,
+    so other geometry types (multilinestrings, polygons) are written as WKB.
+    """
+    if (
+        not isinstance(df, gpd.GeoDataFrame) or 
+        geometry_encoding == "WKB" or
+        not has_geoarrow_coords(df)
+    ):
+        df.to_parquet(path, **kwargs)
+        return
+
+    try:
+        df.to_parquet(path, geometry_encoding=geometry_encoding, **kwargs)
+    except (TypeError, ValueError, NotImplementedError):
+        # TypeError: geopandas < 1.0 doesn't have geometry_encoding
+        # ValueError / NotImplementedError: mixed geometry types
+        df.to_parquet(path, **kwargs)
+
+    return
+
+
+def geo_metadata(schema: pa.Schema) -> dict:
+    if schema.metadata is None or b"geo" not in schema.metadata:
+        return {}
+
+    return json.loads(schema.metadata[b"geo"])
+
+
+def xy_from_struct(arr: pa.Array) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Separated GeoArrow coordinates: struct<x, y>.
+    """
+    x = arr.field("x").to_numpy(zero_copy_only=False).astype("float64")
+    y = arr.field("y").to_numpy(zero_copy_only=False).astype("float64")
+
+    if arr.null_count > 0:
+        is_null = arr.is_null().to_numpy(zero_copy_only=False)
+        x[is_null] = np.nan
+        y[is_null] = np.nan
+
+    return x, y
+
+
+def column_coords(
+    arr: pa.Array,
+    encoding: str
+) -> dict:
+    """
+    Coordinates of 1 geometry column.
+    - points: {"x", "y"}, 1 value per row (NaN for missing)
+    - everything else: {"x", "y", "offsets"}, where row i's coordinates
+    are x[offsets[i]: offsets[i + 1]]
+    """
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+
+    # If geoarrow types are registered, the column comes back as an extension type
+    if isinstance(arr, pa.ExtensionArray):
+        arr = arr.storage
+
+    if encoding == "point":
+        x, y = xy_from_struct(arr)
+        return {"x": x, "y": y}
+
+    if encoding == "linestring":
+        offsets = arr.offsets.to_numpy().astype("int64")
+        # offsets of a sliced list array don't start at 0
+        x, y = xy_from_struct(arr.values)
+        return {
+            "x": x[offsets[0]: offsets[-1]],
+            "y": y[offsets[0]: offsets[-1]],
+            "offsets": offsets - offsets[0],
+        }
+
+    # WKB (or any other encoding): parse into shapely, then get coordinates
+    geometry = shapely.from_wkb(arr.to_numpy(zero_copy_only=False))
+    coords, row = shapely.get_coordinates(geometry, return_index=True)
+
+    type_ids = shapely.get_type_id(geometry)
+
+    if (type_ids[type_ids >= 0] == 0).all():
+        x = np.full(len(geometry), np.nan)
+        y = np.full(len(geometry), np.nan)
+        x[row] = coords[:, 0]
+        y[row] = coords[:, 1]
+        return {"x": x, "y": y}
+
+    offsets = np.append(0, np.cumsum(np.bincount(row, minlength=len(geometry))))
+
+    return {"x": coords[:, 0], "y": coords[:, 1], "offsets": offsets}
+
+
+def read_coords(
+    path: str,
+    columns: list = None,
+    filters: list = None,
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Read a geoparquet without building shapely objects.
+    Returns the non-geometry columns as a df, and
+    {geometry_col: {"x", "y", ("offsets"), "crs"}}.
+    """
+    table = pq.read_table(path, columns=columns, filters=filters)
+    geo_cols = geo_metadata(table.schema).get("columns", {})
+
+    coords = {}
+
+    for c, col_meta in geo_cols.items():
+        if c not in table.column_names:
+            continue
+
+        coords[c] = {
+            **column_coords(table.column(c), col_meta.get("encoding", "WKB")),
+            "crs": col_meta.get("crs", "OGC:CRS84"),
+        }
+
+    df = table.drop_columns(list(coords.keys())).to_pandas()
+
+    return df, coords
+
+
+def coords_to_geoseries(
+    col_coords: dict,
+    index: pd.Index = None
+) -> gpd.GeoSeries:
+    """
+    Build shapely points or linestrings from read_coords output.
+    """
+    crs = col_coords.get("crs")
+    if isinstance(crs, dict):
+        crs = json.dumps(crs)
+
+    if "offsets" not in col_coords:
+        geometry = shapely.points(col_coords["x"], col_coords["y"])
+        geometry[np.isnan(col_coords["x"])] = None
+
+    else:
+        offsets = col_coords["offsets"]
+        n_coords = np.diff(offsets)
+        geometry = np.full(len(n_coords), None, dtype=object)
+
+        # linestrings need 2+ points, the rest are left missing
+        has_line = n_coords > 1
+        keep = np.repeat(has_line, n_coords)
+
+        if has_line.any():
+            geometry[has_line] = shapely.linestrings(
+                np.column_stack([col_coords["x"][keep], col_coords["y"][keep]]),
+                indices = np.repeat(np.arange(has_line.sum()), n_coords[has_line])
+            )
+
+    return gpd.GeoSeries(geometry, index=index, crs=crs)
@@ -0,0 +1,177 @@
+"""
+Run bulk shapely / pyproj operations on a thread pool.
+
+Shapely 2 and pyproj release the GIL while they work through arrays,
+so splitting a big array into chunks and running the chunks on threads
+uses multiple cores without pickling geometries to other processes.
+Arrays smaller than 1 chunk run on the calling thread.
+
+Thread count comes from GEO_THREADS in update_vars
+(None uses every CPU), or n_threads in each function.
+
+With the shape cache on (the default), stop_meters and vp_meters
+come from shape_cache.project, which splits the work by shape
+(not in row chunks) over the same thread count. project here is the
+path with the cache off.
+
+Benchmark on the LADOT partridge feed:
+python geo_threads.py
+"""
+import concurrent.futures
+import datetime
+import geopandas as gpd
+import numpy as np
+import os
+import pandas as pd
+import pyproj
+import shapely
+
+from update_vars import GEO_THREADS, PARTRIDGE_FOLDER, PROJECT_CRS
+
+CHUNK_SIZE = 20_000
+
+def get_n_threads(n_threads: int = None) -> int:
+    if n_threads is None:
+        n_threads = GEO_THREADS
+
+    return n_threads if n_threads is not None else (os.cpu_count() or 1)
+
+
+def chunked_map(
+    func,
+    arrays: list,
+    n_threads: int = None,
+    chunk_size: int = CHUNK_SIZE
+) -> np.ndarray:
+    """
+    Call func on the same slice of every array, chunk by chunk,
+    on a thread pool, and concatenate the results in order.
+    """
+    n_threads = get_n_threads(n_threads)
+    n = len(arrays[0])
+
+    if n_threads <= 1 or n <= chunk_size:
+        return func(*arrays)
+
+    starts = range(0, n, chunk_size)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as pool:
+        results = list(pool.map(
+            lambda start: func(*[a[start: start + chunk_size] for a in arrays]),
+            starts
+        ))
+
+    return np.concatenate(results)
+
+
+def project(
+    lines: gpd.GeoSeries,
+    points: gpd.GeoSeries,
+    n_threads: int = None
+) -> np.ndarray:
+    """
+    Same as lines.project(points) (rows already aligned).
+    """
+    return chunked_map(
+        shapely.line_locate_point,
+        [np.asarray(lines.to_numpy()), np.asarray(points.to_numpy())],
+        n_threads
+    )
+
+
+def get_x(points: gpd.GeoSeries, n_threads: int = None) -> np.ndarray:
+    return chunked_map(shapely.get_x, [np.asarray(points.to_numpy())], n_threads)
+
+
+def get_y(points: gpd.GeoSeries, n_threads: int = None) -> np.ndarray:
+    return chunked_map(shapely.get_y, [np.asarray(points.to_numpy())], n_threads)
+
+
+def to_crs(
+    geometry: gpd.GeoSeries,
+    crs: str,
+    n_threads: int = None
+) -> gpd.GeoSeries:
+    """
+    Same as geometry.to_crs(crs).
+    Transformers aren't thread-safe, so each chunk makes its own.
+    """
+    def transform_chunk(geoms):
+        transformer = pyproj.Transformer.from_crs(
+            geometry.crs, crs, always_xy=True
+        )
+        return shapely.transform(
+            geoms,
+            lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1]))
+        )
+
+    transformed = chunked_map(
+        transform_chunk, [np.asarray(geometry.to_numpy())], n_threads
+    )
+
+    return gpd.GeoSeries(
+        transformed, index=geometry.index, crs=crs, name=geometry.name
+    )
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+
+    import partridge_gtfs_wrangling
+    import shape_cache
+
+    stop_times, stops, trips, shapes = partridge_gtfs_wrangling.read_partridge_tables("LADOT")
+
+    gdf = partridge_gtfs_wrangling.merge_stop_times_trips_shapes_stops(
+        stop_times,
+        stops,
+        trips[["trip_instance_key", "shape_id", "shape_array_key"]],
+        shapes[["shape_array_key", "geometry"]],
+        stop_group = ["schedule_gtfs_dataset_key", "stop_id"],
+        trip_group = ["trip_instance_key"],
+        shape_group = ["shape_array_key"]
+    )
+
+    points = gdf.geometry
+    lines = gpd.GeoSeries(gdf.shape_geometry)
+    points_wgs84 = points.to_crs("EPSG:4326")
+
+    cache_folder = f"{tempfile.mkdtemp()}/"
+    line_keys = gdf[["shape_array_key"]]
+
+    # Write the cache entries first, so every run uses a warm cache
+    shape_cache.project(lines, points, line_keys, cache_folder)
+
+    operations = {
+        "project": lambda n: project(lines, points, n),
+        "shape_cache.project": lambda n: shape_cache.project(
+            lines, points, line_keys, cache_folder, n_threads=n),
+        "x/y": lambda n: (get_x(points, n), get_y(points, n)),
+        "to_crs": lambda n: to_crs(points_wgs84, PROJECT_CRS, n),
+    }
+
+    print(f"{len(gdf)} stop_times rows from {PARTRIDGE_FOLDER}LADOT, {os.cpu_count()} CPUs")
+
+    results = []
+
+    for n_threads in [1, 2, 4, 8]:
+        for name, func in operations.items():
+            start = datetime.datetime.now()
+            func(n_threads)
+            end = datetime.datetime.now()
+
+            results.append({
+                "operation": name,
+                "n_threads": n_threads,
+                "sec": (end - start).total_seconds()
+            })
+
+    results = pd.DataFrame(results)
+    results = results.assign(
+        speedup = results.groupby("operation").sec.transform("first") / results.sec
+    )
+
+    print(results.pivot(index="n_threads", columns="operation", values=["sec", "speedup"]).round(3))
+
+    shutil.rmtree(cache_folder, ignore_errors=True)
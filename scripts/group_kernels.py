@@ -0,0 +1,168 @@
+"""
+Grouped shift kernel.
+
+df.groupby(trip_group).col.shift(n) hashes the group keys again on every call.
+Here we sort once by the group columns (and ordering columns),
+find where each group starts, and then any number of
+lead/lag columns are just NumPy slices of the sorted arrays,
+with the values that would cross a group boundary filled as missing.
+
+Results are scattered back to the df's row order,
+so they can be assigned like a groupby shift.
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+def sort_groups(
+    df: pd.DataFrame,
+    group_cols: list,
+    order_cols: list = []
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sort rows by group_cols + order_cols. If order_cols is empty,
+    rows keep their current order within a group (np.lexsort is stable),
+    just like groupby.
+
+    Returns:
+    - order: positions of df's rows in sorted order
+    - is_group_start: flag for the first row of each group (sorted order)
+    - has_group: False for rows where a group col is missing
+    (groupby drops these groups, so their shifted values are missing)
+    """
+    codes = [pd.factorize(df[c], sort=True)[0] for c in group_cols]
+
+    # np.lexsort uses the last key as the primary key
+    order = np.lexsort(
+        [df[c].to_numpy() for c in order_cols][::-1] + codes[::-1]
+    ) if len(df) > 0 else np.zeros(0, dtype="int64")
+
+    is_group_start = np.zeros(len(df), dtype=bool)
+    has_group = np.ones(len(df), dtype=bool)
+
+    if len(df) > 0:
+        is_group_start[0] = True
+
+    for code in codes:
+        sorted_code = code[order]
+        is_group_start[1:] |= (sorted_code[1:] != sorted_code[:-1])
+        has_group &= (sorted_code >= 0)
+
+    return order, is_group_start, has_group
+
+
+def group_ranks(
+    is_group_start: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    For each row (sorted order), its 0-based position within the group
+    and the number of rows in its group.
+    """
+    starts = np.flatnonzero(is_group_start)
+    group_num = np.cumsum(is_group_start) - 1
+    sizes = np.diff(np.append(starts, len(is_group_start)))
+
+    rank = np.arange(len(is_group_start)) - starts[group_num]
+
+    return rank, sizes[group_num]
+
+
+def shift_sorted(
+    values: np.ndarray,
+    periods: int,
+    fill_value
+) -> np.ndarray:
+    """
+    Plain shift of an array (no groups): positive periods lag, negative lead.
+    """
+    shifted = np.full(len(values), fill_value, dtype=values.dtype)
+
+    if periods > 0:
+        shifted[periods:] = values[:-periods]
+    elif periods < 0:
+        shifted[:periods] = values[-periods:]
+    else:
+        shifted[:] = values
+
+    return shifted
+
+
+def grouped_shift(
+    df: pd.DataFrame,
+    shifts: dict,
+    group_cols: list = None,
+    order_cols: list = [],
+    sorted_groups: tuple = None,
+) -> dict:
+    """
+    shifts: {new_col: (col, periods)}, ex:
+    {"subseq_stop_meters": ("stop_meters", -1), "prior_geometry": ("geometry", 1)}
+
+    Pass in sorted_groups (from sort_groups) to reuse one sort
+    across calls, otherwise sort by group_cols + order_cols.
+
+    Returns {new_col: Series in df's row order}, same as
+    df.groupby(group_cols)[col].shift(periods), keeping the dtype
+    for categoricals, datetimes, and geometry.
+    """
+    if sorted_groups is None:
+        sorted_groups = sort_groups(df, group_cols, order_cols)
+
+    order, is_group_start, has_group = sorted_groups
+    rank, size = group_ranks(is_group_start)
+
+    results = {}
+
+    for new_col, (col, periods) in shifts.items():
+        series = df[col]
+
+        # Crossing a group boundary: lag looks before the group start,
+        # lead looks past the group end
+        if periods >= 0:
+            is_missing = (rank < periods) | ~has_group
+        else:
+            is_missing = (rank >= size + periods) | ~has_group
+
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            values = shift_sorted(series.cat.codes.to_numpy()[order], periods, -1)
+            values[is_missing] = -1
+        elif isinstance(series, gpd.GeoSeries):
+            values = shift_sorted(series.to_numpy()[order], periods, None)
+            values[is_missing] = None
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            values = shift_sorted(series.to_numpy()[order], periods, np.datetime64("NaT"))
+            values[is_missing] = np.datetime64("NaT")
+        elif (pd.api.types.is_numeric_dtype(series) and
+              not pd.api.types.is_bool_dtype(series)):
+            # ints become floats to hold NaN, like a pandas shift
+            float_dtype = (
+                series.dtype if pd.api.types.is_float_dtype(series.dtype) and 
+                isinstance(series.dtype, np.dtype) else "float64"
+            )
+            values = shift_sorted(
+                series.to_numpy(dtype=float_dtype, na_value=np.nan)[order],
+                periods, np.nan
+            )
+            values[is_missing] = np.nan
+        else:
+            values = shift_sorted(series.to_numpy(dtype=object)[order], periods, np.nan)
+            values[is_missing] = np.nan
+
+        unsorted = np.empty(len(order), dtype=values.dtype)
+        unsorted[order] = values
+
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            results[new_col] = pd.Series(
+                pd.Categorical.from_codes(unsorted, dtype=series.dtype), 
+                index=df.index
+            )
+        elif isinstance(series, gpd.GeoSeries):
+            results[new_col] = gpd.GeoSeries(unsorted, index=df.index, crs=series.crs)
+        elif pd.api.types.is_extension_array_dtype(series.dtype):
+            results[new_col] = pd.Series(
+                pd.array(unsorted, dtype=series.dtype), index=df.index
+            )
+        else:
+            results[new_col] = pd.Series(unsorted, index=df.index)
+
+    return results
@@ -0,0 +1,460 @@
+"""
+Ingest GTFS-RT VehiclePositions feeds into vp parquets.
+
+Poll a set of feed URLs concurrently with asyncio,
+decode the protobuf, drop pings we've already seen for a vehicle,
+and buffer rows in memory. Flush in bulk to parquet partitioned by
+service_date and schedule_gtfs_dataset_key, with the columns
+create_table.vp_projected_table expects (read it with vp_table="vp_rt"):
+service_date, schedule_gtfs_dataset_key, trip_instance_key, trip_id,
+location_timestamp_local, geometry.
+
+For testing, serve_recorded_feeds stands up a local HTTP server
+that plays back recorded feed files.
+"""
+import asyncio
+import datetime
+import functools
+import geopandas as gpd
+import http.server
+import os
+import pandas as pd
+import threading
+import urllib.request
+
+import geo_io
+import schema
+from update_vars import OUTPUT_FOLDER, RT_FEEDS, WGS84
+
+VP_RT_FOLDER = f"{OUTPUT_FOLDER}vp_rt/"
+LOCAL_TIMEZONE = "America/Los_Angeles"
+
+POLL_INTERVAL_SEC = 20
+FLUSH_ROWS = 50_000
+FLUSH_INTERVAL_SEC = 300
+REQUEST_TIMEOUT_SEC = 10
+# Forget vehicles that haven't pinged in this long
+LAST_SEEN_SEC = 3600
+
+VP_COLS = [
+    "schedule_gtfs_dataset_key", "vehicle_id", "trip_id", "start_date",
+    "timestamp", "latitude", "longitude"
+]
+
+def fetch_feed(url: str, timeout: int = REQUEST_TIMEOUT_SEC) -> bytes:
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+
+def decode_vehicle_positions(
+    content: bytes,
+    schedule_gtfs_dataset_key: str
+) -> list:
+    """
+    Parse a VehiclePositions FeedMessage into rows (tuples in VP_COLS order).
+    Entities without a trip or position can't be used for speeds.
+    """
+    from google.transit import gtfs_realtime_pb2
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+
+    header_timestamp = feed.header.timestamp
+
+    rows = []
+    for entity in feed.entity:
+        if not entity.HasField("vehicle"):
+            continue
+
+        vp = entity.vehicle
+        if not (vp.HasField("trip") and vp.HasField("position")):
+            continue
+
+        rows.append((
+            schedule_gtfs_dataset_key,
+            vp.vehicle.id or entity.id,
+            vp.trip.trip_id,
+            vp.trip.start_date,
+            vp.timestamp or header_timestamp,
+            vp.position.latitude,
+            vp.position.longitude,
+        ))
+
+    return rows
+
+
+class VehiclePositionBuffer:
+    """
+    Hold decoded rows in memory, dropping repeated pings.
+
+    A vehicle's ping is a repeat if its timestamp isn't newer
+    than the last one we kept for that vehicle. Feeds polled every
+    10-30s often send the same ping several times.
+    Vehicles that haven't pinged in last_seen_sec are forgotten
+    when the buffer is drained, so last_seen doesn't keep growing.
+    """
+    def __init__(self, last_seen_sec: int = LAST_SEEN_SEC):
+        self.rows = []
+        self.last_seen = {}
+        self.last_seen_sec = last_seen_sec
+        self.newest_timestamp = 0
+        self.n_duplicates = 0
+
+    def add(self, rows: list) -> int:
+        n_added = 0
+
+        for row in rows:
+            vehicle = (row[0], row[1])
+            timestamp = row[4]
+
+            if self.last_seen.get(vehicle, -1) >= timestamp:
+                self.n_duplicates += 1
+                continue
+
+            self.last_seen[vehicle] = timestamp
+            self.newest_timestamp = max(self.newest_timestamp, timestamp)
+            self.rows.append(row)
+            n_added += 1
+
+        return n_added
+
+    def drain(self) -> list:
+        rows, self.rows = self.rows, []
+
+        cutoff = self.newest_timestamp - self.last_seen_sec
+        self.last_seen = {
+            vehicle: timestamp for vehicle, timestamp in self.last_seen.items()
+            if timestamp >= cutoff
+        }
+
+        return rows
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def rows_to_vp(
+    rows: list,
+    trip_key_lookup: pd.DataFrame = None
+) -> gpd.GeoDataFrame:
+    """
+    Turn buffered rows into the vp table schema.
+
+    trip_instance_key follows the schedule the feed is matched against:
+    - warehouse feeds: pass trip_key_lookup (schedule_gtfs_dataset_key,
+      service_date, trip_id, trip_instance_key) from the warehouse trips.
+      Trips not in it have no warehouse key, and are left null.
+    - feeds downloaded with partridge (no trip_key_lookup): the int64
+      schema.hash_key of (schedule_gtfs_dataset_key, service_date, trip_id),
+      the same key partridge_gtfs_wrangling gives its trips.
+    """
+    df = pd.DataFrame.from_records(rows, columns = VP_COLS)
+
+    location_timestamp_local = pd.to_datetime(
+        df.timestamp, unit="s", utc=True
+    ).dt.tz_convert(LOCAL_TIMEZONE).dt.tz_localize(None)
+
+    # start_date is YYYYMMDD in GTFS-RT, fall back to the local date of the ping
+    service_date = pd.to_datetime(
+        df.start_date, format="%Y%m%d", errors="coerce"
+    ).fillna(location_timestamp_local.dt.normalize())
+
+    df = df.assign(
+        service_date = service_date,
+        location_timestamp_local = location_timestamp_local,
+    )
+
+    if trip_key_lookup is not None:
+        df = pd.merge(
+            df,
+            trip_key_lookup,
+            on = ["schedule_gtfs_dataset_key", "service_date", "trip_id"],
+            how = "left"
+        )
+    else:
+        df = df.assign(
+            trip_instance_key = schema.hash_key(
+                df, schema.HASH_KEY_COLS["trip_instance_key"])
+        )
+
+    gdf = gpd.GeoDataFrame(
+        df,
+        geometry = gpd.points_from_xy(df.longitude, df.latitude),
+        crs = WGS84
+    )
+
+    return gdf[[
+        "service_date", "schedule_gtfs_dataset_key", "trip_instance_key", "trip_id",
+        "vehicle_id", "location_timestamp_local", "geometry"
+    ]]
+
+
+def write_vp_partitions(
+    gdf: gpd.GeoDataFrame,
+    output_folder: str = VP_RT_FOLDER,
+) -> int:
+    """
+    Write 1 file per service_date / operator in this flush.
+    File names are unique per flush, so files are only ever added.
+    The folders are named like hive partitions, but service_date
+    and schedule_gtfs_dataset_key are also kept in the files
+    (service_date as datetime, like the vp table), so read them
+    with read_vp_partitions.
+    """
+    flush_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+    for (service_date, operator), part_gdf in gdf.groupby(
+        ["service_date", "schedule_gtfs_dataset_key"]
+    ):
+        part_folder = (
+            f"{output_folder}service_date={service_date.date()}/"
+            f"schedule_gtfs_dataset_key={operator}"
+        )
+        os.makedirs(part_folder, exist_ok=True)
+
+        geo_io.write_geoparquet(
+            part_gdf.sort_values(
+                ["trip_instance_key", "location_timestamp_local"]
+            ).reset_index(drop=True),
+            f"{part_folder}/part-{flush_id}.parquet"
+        )
+
+    return len(gdf)
+
+
+def read_vp_partitions(
+    folder_path: str = VP_RT_FOLDER,
+    **kwargs
+) -> gpd.GeoDataFrame:
+    """
+    Read the vp written by write_vp_partitions, with the
+    columns from the files (not the folder names), so service_date
+    is datetime64 and merges with trips.
+    kwargs (columns, filters) are passed to gpd.read_parquet.
+    """
+    return gpd.read_parquet(folder_path, partitioning=None, **kwargs)
+
+
+async def poll_feed(
+    schedule_gtfs_dataset_key: str,
+    url: str,
+    buffer: VehiclePositionBuffer,
+    stop_event: asyncio.Event,
+    interval: int = POLL_INTERVAL_SEC,
+    stats: dict = None
+):
+    """
+    Poll 1 feed until stop_event is set.
+    The download runs in a thread so feeds are fetched concurrently;
+    a failed request is counted and retried on the next poll.
+    """
+    loop = asyncio.get_running_loop()
+
+    while not stop_event.is_set():
+        started = loop.time()
+
+        try:
+            content = await asyncio.to_thread(fetch_feed, url)
+            rows = decode_vehicle_positions(content, schedule_gtfs_dataset_key)
+            n_added = buffer.add(rows)
+
+            if stats is not None:
+                stats["polls"] += 1
+                stats["rows"] += n_added
+
+        except Exception as e:
+            if stats is not None:
+                stats["errors"] += 1
+            print(f"{schedule_gtfs_dataset_key}: {e}")
+
+        try:
+            await asyncio.wait_for(
+                stop_event.wait(),
+                timeout = max(interval - (loop.time() - started), 0)
+            )
+        except asyncio.TimeoutError:
+            pass
+
+
+async def flush_periodically(
+    buffer: VehiclePositionBuffer,
+    stop_event: asyncio.Event,
+    output_folder: str = VP_RT_FOLDER,
+    trip_key_lookup: pd.DataFrame = None,
+    flush_rows: int = FLUSH_ROWS,
+    flush_interval: int = FLUSH_INTERVAL_SEC,
+    stats: dict = None
+):
+    """
+    Flush when the buffer is big enough or enough time has passed,
+    and once more when we're told to stop.
+    Building and writing the parquet runs in a thread.
+    """
+    loop = asyncio.get_running_loop()
+    last_flush = loop.time()
+
+    while True:
+        is_stopping = stop_event.is_set()
+
+        if len(buffer) > 0 and (
+            is_stopping or
+            len(buffer) >= flush_rows or
+            loop.time() - last_flush >= flush_interval
+        ):
+            rows = buffer.drain()
+            n_written = await asyncio.to_thread(
+                lambda: write_vp_partitions(
+                    rows_to_vp(rows, trip_key_lookup), output_folder
+                )
+            )
+            last_flush = loop.time()
+
+            if stats is not None:
+                stats["flushed"] += n_written
+
+        if is_stopping:
+            return
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout = 1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def ingest(
+    feeds: dict = RT_FEEDS,
+    duration_sec: float = None,
+    output_folder: str = VP_RT_FOLDER,
+    trip_key_lookup: pd.DataFrame = None,
+    interval: int = POLL_INTERVAL_SEC,
+    flush_rows: int = FLUSH_ROWS,
+    flush_interval: int = FLUSH_INTERVAL_SEC,
+) -> dict:
+    """
+    feeds: {schedule_gtfs_dataset_key: vehicle positions url}
+    Run every feed's poll loop and the flusher until duration_sec is up
+    (or forever if None). Returns counts of polls, rows, errors, flushed rows.
+    """
+    buffer = VehiclePositionBuffer()
+    stop_event = asyncio.Event()
+    stats = {"polls": 0, "rows": 0, "errors": 0, "flushed": 0}
+
+    pollers = [
+        poll_feed(key, url, buffer, stop_event, interval, stats)
+        for key, url in feeds.items()
+    ]
+    flusher = flush_periodically(
+        buffer, stop_event, output_folder, trip_key_lookup,
+        flush_rows, flush_interval, stats
+    )
+
+    async def stop_after():
+        if duration_sec is not None:
+            await asyncio.sleep(duration_sec)
+            stop_event.set()
+
+    await asyncio.gather(*pollers, flusher, stop_after())
+
+    stats["duplicates"] = buffer.n_duplicates
+
+    return stats
+
+
+def get_trip_key_lookup(folder_path: str = OUTPUT_FOLDER) -> pd.DataFrame:
+    """
+    trip_instance_key for each (operator, service_date, trip_id) in trips.
+    """
+    trip_cols = ["schedule_gtfs_dataset_key", "service_date", "trip_id"]
+
+    trips = pd.read_parquet(
+        f"{folder_path}trips.parquet",
+        columns = trip_cols + ["trip_instance_key"]
+    )
+
+    return trips.assign(
+        service_date = pd.to_datetime(trips.service_date)
+    ).drop_duplicates(trip_cols)
+
+
+class RecordedFeedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /{feed_name} returns the next recorded file in
+    {recorded_folder}/{feed_name}/ (sorted by filename),
+    cycling back to the first one at the end.
+    """
+    def __init__(
+        self, *args,
+        recorded_folder: str,
+        positions: dict,
+        positions_lock: threading.Lock,
+        **kwargs
+    ):
+        self.recorded_folder = recorded_folder
+        self.positions = positions
+        self.positions_lock = positions_lock
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        feed_name = self.path.strip("/")
+        feed_folder = os.path.join(self.recorded_folder, feed_name)
+
+        if not os.path.isdir(feed_folder):
+            self.send_error(404)
+            return
+
+        files = sorted(os.listdir(feed_folder))
+        # Requests are handled on separate threads
+        with self.positions_lock:
+            position = self.positions.get(feed_name, 0)
+            self.positions[feed_name] = (position + 1) % len(files)
+
+        with open(os.path.join(feed_folder, files[position]), "rb") as f:
+            content = f.read()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-protobuf")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        return
+
+
+def serve_recorded_feeds(
+    recorded_folder: str,
+    port: int = 0
+) -> tuple[http.server.ThreadingHTTPServer, str]:
+    """
+    Start a local stand-in for the feed URLs in a background thread.
+    Returns the server (call server.shutdown() when done)
+    and its base url, ex: http://127.0.0.1:8000/.
+    Point feeds at f"{base_url}{feed_name}".
+    """
+    handler = functools.partial(
+        RecordedFeedHandler,
+        recorded_folder = recorded_folder,
+        positions = {},
+        positions_lock = threading.Lock()
+    )
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+if __name__ == "__main__":
+
+    start = datetime.datetime.now()
+
+    stats = asyncio.run(
+        ingest(
+            RT_FEEDS,
+            trip_key_lookup = get_trip_key_lookup(OUTPUT_FOLDER)
+        )
+    )
+
+    end = datetime.datetime.now()
+    print(f"{stats}")
+    print(f"execution time: {end - start}")
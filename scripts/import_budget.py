@@ -0,0 +1,85 @@
+"""
+Measure import time of the core pipeline modules.
+
+Batch jobs fan out many short worker processes, and each one
+pays the import cost again. Each module is imported in a fresh
+interpreter with `python -X importtime`, and we check that:
+- the cumulative import time stays under its budget
+- plotting / download libraries are not pulled in
+"""
+import subprocess
+import sys
+
+# seconds, cumulative time to import the module in a fresh interpreter
+IMPORT_BUDGET_SEC = {
+    "update_vars": 0.05,
+    "schema": 0.75,
+    "utils": 1.0,
+    "dwell": 1.0,
+    "partridge_gtfs_wrangling": 1.0,
+    "neighbor": 1.5,
+    "create_table": 1.5,
+}
+
+# These should only be imported by plotting or download helpers
+LAZY_MODULES = ["folium", "branca", "gtfs_segments", "create_table"]
+
+def measure_import(module_name: str) -> tuple[float, list]:
+    """
+    Import module_name in a fresh interpreter.
+    Return the cumulative import time in seconds (from -X importtime,
+    which is written to stderr) and the list of lazy modules that got imported.
+    """
+    check_lazy = (
+        f"import sys, {module_name}; "
+        f"print(','.join(m for m in {LAZY_MODULES} "
+        f"if m in sys.modules and m != '{module_name}'))"
+    )
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check_lazy],
+        capture_output=True, text=True, check=True
+    )
+
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module_name:
+            cumulative_us = int(parts[1])
+
+    eager_imports = [m for m in result.stdout.strip().split(",") if m]
+
+    return cumulative_us / 1e6, eager_imports
+
+
+def check_import_budget(
+    budget_dict: dict = IMPORT_BUDGET_SEC
+) -> bool:
+    """
+    Print import time for each module against its budget.
+    Returns True if every module is within budget
+    and none of them import the lazy modules.
+    """
+    all_ok = True
+
+    for module_name, budget in budget_dict.items():
+        import_sec, eager_imports = measure_import(module_name)
+        is_ok = (import_sec <= budget) and (len(eager_imports) == 0)
+        all_ok = all_ok and is_ok
+
+        print(
+            f"{module_name:<28} {import_sec:6.3f}s / {budget:.2f}s "
+            f"{'ok' if is_ok else 'OVER'} "
+            f"{'eager: ' + ', '.join(eager_imports) if eager_imports else ''}"
+        )
+
+    return all_ok
+
+
+if __name__ == "__main__":
+
+    is_ok = check_import_budget(IMPORT_BUDGET_SEC)
+
+    if not is_ok:
+        sys.exit(1)
@@ -0,0 +1,114 @@
+"""
+Prepare speed layers that are small enough to map.
+
+GeoDataFrame.explore writes every column and every vertex of every
+segment into the folium HTML. For a full operator-day that's
+tens of MB of GeoJSON.
+
+Instead:
+- aggregate trip-segment speeds to 1 row per stop pair
+- simplify segment geometry for the zoom level (level of detail)
+- round coordinates and keep only the columns the map needs
+"""
+import geopandas as gpd
+import os
+import shapely
+
+import speed_rollups
+from update_vars import PROJECT_CRS, WGS84
+
+# Simplification tolerance (meters in PROJECT_CRS) for each level of detail
+LOD_TOLERANCES = {
+    "district": 50,
+    "city": 15,
+    "street": 3,
+}
+
+# ~1 meter precision in degrees is plenty for a web map
+WGS84_GRID_SIZE = 1e-5
+
+STOP_PAIR_LEVEL = {
+    "stop_pair": ["schedule_gtfs_dataset_key", "stop_id1", "stop_id2"]
+}
+
+MAP_COLS = [
+    "schedule_gtfs_dataset_key", "stop_id1", "stop_id2",
+    "n_trips", "p50_speed_mph"
+]
+
+def aggregate_by_stop_pair(
+    speed_gdf: gpd.GeoDataFrame,
+) -> gpd.GeoDataFrame:
+    """
+    Collapse trip-segment speeds into 1 row per stop pair
+    (across all trips and routes that serve it).
+    Uses the same sorted rollup as speed_rollups,
+    so we get n_trips and p20/p50/p80 speeds for each stop pair.
+    """
+    return speed_rollups.rollup_speeds(
+        speed_gdf,
+        levels = STOP_PAIR_LEVEL
+    )["stop_pair"]
+
+
+def simplify_for_lod(
+    gdf: gpd.GeoDataFrame,
+    lod: str = "district",
+    keep_cols: list = MAP_COLS,
+) -> gpd.GeoDataFrame:
+    """
+    Simplify geometry in projected CRS (so tolerance is in meters),
+    then project to WGS84 and snap coordinates to a grid,
+    which shortens every coordinate written out in the GeoJSON.
+    """
+    tolerance = LOD_TOLERANCES[lod]
+    geometry_col = gdf.geometry.name
+
+    gdf = gdf[
+        [c for c in keep_cols if c in gdf.columns] + [geometry_col]
+    ].to_crs(PROJECT_CRS)
+
+    simplified = shapely.simplify(
+        gdf.geometry.to_numpy(), tolerance, preserve_topology=False
+    )
+
+    gdf = gdf.set_geometry(
+        gpd.GeoSeries(simplified, index=gdf.index, crs=PROJECT_CRS)
+    ).to_crs(WGS84)
+
+    gdf = gdf.set_geometry(
+        gpd.GeoSeries(
+            shapely.set_precision(gdf.geometry.to_numpy(), WGS84_GRID_SIZE),
+            index=gdf.index, crs=WGS84
+        )
+    )
+
+    return gdf[~gdf.geometry.is_empty].reset_index(drop=True)
+
+
+def export_lod_layers(
+    speed_gdf: gpd.GeoDataFrame,
+    output_folder: str,
+    aggregate: bool = True,
+    lods: list = list(LOD_TOLERANCES.keys())
+) -> dict:
+    """
+    Write one GeoJSON per level of detail, ready to be
+    served as static files or loaded into a web map.
+    Returns the filepaths.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    if aggregate:
+        speed_gdf = aggregate_by_stop_pair(speed_gdf)
+
+    filepaths = {}
+
+    for lod in lods:
+        filepaths[lod] = f"{output_folder}speeds_{lod}.geojson"
+
+        simplify_for_lod(speed_gdf, lod).to_file(
+            filepaths[lod], driver="GeoJSON"
+        )
+
+    return filepaths
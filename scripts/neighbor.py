@@ -4,8 +4,10 @@ import pandas as pd
 import shapely
 
 from scipy.spatial import KDTree
-from typing import Union
 
+import group_kernels
+import schedule_adherence
+import shape_cache
 import utils
 from update_vars import OUTPUT_FOLDER
 
@@ -17,217 +19,168 @@ OPPOSITE_DIRECTIONS = {
     "Unknown": ""
 }
 
-def nearest_snap(
-    line: Union[shapely.LineString, np.ndarray], 
-    point: shapely.Point, 
-    k_neighbors: int = 1
-) -> np.ndarray:
-    """
-    Based off of this function,
-    but we want to return the index value, rather than the point.
-    https://github.com/UTEL-UIUC/gtfs_segments/blob/main/gtfs_segments/geom_utils.py
-    """
-    if isinstance(line, shapely.LineString):
-        line = np.asarray(line.coords)
-    elif isinstance(line, np.ndarray):
-        line = line
-    point = np.asarray(point.coords)
-    tree = KDTree(line)
-
-    # np_dist is array of distances of result (let's not return it)
-    # np_inds is array of indices of result
-    _, np_inds = tree.query(
-        point,
-        workers=-1,
-        k=k_neighbors,
-    )
-
-    return np_inds.squeeze()
+# Nearest vp to query for each stop. Start small, and only re-query
+# stops without a vp on both sides with the next (larger) k.
+# [5] is a single fixed-k search.
+K_NEIGHBORS = [3, 10, 30]
 
-def find_nearest_points(
-    vp_coords_array: np.ndarray, 
-    target_stop: shapely.Point, 
+def nearest_vp_before_after(
+    vp_xy: np.ndarray,
+    vp_meters: np.ndarray,
     vp_idx_array: np.ndarray,
-) -> np.ndarray:
-    """    
-    vp_coords_line is all the vehicle positions strung together as 
-    coordinates in a linestring.
-    The target point is a stop.
-
-    We want to find the k nearest points before/after a stop.
-    Start with k=5.
-    Returns an array that gives the indices that are the nearest k points 
-    (ex: nearest 5 vp to each stop).
-    """
-    indices = nearest_snap(
-        vp_coords_array, 
-        target_stop, 
-        k_neighbors = 5
-    )
-        
-    # nearest neighbor returns self.N 
-    # if there are no nearest neighbor results found
-    # if we want 10 nearest neighbors and 8th, 9th, 10th are all
-    # the same result, the 8th will have a result, then 9th and 10th will
-    # return the length of the array (which is out-of-bounds)
-    # using vp_coords_array keeps too many points (is this because coords can be dupes?)
-    indices2 = indices[indices < vp_idx_array.size]
-    
-    return indices2
-
-
-def filter_to_nearest2_vp(
-    nearest_vp_coords_array: np.ndarray,
-    shape_geometry: shapely.LineString,
-    nearest_vp_idx_array: np.ndarray,
-    stop_meters: float,
+    stop_xy: np.ndarray,
+    stop_meters: np.ndarray,
+    k_neighbors: list = K_NEIGHBORS
 ) -> tuple[np.ndarray]:
     """
-    Take the indices that are the nearest.
-    Filter the vp coords down and project those against the shape_geometry.
-    Calculate how close those nearest k vp are to a stop (as they travel along a shape).
-    
-    Filter down to the nearest 2 vp before and after a stop.
-    If there isn't one before or after, a value of -1 is returned.
+    For all the stops of a trip (with the same valid vp), 
+    query 1 KDTree with the smallest k. 
+    Of the nearest k vp, keep the closest one before and after
+    the stop (by position along the shape).
+    Stops missing either side are re-queried with the next k,
+    until k covers every vp.
+    
+    Returns before / after vp_idx (-1 if not found),
+    before / after vp meters (0 if not found),
+    and the k each stop was last queried with.
     """
-    # Project these vp coords to shape geometry and see how far it is
-    # from the stop's position on the shape
-    nearest_vp_projected = np.asarray(
-        [shape_geometry.project(shapely.Point(i)) 
-         for i in nearest_vp_coords_array]
-    )
-
-    # Negative values are before the stop
-    # Positive values are vp after the stop
-    before_indices = np.where(nearest_vp_projected - stop_meters < 0)[0]
-    after_indices = np.where(nearest_vp_projected - stop_meters > 0)[0]
-    
-    # Set missing values when we're not able to find a nearest neighbor result
-    # use -1 as vp_idx (since this is not present in vp_usable)
-    # and zeroes for meters
-    before_idx = -1
-    after_idx = -1
-    before_vp_meters = 0
-    after_vp_meters = 0
-    
-    # Grab the closest vp before a stop (-1 means array was empty)
-    if before_indices.size > 0:
-        before_idx = nearest_vp_idx_array[before_indices][-1] 
-        before_vp_meters = nearest_vp_projected[before_indices][-1]
-   
-    # Grab the closest vp after a stop (-1 means array was empty)
-    if after_indices.size > 0:
-        after_idx = nearest_vp_idx_array[after_indices][0]
-        after_vp_meters = nearest_vp_projected[after_indices][0]
-    
-    return before_idx, after_idx, before_vp_meters, after_vp_meters
-
-
-def two_nearest_neighbor_near_stop(
-    vp_direction_array: np.ndarray,
-    vp_geometry: shapely.LineString,
-    vp_idx_array: np.ndarray,
-    stop_geometry: shapely.Point,
-    opposite_stop_direction: str,
-    shape_geometry: shapely.LineString,
-    stop_meters: float
-) -> np.ndarray: 
-    """
-    Each row stores several arrays related to vp.
-    vp_direction is an array, vp_idx is an array,
-    and the linestring of vp coords can be coerced into an array.
-    
-    When we're doing nearest neighbor search, we want to 
-    first filter the full array down to valid vp
-    before snapping it.
-    """        
-    # These are the valid index values where opposite direction 
-    # is excluded       
-    valid_indices = (vp_direction_array != opposite_stop_direction).nonzero()   
-    
-    # These are vp coords where index values of opposite direction is excluded
-    valid_vp_coords_array = np.array(vp_geometry.coords)[valid_indices]
-    
-    # These are the subset of vp_idx values where opposite direction is excluded
-    valid_vp_idx_array = np.asarray(vp_idx_array)[valid_indices]  
-    
-    nearest_indices = find_nearest_points(
-        valid_vp_coords_array, 
-        stop_geometry, 
-        valid_vp_idx_array,
-    )
- 
-    before_vp, after_vp, before_meters, after_meters = filter_to_nearest2_vp(
-        valid_vp_coords_array[nearest_indices], # subset of coords in nn
-        shape_geometry,
-        valid_vp_idx_array[nearest_indices], # subset of vp_idx in nn
-        stop_meters,
-    )
+    n_stops = len(stop_xy)
+    before_idx = np.full(n_stops, -1, dtype="int64")
+    after_idx = np.full(n_stops, -1, dtype="int64")
+    before_meters = np.zeros(n_stops)
+    after_meters = np.zeros(n_stops)
+    k_used = np.zeros(n_stops, dtype="int64")
     
-    return before_vp, after_vp, before_meters, after_meters
-
-
-def grab_vp_timestamp(
-    prior_vp: int, 
-    subseq_vp: int, 
-    vp_idx_array: np.ndarray,
-    timestamp_arr: np.ndarray
-) -> tuple:
-    """
-    Find the timestamps of the 2 vp flanking a stop position.
-    If the prior or subseq vp_idx are -1, return NaT.
-    """
-    vp_idx_array = np.asarray(vp_idx_array)
-    timestamp_arr = np.asarray(timestamp_arr)
+    if len(vp_xy) == 0:
+        return before_idx, after_idx, before_meters, after_meters, k_used
     
-    index_of_prior = np.where(vp_idx_array == prior_vp)[0]
-    index_of_subseq = np.where(vp_idx_array == subseq_vp)[0]
+    tree = KDTree(vp_xy)
+    unresolved = np.arange(n_stops)
     
-    if index_of_prior.size > 0:
-        start_timestamp = timestamp_arr[index_of_prior][0]
-    else: 
-        start_timestamp = np.nan
-    
-    if index_of_subseq.size > 0:
-        end_timestamp = timestamp_arr[index_of_subseq][0]
-    else:
-        end_timestamp = np.nan
+    for k in k_neighbors:
+        k = min(k, len(vp_xy))
+        
+        _, nearest = tree.query(stop_xy[unresolved], k=k)
+        nearest = nearest.reshape(len(unresolved), k)
+        
+        # Negative values are vp before the stop, positive are after
+        distance = vp_meters[nearest] - stop_meters[unresolved, np.newaxis]
+        
+        before_pos = np.where(distance < 0, distance, -np.inf).argmax(axis=1)
+        after_pos = np.where(distance > 0, distance, np.inf).argmin(axis=1)
+        
+        rows = np.arange(len(unresolved))
+        has_before = distance[rows, before_pos] < 0
+        has_after = distance[rows, after_pos] > 0
+        
+        before_vp = nearest[rows, before_pos]
+        after_vp = nearest[rows, after_pos]
+        
+        before_idx[unresolved] = np.where(has_before, vp_idx_array[before_vp], -1)
+        after_idx[unresolved] = np.where(has_after, vp_idx_array[after_vp], -1)
+        before_meters[unresolved] = np.where(has_before, vp_meters[before_vp], 0)
+        after_meters[unresolved] = np.where(has_after, vp_meters[after_vp], 0)
+        k_used[unresolved] = k
+        
+        unresolved = unresolved[~(has_before & has_after)]
+        
+        if len(unresolved) == 0 or k == len(vp_xy):
+            break
     
-    return start_timestamp, end_timestamp
+    return before_idx, after_idx, before_meters, after_meters, k_used
 
 
-def interpolate_stop_arrival_time(
-    stop_position: float, 
-    shape_meters_arr: np.ndarray,
-    timestamp_arr: np.ndarray
-) -> float:
+def adaptive_nearest_neighbor(
+    gdf: gpd.GeoDataFrame,
+    k_neighbors: list = K_NEIGHBORS
+) -> pd.DataFrame:
     """
-    Interpolate the arrival time given the stop meters position.
-    Cast datetimes into floats and cast back as datetime.
+    Find the vp before and after every stop, 1 trip at a time.
+    The trip's vp are projected against its shape once
+    (with the shape's cached arrays, see shape_cache), 
+    and 1 KDTree is built per trip and opposite direction,
+    instead of per stop.
+    
+    Returns prior_vp_idx, subseq_vp_idx, prior_vp_meters, 
+    subseq_vp_meters, neighbor_k (the k a stop was last queried with),
+    and start_sec / end_sec (seconds since the service day started 
+    of the prior and subseq vp, NaN if not found), aligned with gdf's rows.
+    If vp dwells were collapsed, start_sec is when the bus 
+    started moving again from the prior vp.
     """
-    timestamp_arr = np.asarray(timestamp_arr).astype("datetime64[s]").astype("float64")
-
-    return np.interp(
-        stop_position, np.asarray(shape_meters_arr), timestamp_arr
-    ).astype("datetime64[s]")
+    n_rows = len(gdf)
+    results = {
+        "prior_vp_idx": np.full(n_rows, -1, dtype="int64"),
+        "subseq_vp_idx": np.full(n_rows, -1, dtype="int64"),
+        "prior_vp_meters": np.zeros(n_rows),
+        "subseq_vp_meters": np.zeros(n_rows),
+        "neighbor_k": np.zeros(n_rows, dtype="int64"),
+        "start_sec": np.full(n_rows, np.nan),
+        "end_sec": np.full(n_rows, np.nan),
+    }
+    
+    prior_sec_col = "moving_sec" if "moving_sec" in gdf.columns else "location_sec"
+    
+    stop_xy = shapely.get_coordinates(gdf.stop_geometry.to_numpy())
+    stop_meters = gdf.stop_meters.to_numpy().astype("float64")
+    opposite_direction = gdf.stop_opposite_direction.to_numpy()
+    
+    for rows in gdf.groupby("trip_instance_key", observed=True).indices.values():
+        # vp and shape columns are the same for every stop in a trip
+        first = gdf.iloc[rows[0]]
+        
+        vp_xy = shapely.get_coordinates(first.vp_geometry)
+        vp_meters = shape_cache.project_line(first.shape_geometry, vp_xy)
+        vp_direction = np.asarray(first.vp_primary_direction)
+        vp_idx_array = np.asarray(first.vp_idx)
+        
+        for direction in np.unique(opposite_direction[rows]):
+            stop_rows = rows[opposite_direction[rows] == direction]
+            valid = vp_direction != direction
+            
+            found = nearest_vp_before_after(
+                vp_xy[valid],
+                vp_meters[valid],
+                vp_idx_array[valid],
+                stop_xy[stop_rows],
+                stop_meters[stop_rows],
+                k_neighbors
+            )
+            
+            for col, values in zip(results, found):
+                results[col][stop_rows] = values
+        
+        # Look up the prior / subseq vp's seconds by vp_idx (-1 is not found)
+        vp_position = pd.Index(vp_idx_array)
+        prior_pos = vp_position.get_indexer(results["prior_vp_idx"][rows])
+        subseq_pos = vp_position.get_indexer(results["subseq_vp_idx"][rows])
+        
+        prior_sec = np.asarray(first[prior_sec_col], dtype="float64")
+        location_sec = np.asarray(first.location_sec, dtype="float64")
+        
+        results["start_sec"][rows] = np.where(prior_pos >= 0, prior_sec[prior_pos], np.nan)
+        results["end_sec"][rows] = np.where(subseq_pos >= 0, location_sec[subseq_pos], np.nan)
     
+    return pd.DataFrame(results, index=gdf.index)
 
-def convert_timestamp_to_seconds(
-    df: pd.DataFrame, 
-    timestamp_cols: list,
-) -> pd.DataFrame: 
+
+def neighbor_escalation_stats(gdf: pd.DataFrame) -> pd.DataFrame:
     """
-    Convert timestamp into seconds.
+    How many stops were resolved at each k of the adaptive search,
+    and how many still miss a vp before or after the stop.
     """
-    for c in timestamp_cols:
-        df = df.assign(
-            time_sec = ((df[c].dt.hour * 3_600) + 
-                            (df[c].dt.minute * 60) + 
-                            (df[c].dt.second)
-                       ),
-        ).rename(columns = {"time_sec": f"{c}_sec"})
+    resolved = (gdf.prior_vp_idx != -1) & (gdf.subseq_vp_idx != -1)
     
-    return df
+    stats = (gdf.assign(resolved = resolved)
+             .groupby(["neighbor_k", "resolved"])
+             .size()
+             .reset_index(name="n_stops")
+            )
+    
+    return stats.assign(
+        pct_stops = (stats.n_stops / len(gdf) * 100).round(2)
+    )
+
 
 def rolling_window_make_array(
     df: pd.DataFrame, 
@@ -245,7 +198,7 @@ def rolling_window_make_array(
     """
     df[f"rolling_{rolling_col}"] = [
         np.asarray(window) for window in 
-        df.groupby("trip_instance_key")[rolling_col].rolling(
+        df.groupby("trip_instance_key", observed=True)[rolling_col].rolling(
             window = window, center=True)
     ]
     
@@ -260,39 +213,52 @@ def stop_and_arrival_time_arrays_by_trip(
 ) -> pd.DataFrame:
     """
     For stops that violated the monotonically increasing condition,
-    set those arrival_times to NaT again.
+    arrival_time_sec was set to NaN again.
     Now, look across stops and interpolate again, using stop_meters.
+    
+    All trips are interpolated with 1 np.interp: each trip's stop_meters 
+    are offset so trips don't overlap, and clipped to the range of the 
+    trip's correct arrivals (np.interp holds the end values, like within 1 trip).
+    Trips without any correct arrivals stay NaN.
     """
-    # Add columns with the trip's stop_meters and arrival_times
-    # for only correctly interpolated values
-    df_arrays = (df[df.arrival_time.notna()].sort_values(trip_stop_cols)
-           .groupby("trip_instance_key", group_keys=False)
-           .agg({
-               "stop_meters": lambda x: list(x),
-               "arrival_time": lambda x: list(x)
-           }).rename(columns = {
-               "stop_meters": "stop_meters_arr", 
-               "arrival_time": "arrival_time_arr"
-           }).reset_index()
+    trip_code = df.groupby(
+        trip_stop_cols[:-1], observed=True, sort=False
+    ).ngroup().to_numpy()
+    
+    stop_meters = df.stop_meters.to_numpy().astype("float64")
+    arrival_sec = df.arrival_time_sec.to_numpy().astype("float64")
+    
+    is_valid = ~np.isnan(arrival_sec) & ~np.isnan(stop_meters)
+    
+    if not is_valid.any():
+        return df
+    
+    offset = np.nanmax(np.abs(stop_meters)) * 2 + 1
+    n_trips = trip_code.max() + 1
+    
+    min_meters = np.full(n_trips, np.inf)
+    max_meters = np.full(n_trips, -np.inf)
+    np.minimum.at(min_meters, trip_code[is_valid], stop_meters[is_valid])
+    np.maximum.at(max_meters, trip_code[is_valid], stop_meters[is_valid])
+    
+    order = np.lexsort([stop_meters[is_valid], trip_code[is_valid]])
+    known_x = (trip_code * offset + stop_meters)[is_valid][order]
+    known_sec = arrival_sec[is_valid][order]
+    
+    fill = (
+        np.isnan(arrival_sec) & ~np.isnan(stop_meters) & 
+        np.isfinite(min_meters[trip_code])
     )
     
-    df2 = pd.merge(
-        df,
-        df_arrays,
-        on = "trip_instance_key",
-        how = "inner"
+    fill_x = trip_code[fill] * offset + np.clip(
+        stop_meters[fill], 
+        min_meters[trip_code[fill]], 
+        max_meters[trip_code[fill]]
     )
-
-    # Use correct values to fill in the missing arrival times
-    df2 = df2.assign(
-        arrival_time = df2.apply(
-            lambda x: interpolate_stop_arrival_time(
-                x.stop_meters, x.stop_meters_arr, x.arrival_time_arr
-            ), axis=1
-        )
-    ).drop(columns = ["stop_meters_arr", "arrival_time_arr"])
-
-    return df2
+    
+    arrival_sec[fill] = np.interp(fill_x, known_x, known_sec)
+    
+    return df.assign(arrival_time_sec = arrival_sec)
 
 
 def enforce_monotonicity_and_interpolate_across_stops(
@@ -305,9 +271,8 @@ def enforce_monotonicity_and_interpolate_across_stops(
     position is not increasing, we will interpolate again using 
     surrounding observations.
     """
-    df = convert_timestamp_to_seconds(
-        df, ["arrival_time"])
-
+    df = df.sort_values(trip_stop_cols).reset_index(drop=True)
+    
     df = rolling_window_make_array(
         df, 
         window = 3, rolling_col = "arrival_time_sec"
@@ -315,16 +280,16 @@ def enforce_monotonicity_and_interpolate_across_stops(
     
     # Subset to trips that have at least 1 obs that violates monotonicity
     trips_with_one_false = (
-        df.groupby("trip_instance_key")
+        df.groupby("trip_instance_key", observed=True)
         .agg({"arrival_time_sec_monotonic": "min"})
         .reset_index()
         .query('arrival_time_sec_monotonic==0')
         .trip_instance_key
     )
     
-    # Set arrival times to NaT if it's not monotonically increasing
+    # Set arrival times to NaN if it's not monotonically increasing
     mask = df.arrival_time_sec_monotonic == False 
-    df.loc[mask, 'arrival_time'] = np.nan
+    df.loc[mask, 'arrival_time_sec'] = np.nan
     
     
     no_fix = df[~df.trip_instance_key.isin(trips_with_one_false)]
@@ -332,7 +297,6 @@ def enforce_monotonicity_and_interpolate_across_stops(
     fix1 = stop_and_arrival_time_arrays_by_trip(fix1, trip_stop_cols)
     
     drop_me = [
-        "arrival_time_sec",
         "rolling_arrival_time_sec", "arrival_time_sec_monotonic"
     ]
     
@@ -343,6 +307,11 @@ def enforce_monotonicity_and_interpolate_across_stops(
     ).sort_values(
         trip_stop_cols
     ).reset_index(drop=True)
+    
+    fixed_df = fixed_df.assign(
+        arrival_time = utils.seconds_to_timestamp(
+            fixed_df.service_date, fixed_df.arrival_time_sec)
+    )
         
     return fixed_df
 
@@ -354,24 +323,32 @@ def calculate_speed_from_stop_arrivals(
 ) -> pd.DataFrame:
     """
     Take arrival times between stops and 
-    derive speed for that segment (1 segment = between 2 stops)
+    derive speed for that segment (1 segment = between 2 stops).
+    
+    arrival_time_sec counts from the start of the service day,
+    so a segment that crosses midnight still has a positive sec_elapsed.
+    
+    If the scheduled arrival_sec is present, schedule adherence
+    (delay, on-time, delay added between stops) is calculated
+    in the same pass, reusing the trip sort.
     """
-    df = convert_timestamp_to_seconds(
-        df, ["arrival_time"]
-    ).sort_values(trip_stop_cols).reset_index(drop=True)
+    df = df.sort_values(trip_stop_cols).reset_index(drop=True)
+    
+    sorted_groups = group_kernels.sort_groups(df, trip_cols)
     
     df = df.assign(
-        subseq_arrival_time_sec = (df.groupby(trip_cols, 
-                                             observed=True, group_keys=False)
-                                  .arrival_time_sec
-                                  .shift(-1)
-                                 ),
-        subseq_stop_meters = (df.groupby(trip_cols, 
-                                        observed=True, group_keys=False)
-                             .stop_meters
-                             .shift(-1)
-                            )
+        **group_kernels.grouped_shift(
+            df,
+            {
+                "subseq_arrival_time_sec": ("arrival_time_sec", -1),
+                "subseq_stop_meters": ("stop_meters", -1),
+            },
+            sorted_groups = sorted_groups
+        )
     )
+    
+    if "arrival_sec" in df.columns:
+        df = schedule_adherence.add_stop_delay(df, sorted_groups)
 
     speed = df.assign(
         meters_elapsed = df.subseq_stop_meters - df.stop_meters, 
@@ -386,69 +363,47 @@ def calculate_speed_from_stop_arrivals(
     
     
 def nearest_neighbor_and_interpolate(
-    gdf: gpd.GeoDataFrame
+    gdf: gpd.GeoDataFrame,
+    k_neighbors: list = K_NEIGHBORS
 ) -> gpd.GeoDataFrame:
     """
     Combine nearest neighbor with interpolation to get 
     interpolated arrival times for stop.
     
+    Nearest neighbor search starts at k_neighbors[0] and only
+    escalates for stops without a vp on both sides 
+    (see neighbor_escalation_stats).
+    
+    Arrivals are interpolated in seconds since the service day started
+    (arrival_time_sec), so trips past midnight keep increasing.
+    arrival_time is the same as a timestamp.
+    
     This is part 1 of method2.
     We break out these in stages in our pipeline, but let's optimize this as a whole.
     """
-    vp_before, vp_after, vp_before_meters, vp_after_meters = np.vectorize(
-        two_nearest_neighbor_near_stop
-    )(
-        gdf.vp_primary_direction, 
-        gdf.vp_geometry, 
-        gdf.vp_idx,
-        gdf.stop_geometry,
-        gdf.stop_opposite_direction,
-        gdf.shape_geometry,
-        gdf.stop_meters
-    )
-    
     gdf = gdf.assign(
-        prior_vp_idx = vp_before,
-        subseq_vp_idx = vp_after,
-        prior_vp_meters = vp_before_meters, 
-        subseq_vp_meters = vp_after_meters
+        **adaptive_nearest_neighbor(gdf, k_neighbors)
     )
     
-    start_time_series = []
-    end_time_series = []
-
-    for row in gdf.itertuples():
-        start_time, end_time = grab_vp_timestamp(
-            getattr(row, "prior_vp_idx"),
-            getattr(row, "subseq_vp_idx"),
-            getattr(row, "vp_idx"),
-            getattr(row, "location_timestamp_local"),
-        )
-
-        start_time_series.append(start_time)
-        end_time_series.append(end_time)
+    # Interpolate between the vp before and after the stop
+    # (the stop is strictly between their positions along the shape)
+    has_both = (gdf.prior_vp_idx != -1) & (gdf.subseq_vp_idx != -1)
+    
+    arrival_sec = np.where(
+        has_both,
+        gdf.start_sec + (
+            (gdf.stop_meters - gdf.prior_vp_meters) 
+            / (gdf.subseq_vp_meters - gdf.prior_vp_meters).where(has_both) 
+            * (gdf.end_sec - gdf.start_sec)
+        ),
+        np.nan
+    )
     
     gdf = gdf.assign(
-        start_local_timestamp = start_time_series,
-        end_local_timestamp = end_time_series
+        arrival_time_sec = arrival_sec,
+        arrival_time = utils.seconds_to_timestamp(gdf.service_date, arrival_sec)
     )
     
-    interpolated_arrival_series = []
-
-    for row in gdf.itertuples():
-        if (getattr(row, "prior_vp_idx") == -1) or (getattr(row, "subseq_vp_idx") == -1):
-            arrival_time = np.nan
-        else:
-            arrival_time = interpolate_stop_arrival_time(
-                getattr(row, "stop_meters"),
-                [getattr(row, "prior_vp_meters"), getattr(row, "subseq_vp_meters")],
-                [getattr(row, "start_local_timestamp"), getattr(row, "end_local_timestamp")]
-            )
-
-        interpolated_arrival_series.append(arrival_time)
-        
-    gdf["arrival_time"] = interpolated_arrival_series
-    
     return gdf
     
     
@@ -470,7 +425,10 @@ def enforce_monotonicity_calculate_speeds(
         'shape_geometry',
         'prior_vp_idx', 'subseq_vp_idx', 
         'prior_vp_meters', 'subseq_vp_meters', 
-        'start_local_timestamp', 'end_local_timestamp'
+        'start_sec', 'end_sec', 'location_sec',
+    ] + [
+        c for c in ["moving_timestamp_local", "moving_sec"] 
+        if c in gdf.columns
     ]
     
     trip_stop_cols = ["trip_instance_key", "stop_sequence"]
@@ -490,7 +448,7 @@ def enforce_monotonicity_calculate_speeds(
     )
     
     speed_gdf = pd.merge(
-        segments.rename(columns = {"geometry": "segment_geometry"}),
+        segments.rename_geometry("segment_geometry"),
         speeds,
         on = ["trip_instance_key", "stop_id1", "stop_id2"]
     )
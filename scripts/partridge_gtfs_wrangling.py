@@ -4,64 +4,234 @@ for operators.
 
 Set up functions to do preprocessing for stop_times grain table.
 """
-import datetime
 import geopandas as gpd
-import gtfs_segments
 import numpy as np
 import pandas as pd
 
+from typing import Union
+
+import dwell
+import geo_io
+import geo_threads
+import group_kernels
+import schema
+import shape_cache
+import trip_patterns
 import utils
-from update_vars import PARTRIDGE_FOLDER, PROJECT_CRS 
+from update_vars import PARTRIDGE_FOLDER, PROJECT_CRS, analysis_date
 
-def get_stop_times_with_stop_geometry(
-    operator_name: str
-) -> gpd.GeoDataFrame:
+# stop_times_direction is stored as 1 row per pattern stop and 1 row per trip
+# (see trip_patterns), the rest comes from stop_times
+STOP_TIMES_DIRECTION_FILES = {
+    "pattern_stops": "stop_times_direction_patterns.parquet",
+    "trips": "stop_times_direction_trips.parquet",
+}
+
+PATTERN_STOP_COLS = [
+    "stop_id1", "stop_name", "geometry", 
+    "stop_primary_direction", "stop_meters", "stop_id2", "subseq_stop_meters"
+]
+
+TRIP_PATTERN_COLS = [
+    "schedule_gtfs_dataset_key", "service_date", "trip_id", "trip_instance_key",
+    "shape_id", "shape_array_key"
+]
+
+def operator_key(operator_name: str) -> str:
     """
-    For feed downloaded from partridge, 
-    combine stop_times, stops, shapes, trips
-    and get preprocessed table.
+    Use the schedule_gtfs_dataset_key for operators we know,
+    otherwise the readable name.
+    """
+    name_to_key = {v: k for k, v in utils.OPERATOR_NAMES_DICT.items()}
+    
+    return name_to_key.get(operator_name, operator_name)
+
+
+def read_partridge_tables(
+    operator_name: str,
+    service_date: str = analysis_date,
+    trip_ids: list = None
+) -> tuple:
     """
+    For feed downloaded from partridge, read stop_times, stops, 
+    trips, shapes, and add the operator (and service_date),
+    and the int64 trip_instance_key / shape_array_key.
+    If trip_ids is given, only read stop_times and trips for those trips.
+    """
+    trip_filters = None if trip_ids is None else [("trip_id", "in", list(trip_ids))]
+    
+    operator_cols = {
+        "schedule_gtfs_dataset_key": operator_key(operator_name),
+        "service_date": pd.Timestamp(service_date),
+    }
+    
     stop_times = pd.read_parquet(
         f"{PARTRIDGE_FOLDER}{operator_name}/stop_times.parquet",
         columns = [
             "trip_id",
             "stop_id", "stop_sequence",
             "arrival_time"
-        ]
-    ).rename(columns = {"arrival_time": "arrival_sec"})
+        ],
+        filters = trip_filters
+    ).rename(
+        columns = {"arrival_time": "arrival_sec"}
+    ).assign(**operator_cols).pipe(schema.add_hash_keys)
     
     stops = gpd.read_parquet(
         f"{PARTRIDGE_FOLDER}{operator_name}/stops.parquet",
         columns = ["stop_id", "stop_name", "geometry"]
-    ).to_crs(PROJECT_CRS)
+    ).to_crs(PROJECT_CRS).assign(
+        schedule_gtfs_dataset_key = operator_cols["schedule_gtfs_dataset_key"]
+    )
     
     trips = pd.read_parquet(
         f"{PARTRIDGE_FOLDER}{operator_name}/trips.parquet",
         columns = [
             "trip_id", "shape_id",
-        ]
-    )
+        ],
+        filters = trip_filters
+    ).assign(**operator_cols).pipe(schema.add_hash_keys)
     
     shapes = gpd.read_parquet(
         f"{PARTRIDGE_FOLDER}{operator_name}/shapes.parquet",
         columns = ["shape_id", "geometry"]
-    ).to_crs(PROJECT_CRS)
+    ).to_crs(PROJECT_CRS).assign(
+        schedule_gtfs_dataset_key = operator_cols["schedule_gtfs_dataset_key"]
+    ).pipe(schema.add_hash_keys)
+    
+    return stop_times, stops, trips, shapes
+
+
+def get_stop_times_with_stop_geometry(
+    operator_names: Union[str, list],
+    service_date: str = analysis_date,
+    trip_ids: list = None
+) -> gpd.GeoDataFrame:
+    """
+    For feeds downloaded from partridge, 
+    combine stop_times, stops, shapes, trips
+    and get preprocessed table.
+    
+    Trips and shapes are keyed by trip_instance_key / shape_array_key,
+    so several operators are concatenated and processed in one batch.
+    trip_ids limits this to some trips (ex: trips that changed in a new feed).
+    """
+    if isinstance(operator_names, str):
+        operator_names = [operator_names]
+    
+    tables = [
+        read_partridge_tables(o, service_date, trip_ids) for o in operator_names
+    ]
+    
+    stop_times, stops, trips, shapes = [
+        pd.concat(dfs, axis=0, ignore_index=True) for dfs in zip(*tables)
+    ]
+    
+    schema.check_hash_keys(trips)
+    
+    # stop_times has every trip in the feed, trips only the service_date's,
+    # and shapes has every shape, used or not
+    stop_times = stop_times[
+        stop_times.trip_instance_key.isin(trips.trip_instance_key)
+    ].reset_index(drop=True)
+    
+    shapes = shapes[
+        shapes.shape_array_key.isin(trips.shape_array_key)
+    ].reset_index(drop=True)
+    
+    # Encode trip_id, shape_id, stop_id against one shared dictionary
+    # so the merges below are on integer codes
+    key_dictionary = schema.build_key_dictionary([trips, stops])
+    
+    stop_times, stops, trips, shapes = [
+        schema.encode_keys(df, key_dictionary).pipe(schema.downcast_dtypes)
+        for df in [stop_times, stops, trips, shapes]
+    ]
     
     gdf = merge_stop_times_trips_shapes_stops(
         stop_times,
         stops,
-        trips,
-        shapes,
-        stop_group = ["stop_id"],
-        trip_group = ["trip_id"],
-        shape_group = ["shape_id"]
+        trips[["trip_instance_key", "shape_id", "shape_array_key"]],
+        shapes[["shape_array_key", "geometry"]],
+        stop_group = ["schedule_gtfs_dataset_key", "stop_id"],
+        trip_group = ["trip_instance_key"],
+        shape_group = ["shape_array_key"]
     )
     
-    gdf2 = stop_times_preprocessing(gdf, trip_group = ["trip_id"])
+    gdf2 = stop_times_preprocessing(
+        gdf, 
+        trip_group = ["trip_instance_key"],
+        by_pattern = True,
+        shape_group = ["shape_array_key"]
+    )
     
     return gdf2
 
 
+def write_stop_times_direction(
+    gdf: gpd.GeoDataFrame,
+    operator_name: str
+):
+    """
+    Save the output of get_stop_times_with_stop_geometry
+    as pattern stops + trips (see STOP_TIMES_DIRECTION_FILES).
+    Per stop_time columns (stop_sequence, arrival_sec) are already in stop_times.
+    """
+    pattern_stops, trips = trip_patterns.split_pattern_stops(
+        gdf,
+        trip_cols = TRIP_PATTERN_COLS,
+        pattern_cols = PATTERN_STOP_COLS,
+        trip_group = ["trip_instance_key"]
+    )
+
+    folder = f"{PARTRIDGE_FOLDER}{operator_name}/"
+
+    geo_io.write_geoparquet(
+        pattern_stops, f"{folder}{STOP_TIMES_DIRECTION_FILES['pattern_stops']}")
+    geo_io.write_geoparquet(
+        trips, f"{folder}{STOP_TIMES_DIRECTION_FILES['trips']}")
+
+    return
+
+
+def read_stop_times_direction(
+    operator_name: str
+) -> gpd.GeoDataFrame:
+    """
+    Put the saved pattern stops and trips back together with stop_times,
+    into the same table get_stop_times_with_stop_geometry returns.
+    """
+    folder = f"{PARTRIDGE_FOLDER}{operator_name}/"
+
+    pattern_stops = gpd.read_parquet(
+        f"{folder}{STOP_TIMES_DIRECTION_FILES['pattern_stops']}")
+    trips = pd.read_parquet(f"{folder}{STOP_TIMES_DIRECTION_FILES['trips']}")
+
+    stop_times = pd.read_parquet(
+        f"{folder}stop_times.parquet",
+        columns = ["trip_id", "stop_sequence", "arrival_time"],
+        filters = [("trip_id", "in", trips.trip_id.astype(str).tolist())]
+    ).rename(columns = {"arrival_time": "arrival_sec"})
+
+    gdf = trip_patterns.join_pattern_stops(
+        stop_times,
+        trips.astype({"trip_id": str}),
+        pattern_stops,
+        trip_group = ["trip_id"]
+    ).pipe(schema.downcast_dtypes)
+
+    gdf = gdf.assign(
+        subseq_stop_sequence = group_kernels.grouped_shift(
+            gdf,
+            {"subseq_stop_sequence": ("stop_sequence", -1)},
+            group_cols = ["trip_id"],
+            order_cols = ["stop_sequence"]
+        )["subseq_stop_sequence"].astype("Int32")
+    )
+
+    return gdf
+
+
 def merge_stop_times_trips_shapes_stops(
     stop_times_df: pd.DataFrame,
     stops_gdf: gpd.GeoDataFrame,
@@ -105,7 +275,9 @@ def merge_stop_times_trips_shapes_stops(
 
 def stop_times_preprocessing(
     gdf: gpd.GeoDataFrame,
-    trip_group: list = ["trip_id"]
+    trip_group: list = ["trip_id"],
+    by_pattern: bool = False,
+    shape_group: list = ["shape_id"]
 ) -> gpd.GeoDataFrame:
     """
     All the stuff we want to do to stop_times + shapes + stops + trips.
@@ -114,59 +286,115 @@ def stop_times_preprocessing(
     - stop_primary_direction: direction from prior stop
     - stop_meters: the stop's point geometry projected against the shape geometry 
     (meters progressed along shape)
-    - stop_seq_pair: a segment can be defined as a pair of stop_sequences
-    - stop_id_pair: a segment can be defined as a pair of stop_ids
+    - stop_sequence/subseq_stop_sequence: a segment can be defined as a pair of stop_sequences
+    - stop_id1/stop_id2: a segment can be defined as a pair of stop_ids
+    
+    The pairs are kept as 2 columns (integer codes if keys are categorical),
+    rather than concatenated strings. stop_sequence pair is more intuitive 
+    to check what's happening, but stop_id pair will help us aggregate 
+    speeds across many trips. Use schema.add_stop_pair_labels to get
+    stop_seq_pair and stop_id_pair strings for display.
     
-    stop_seq_pair is more intuitive to check what's happening,
-    but stop_id_pair will help us aggregate speeds across many trips
+    If by_pattern is True, the stop-level geometry attributes are computed once
+    per trip pattern (shape_group + ordered stop_ids) and broadcast to trips
+    (see trip_patterns). pattern_key and stop_rank are kept as columns.
     """
-    prior_geometry = (gdf
-                  .groupby(trip_group, group_keys=False)
-                  .geometry
-                  .shift(1)
-                )    
+    if by_pattern:
+        return stop_times_preprocessing_by_pattern(gdf, trip_group, shape_group)
+    
+    # Sort by trip once, and reuse it for every shifted column
+    sorted_groups = group_kernels.sort_groups(gdf, trip_group)
+    
+    prior_geometry = group_kernels.grouped_shift(
+        gdf, 
+        {"prior_geometry": ("geometry", 1)}, 
+        sorted_groups = sorted_groups
+    )["prior_geometry"]
     
     gdf = gdf.assign(
         stop_primary_direction = np.vectorize(utils.cardinal_definition_rules)(
-            gdf.geometry.x - prior_geometry.x, 
-            gdf.geometry.y - prior_geometry.y),
-        stop_meters = gdf.shape_geometry.project(gdf.geometry)
+            geo_threads.get_x(gdf.geometry) - geo_threads.get_x(prior_geometry), 
+            geo_threads.get_y(gdf.geometry) - geo_threads.get_y(prior_geometry)),
+        stop_meters = shape_cache.project(
+            gdf.shape_geometry, gdf.geometry, gdf[shape_group])
+    )
+    
+    subseq_cols = group_kernels.grouped_shift(
+        gdf,
+        {
+            "subseq_stop_sequence": ("stop_sequence", -1),
+            "stop_id2": ("stop_id", -1),
+            "subseq_stop_meters": ("stop_meters", -1),
+        },
+        sorted_groups = sorted_groups
     )
     
     gdf = gdf.assign(
-        subseq_stop_sequence = (gdf
-                           .groupby(trip_group, group_keys=False)
-                           .stop_sequence
-                           .shift(-1)
-                          ).astype("Int64"),
-        stop_id2 = (gdf
-                    .groupby(trip_group, group_keys=False)
-                    .stop_id
-                    .shift(-1)
-                    ),
-        subseq_stop_meters = (gdf
-                   .groupby(trip_group, group_keys=False)
-                   .stop_meters
-                   .shift(-1)
-                  ),
-    ).rename(columns = {"stop_id": "stop_id1"})
-
-    gdf = gdf.assign(
-        stop_seq_pair = gdf.stop_sequence.astype(str).str.cat(
-            gdf.subseq_stop_sequence.astype(str), 
-            sep="__"
-        ),
-        stop_id_pair = gdf.stop_id1.str.cat(gdf.stop_id2, sep="__")
-    ).drop(
-        columns = ["subseq_stop_sequence", "shape_geometry"]
+        subseq_stop_sequence = subseq_cols["subseq_stop_sequence"].astype("Int32"),
+        stop_id2 = subseq_cols["stop_id2"],
+        subseq_stop_meters = subseq_cols["subseq_stop_meters"],
+    ).rename(columns = {"stop_id": "stop_id1"}).drop(
+        columns = ["shape_geometry"]
     )
     
     return gdf
 
 
+def stop_times_preprocessing_by_pattern(
+    gdf: gpd.GeoDataFrame,
+    trip_group: list = ["trip_id"],
+    shape_group: list = ["shape_id"]
+) -> gpd.GeoDataFrame:
+    """
+    Run stop_times_preprocessing on 1 trip per pattern,
+    and broadcast the results to every trip in that pattern.
+    subseq_stop_sequence is the only column that isn't the same 
+    across a pattern's trips, so it's shifted within each trip.
+    """
+    orig_cols = [c for c in gdf.columns if c != "shape_geometry"]
+    
+    gdf = trip_patterns.add_pattern_key(
+        gdf, 
+        trip_group = trip_group,
+        shape_group = shape_group,
+        stop_col = "stop_id"
+    )
+    
+    pattern_stops = stop_times_preprocessing(
+        trip_patterns.representative_trips(gdf, trip_group),
+        trip_group = ["pattern_key"],
+        shape_group = shape_group
+    )
+    
+    gdf = trip_patterns.broadcast_pattern_stops(
+        gdf, 
+        pattern_stops
+    ).drop(columns = "shape_geometry")
+    
+    gdf = gdf.assign(
+        subseq_stop_sequence = group_kernels.grouped_shift(
+            gdf,
+            {"subseq_stop_sequence": ("stop_sequence", -1)},
+            group_cols = trip_group,
+            order_cols = ["stop_sequence"]
+        )["subseq_stop_sequence"].astype("Int32")
+    ).rename(columns = {"stop_id": "stop_id1"})
+    
+    col_order = [
+        "stop_id1" if c == "stop_id" else c for c in orig_cols
+    ] + [
+        "stop_primary_direction", "stop_meters", "subseq_stop_sequence", 
+        "stop_id2", "subseq_stop_meters", "pattern_key", "stop_rank"
+    ]
+    
+    return gdf[col_order]
+    
+    
 def vp_preprocessing(
     gdf: gpd.GeoDataFrame,
-    trip_group: list = ["trip_id"]
+    trip_group: list = ["trip_id"],
+    collapse_dwells: bool = False,
+    shape_group: list = ["shape_id"]
 ) -> gpd.GeoDataFrame:
     """
     All the stuff we want to do to vehicle_positions.
@@ -174,26 +402,61 @@ def vp_preprocessing(
     For vp, we want to add columns to understand:
     - vp_primary_direction: direction from prior stop
     - vp_meters: the vp's point geometry projected against the shape geometry 
-    (meters progressed along shape)
-    We should also get vp dwell positions, 
-    and have location_timestamp_local and moving_timestamp_local.
+    (meters progressed along shape). shape_group identifies which
+    rows share a shape, so each shape is projected against once.
+    
+    If collapse_dwells is True, runs of vp that don't move along the shape
+    are collapsed into dwell positions, 
+    with location_timestamp_local and moving_timestamp_local.
+    
+    Timestamps are also kept as location_sec (and moving_sec): seconds
+    since the service day started, which is what arrival times are 
+    interpolated and compared with. Without service_date, the service day
+    is the date of the trip's first vp.
     """  
-    prior_geometry = (gdf
-                  .groupby(trip_group, group_keys=False)
-                  .geometry
-                  .shift(1)
-                )    
+    prior_geometry = group_kernels.grouped_shift(
+        gdf, 
+        {"prior_geometry": ("geometry", 1)}, 
+        group_cols = trip_group
+    )["prior_geometry"]
     
     gdf = gdf.assign(
         vp_primary_direction = np.vectorize(utils.cardinal_definition_rules)(
-            gdf.geometry.x - prior_geometry.x, 
-            gdf.geometry.y - prior_geometry.y),
-        vp_meters = gdf.shape_geometry.project(gdf.geometry),
+            geo_threads.get_x(gdf.geometry) - geo_threads.get_x(prior_geometry), 
+            geo_threads.get_y(gdf.geometry) - geo_threads.get_y(prior_geometry)),
+        vp_meters = shape_cache.project(
+            gdf.shape_geometry, gdf.geometry, gdf[shape_group]),
         vp_idx = gdf.index, # it's ordered within a trip, but vp_idx spans entirety of vp
     )
     
     if "feed_key" in gdf.columns:
         gdf = gdf.drop(columns = "feed_key") 
     
+    if collapse_dwells:
+        gdf = dwell.collapse_dwells(
+            gdf, 
+            trip_group = trip_group,
+            meters_col = "vp_meters",
+            timestamp_col = "location_timestamp_local"
+        )
+    
+    if "service_date" in gdf.columns:
+        service_date = gdf.service_date
+    else:
+        service_date = gdf.groupby(
+            trip_group, observed=True
+        ).location_timestamp_local.transform("min").dt.normalize()
+    
+    gdf = gdf.assign(
+        location_sec = utils.seconds_since_service_day(
+            gdf.location_timestamp_local, service_date)
+    )
+    
+    if collapse_dwells:
+        gdf = gdf.assign(
+            moving_sec = utils.seconds_since_service_day(
+                gdf.moving_timestamp_local, service_date)
+        )
+    
     return gdf
     
\ No newline at end of file
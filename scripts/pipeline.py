@@ -0,0 +1,509 @@
+"""
+Checkpointed pipeline runner.
+
+The stages that go from GTFS tables to segment speeds:
+1. stop_times_direction: project stops against shapes
+2. stop_times_with_vp: attach each trip's condensed vp
+3. nearest_neighbor: nearest vp and interpolated stop arrivals
+(plus neighbor_escalation.parquet, stops resolved at each k)
+4. speeds: enforce monotonic arrivals and calculate segment speeds
+
+Each stage runs per partition (service_date + operator), and writes
+a parquet checkpoint plus a _manifest.json:
+{PIPELINE_FOLDER}{stage}/service_date=.../schedule_gtfs_dataset_key=.../
+
+The manifest keeps a fingerprint of the stage's inputs
+(source parquet file sizes and modified times, upstream fingerprints),
+its code (source of the stage function and the scripts it imports)
+and kwargs, the column dtypes, and whether it finished or failed.
+On a re-run, stages with the same fingerprint are skipped,
+so a crash resumes at the stage and partition that failed.
+Partitions don't depend on each other and run in separate processes.
+"""
+import concurrent.futures
+import datetime
+import functools
+import geopandas as gpd
+import hashlib
+import inspect
+import json
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+import traceback
+import types
+
+import create_table
+import geo_io
+import neighbor
+import update_vars
+from update_vars import OUTPUT_FOLDER, PIPELINE_FOLDER
+
+PARTITION_COLS = ["service_date", "schedule_gtfs_dataset_key"]
+SCRIPTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+def partition_filters(partition: dict) -> list:
+    return [[(c, "==", partition[c]) for c in PARTITION_COLS]]
+
+
+def stop_times_direction_stage(
+    partition: dict,
+    inputs: dict,
+    **kwargs
+) -> gpd.GeoDataFrame:
+    return create_table.stop_times_projected_calitp_table(
+        folder_path = OUTPUT_FOLDER,
+        filters = partition_filters(partition),
+        **kwargs
+    )
+
+
+def stop_times_with_vp_stage(
+    partition: dict,
+    inputs: dict,
+    **kwargs
+) -> gpd.GeoDataFrame:
+    # Trips without enough vp coverage are dropped here,
+    # the coverage table sits next to the checkpoint
+    checkpoint_folder = f"{PIPELINE_FOLDER}stop_times_with_vp/{partition_path(partition)}"
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    
+    return create_table.stop_times_with_vp_table(
+        stops_projected = inputs["stop_times_direction"],
+        coverage_path = f"{checkpoint_folder}vp_coverage.parquet",
+        filters = partition_filters(partition),
+        **kwargs
+    )
+
+
+def nearest_neighbor_stage(
+    partition: dict,
+    inputs: dict,
+    **kwargs
+) -> gpd.GeoDataFrame:
+    gdf = neighbor.nearest_neighbor_and_interpolate(
+        inputs["stop_times_with_vp"],
+        **kwargs
+    )
+    
+    # How many stops each k of the adaptive search resolved,
+    # next to the checkpoint
+    checkpoint_folder = f"{PIPELINE_FOLDER}nearest_neighbor/{partition_path(partition)}"
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    
+    neighbor.neighbor_escalation_stats(gdf).assign(**partition).to_parquet(
+        f"{checkpoint_folder}neighbor_escalation.parquet"
+    )
+    
+    return gdf
+
+
+def speeds_stage(
+    partition: dict,
+    inputs: dict,
+    **kwargs
+) -> gpd.GeoDataFrame:
+    return neighbor.enforce_monotonicity_calculate_speeds(
+        inputs["nearest_neighbor"],
+        **kwargs
+    )
+
+
+# upstream: stages whose checkpoints are inputs
+# sources: parquets in OUTPUT_FOLDER the stage reads directly
+# kwargs: passed to func, and part of the fingerprint
+STAGES = {
+    "stop_times_direction": {
+        "func": stop_times_direction_stage,
+        "upstream": [],
+        "sources": ["trips", "stop_times", "stops", "shapes"],
+        "kwargs": {},
+    },
+    "stop_times_with_vp": {
+        "func": stop_times_with_vp_stage,
+        "upstream": ["stop_times_direction"],
+        "sources": ["trips", "shapes", "vp"],
+        "kwargs": {"gate_coverage": True},
+    },
+    "nearest_neighbor": {
+        "func": nearest_neighbor_stage,
+        "upstream": ["stop_times_with_vp"],
+        "sources": [],
+        "kwargs": {},
+    },
+    "speeds": {
+        "func": speeds_stage,
+        "upstream": ["nearest_neighbor"],
+        "sources": ["segments"],
+        "kwargs": {},
+    },
+}
+
+
+def stage_order(stages: dict = STAGES) -> list:
+    """
+    Topological order of the stages, so every stage
+    runs after its upstream stages.
+    """
+    order = []
+    visiting = set()
+
+    def visit(stage):
+        if stage in order:
+            return
+        if stage in visiting:
+            raise ValueError(f"stage {stage} depends on itself")
+
+        visiting.add(stage)
+        for upstream in stages[stage]["upstream"]:
+            visit(upstream)
+        visiting.remove(stage)
+
+        order.append(stage)
+
+    for stage in stages:
+        visit(stage)
+
+    return order
+
+
+def partition_path(partition: dict) -> str:
+    service_date = pd.Timestamp(partition["service_date"]).date()
+
+    return (
+        f"service_date={service_date}/"
+        f"schedule_gtfs_dataset_key={partition['schedule_gtfs_dataset_key']}/"
+    )
+
+
+def source_fingerprint(
+    table_name: str,
+    folder_path: str = OUTPUT_FOLDER
+) -> str:
+    """
+    Size and modified time of the source parquet,
+    so a re-downloaded table invalidates the stages that read it.
+    """
+    filepath = create_table.get_hackathon_table_filepath(table_name, folder_path)
+    stat = os.stat(filepath)
+
+    return f"{table_name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def is_local(module: types.ModuleType) -> bool:
+    filepath = getattr(module, "__file__", None)
+
+    return (
+        filepath is not None and
+        os.path.dirname(os.path.abspath(filepath)) == SCRIPTS_FOLDER
+    )
+
+
+def local_modules(
+    module: types.ModuleType,
+    found: dict = None
+) -> dict:
+    """
+    The module and every module from this folder it imports,
+    directly or through other modules here.
+    """
+    if found is None:
+        found = {}
+
+    found[module.__name__] = module
+
+    for value in vars(module).values():
+        if (
+            isinstance(value, types.ModuleType) and
+            is_local(value) and
+            value.__name__ not in found
+        ):
+            local_modules(value, found)
+
+    return found
+
+
+@functools.cache
+def code_fingerprint(func: types.FunctionType) -> str:
+    """
+    Hash of the stage function's source, and the source of every
+    module here it calls into (plus update_vars, for the constants
+    they import), so editing any of them re-runs the stage.
+    """
+    modules = {"update_vars": update_vars}
+
+    for value in inspect.getclosurevars(func).globals.values():
+        if isinstance(value, types.ModuleType) and is_local(value):
+            local_modules(value, modules)
+
+    sources = [inspect.getsource(func)] + [
+        inspect.getsource(modules[name]) for name in sorted(modules)
+    ]
+
+    return hashlib.md5("".join(sources).encode()).hexdigest()
+
+
+def stage_fingerprint(
+    stage: str,
+    partition: dict,
+    upstream_fingerprints: list,
+    stages: dict = STAGES
+) -> str:
+    parts = (
+        [stage, partition_path(partition)]
+        + [code_fingerprint(stages[stage]["func"])]
+        + [json.dumps(stages[stage].get("kwargs", {}), sort_keys=True, default=str)]
+        + [source_fingerprint(t) for t in stages[stage]["sources"]]
+        + upstream_fingerprints
+    )
+
+    return hashlib.md5("|".join(parts).encode()).hexdigest()
+
+
+def read_manifest(checkpoint_folder: str) -> dict:
+    try:
+        with open(f"{checkpoint_folder}_manifest.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(checkpoint_folder: str, manifest: dict):
+    """
+    Write to a temp file and rename, so an interrupted run
+    never leaves a half-written manifest.
+    """
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    tmp_path = f"{checkpoint_folder}_manifest.json.tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+
+    os.replace(tmp_path, f"{checkpoint_folder}_manifest.json")
+
+    return
+
+
+def is_current(
+    checkpoint_folder: str,
+    fingerprint: str
+) -> bool:
+    manifest = read_manifest(checkpoint_folder)
+
+    return (
+        manifest.get("status") == "done" and
+        manifest.get("fingerprint") == fingerprint and
+        os.path.exists(f"{checkpoint_folder}part-0.parquet")
+    )
+
+
+def check_checkpoint_file(
+    filepath: str,
+    is_geo: bool
+):
+    """
+    Read back the schema of a written checkpoint, and make sure
+    a geo checkpoint's primary geometry column is in the file,
+    so gpd.read_parquet works downstream.
+    """
+    schema = pq.read_schema(filepath)
+
+    if is_geo:
+        primary_column = geo_io.geo_metadata(schema).get("primary_column")
+
+        if primary_column not in schema.names:
+            raise ValueError(
+                f"{filepath} geo metadata points at {primary_column}, "
+                f"which isn't one of its columns: {schema.names}"
+            )
+
+    return
+
+
+def write_checkpoint(
+    df: pd.DataFrame,
+    checkpoint_folder: str,
+    fingerprint: str
+):
+    """
+    GeoDataFrames need their active geometry column present
+    (ex: after renaming geometry, use rename_geometry / set_geometry).
+    """
+    is_geo = isinstance(df, gpd.GeoDataFrame)
+
+    if is_geo and df.active_geometry_name not in df.columns:
+        raise ValueError(
+            f"active geometry column {df.active_geometry_name} isn't in the "
+            f"columns {list(df.columns)}"
+        )
+
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    tmp_path = f"{checkpoint_folder}part-0.parquet.tmp"
+
+    geo_io.write_geoparquet(df, tmp_path)
+    check_checkpoint_file(tmp_path, is_geo)
+    os.replace(tmp_path, f"{checkpoint_folder}part-0.parquet")
+
+    write_manifest(checkpoint_folder, {
+        "status": "done",
+        "fingerprint": fingerprint,
+        "is_geo": is_geo,
+        "dtypes": {c: str(t) for c, t in df.dtypes.items()},
+        "n_rows": len(df),
+        "finished_at": datetime.datetime.now().isoformat(),
+    })
+
+    return
+
+
+def read_checkpoint(checkpoint_folder: str) -> pd.DataFrame:
+    """
+    Read a stage's checkpoint, and check it has the
+    columns its manifest says it was written with.
+    """
+    manifest = read_manifest(checkpoint_folder)
+    filepath = f"{checkpoint_folder}part-0.parquet"
+
+    if manifest.get("is_geo"):
+        df = gpd.read_parquet(filepath)
+    else:
+        df = pd.read_parquet(filepath)
+
+    if list(df.columns) != list(manifest["dtypes"].keys()):
+        raise ValueError(
+            f"{filepath} columns don't match its manifest: "
+            f"{list(df.columns)} vs {list(manifest['dtypes'].keys())}"
+        )
+
+    return df
+
+
+def run_partition(
+    partition: dict,
+    stages: dict = STAGES,
+    pipeline_folder: str = PIPELINE_FOLDER
+) -> list:
+    """
+    Run every stage for 1 partition, in order.
+    Stages that are current are skipped (their checkpoint is only read
+    if a later stage has to run).
+    If a stage fails, record the error in its manifest and
+    stop this partition; its downstream stages are blocked.
+
+    Returns 1 dict per stage with the partition, stage, and status.
+    """
+    fingerprints = {}
+    loaded = {}
+    results = []
+
+    def get_input(stage):
+        if stage not in loaded:
+            loaded[stage] = read_checkpoint(
+                f"{pipeline_folder}{stage}/{partition_path(partition)}"
+            )
+        return loaded[stage]
+
+    order = stage_order(stages)
+
+    for i, stage in enumerate(order):
+        checkpoint_folder = f"{pipeline_folder}{stage}/{partition_path(partition)}"
+
+        fingerprints[stage] = stage_fingerprint(
+            stage,
+            partition,
+            [fingerprints[u] for u in stages[stage]["upstream"]],
+            stages
+        )
+
+        if is_current(checkpoint_folder, fingerprints[stage]):
+            results.append({**partition, "stage": stage, "status": "skipped"})
+            continue
+
+        try:
+            inputs = {u: get_input(u) for u in stages[stage]["upstream"]}
+            df = stages[stage]["func"](
+                partition, inputs, **stages[stage].get("kwargs", {})
+            )
+
+            write_checkpoint(df, checkpoint_folder, fingerprints[stage])
+            loaded[stage] = df
+
+            results.append({**partition, "stage": stage, "status": "done"})
+
+        except Exception as e:
+            write_manifest(checkpoint_folder, {
+                "status": "failed",
+                "fingerprint": fingerprints[stage],
+                "error": repr(e),
+                "traceback": traceback.format_exc(),
+                "finished_at": datetime.datetime.now().isoformat(),
+            })
+
+            results.append({
+                **partition, "stage": stage, "status": "failed", "error": repr(e)
+            })
+            results += [
+                {**partition, "stage": s, "status": "blocked"}
+                for s in order[i + 1:]
+            ]
+            break
+
+    return results
+
+
+def list_partitions(folder_path: str = OUTPUT_FOLDER) -> list:
+    """
+    Every service_date + operator in trips.
+    """
+    trips = create_table.get_calitp_table(
+        "trips",
+        folder_path = folder_path,
+        columns = PARTITION_COLS
+    )
+
+    return trips.sort_values(PARTITION_COLS).to_dict(orient="records")
+
+
+def run_pipeline(
+    partitions: list = None,
+    stages: dict = STAGES,
+    pipeline_folder: str = PIPELINE_FOLDER,
+    max_workers: int = 4,
+) -> pd.DataFrame:
+    """
+    Run all partitions (every service_date + operator in trips if None),
+    up to max_workers at a time in separate processes.
+    Returns 1 row per partition and stage with its status
+    (done, skipped, failed, blocked).
+    """
+    if partitions is None:
+        partitions = list_partitions()
+
+    stage_order(stages)
+
+    if max_workers <= 1:
+        results = [
+            run_partition(p, stages, pipeline_folder) for p in partitions
+        ]
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(
+                run_partition,
+                partitions,
+                [stages] * len(partitions),
+                [pipeline_folder] * len(partitions)
+            ))
+
+    return pd.DataFrame([r for partition_results in results for r in partition_results])
+
+
+if __name__ == "__main__":
+
+    start = datetime.datetime.now()
+
+    status_df = run_pipeline()
+
+    end = datetime.datetime.now()
+    print(status_df.groupby(["stage", "status"]).size())
+    print(f"execution time: {end - start}")
@@ -0,0 +1,223 @@
+"""
+Assign segment speeds (stop to stop) to road segments
+in district7_roads.parquet, and aggregate across all operators.
+
+A stop-to-stop segment and the roads it runs along don't line up exactly,
+so roads are buffered, and a segment is matched to a road if
+enough of the segment's length falls inside the road's buffer.
+That overlap length is the weight of the segment's speed on that road.
+
+To keep this to a few vectorized calls for a district and a day of speeds:
+- many trips share the same segment geometry, so match unique geometries only
+- build one STRtree over the buffered roads, and query segments in batches
+- overlaps are one shapely.intersection over all the candidate pairs
+- aggregates come from a single sort by road and speed
+"""
+import datetime
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import geo_io
+import speed_rollups
+from update_vars import OUTPUT_FOLDER, PROJECT_CRS, analysis_date
+
+# Columns from the roads table to keep, if present
+ROAD_COLS = ["linearid", "mtfcc", "fullname", "segment_sequence"]
+
+# How far (meters) a segment can be from the road centerline
+ROAD_BUFFER_METERS = 10
+
+# A segment that just crosses a road overlaps its buffer for
+# about 2x the buffer, so require more than that
+MIN_OVERLAP_METERS = 25
+
+QUERY_BATCH_SIZE = 50_000
+
+PERCENTILES = speed_rollups.PERCENTILES
+
+def get_roads(
+    folder_path: str = OUTPUT_FOLDER,
+    crs: str = PROJECT_CRS
+) -> gpd.GeoDataFrame:
+    """
+    Import roads, add road_idx (position in this table),
+    which is what speeds are aggregated to.
+    """
+    roads = gpd.read_parquet(
+        f"{folder_path}district7_roads.parquet"
+    ).to_crs(crs)
+
+    keep_cols = [c for c in ROAD_COLS if c in roads.columns]
+
+    return roads[keep_cols + ["geometry"]].reset_index(drop=True).assign(
+        road_idx = lambda x: np.arange(len(x), dtype="int64")
+    )
+
+
+def match_segments_to_roads(
+    segment_geometry: np.ndarray,
+    road_geometry: np.ndarray,
+    buffer_meters: float = ROAD_BUFFER_METERS,
+    min_overlap_meters: float = MIN_OVERLAP_METERS,
+    batch_size: int = QUERY_BATCH_SIZE
+) -> pd.DataFrame:
+    """
+    Returns 1 row per (segment, road) match:
+    segment position, road position, overlap_meters.
+    """
+    road_buffers = shapely.buffer(road_geometry, buffer_meters, cap_style="flat")
+    tree = shapely.STRtree(road_buffers)
+
+    segment_idx = []
+    road_idx = []
+
+    for start in range(0, len(segment_geometry), batch_size):
+        batch = segment_geometry[start: start + batch_size]
+        pairs = tree.query(batch, predicate="intersects")
+
+        segment_idx.append(pairs[0] + start)
+        road_idx.append(pairs[1])
+
+    segment_idx = np.concatenate(segment_idx) if segment_idx else np.zeros(0, "int64")
+    road_idx = np.concatenate(road_idx) if road_idx else np.zeros(0, "int64")
+
+    overlap = shapely.length(
+        shapely.intersection(
+            segment_geometry[segment_idx], road_buffers[road_idx]
+        )
+    )
+
+    keep = overlap >= min_overlap_meters
+
+    return pd.DataFrame({
+        "segment_idx": segment_idx[keep],
+        "road_idx": road_idx[keep],
+        "overlap_meters": overlap[keep],
+    })
+
+
+def weighted_percentiles(
+    starts: np.ndarray,
+    sorted_values: np.ndarray,
+    sorted_weights: np.ndarray,
+    percentiles: list = PERCENTILES
+) -> dict:
+    """
+    Values are sorted within each group (starting at starts).
+    The weighted percentile is the first value where the group's
+    running weight reaches p% of its total.
+    """
+    cum_weight = np.cumsum(sorted_weights)
+    before_group = np.append(0, cum_weight)[starts]
+    group_weight = np.add.reduceat(sorted_weights, starts)
+
+    return {
+        p: sorted_values[
+            np.minimum(
+                np.searchsorted(
+                    cum_weight, before_group + group_weight * p / 100, side="left"
+                ),
+                len(sorted_values) - 1
+            )
+        ]
+        for p in percentiles
+    }
+
+
+def road_segment_speeds(
+    speed_gdf: gpd.GeoDataFrame,
+    roads: gpd.GeoDataFrame,
+    percentiles: list = PERCENTILES
+) -> gpd.GeoDataFrame:
+    """
+    For each road segment with matched speeds:
+    - n_obs: trip-segment speeds on this road
+    - n_trips, n_operators
+    - avg_speed_mph: overlap-weighted mean speed
+    - p20/p50/p80_speed_mph: overlap-weighted percentiles
+    """
+    gdf = speed_rollups.valid_speeds(speed_gdf)
+    segment_geometry = gpd.GeoSeries(gdf.segment_geometry).to_crs(roads.crs)
+
+    # Match each unique segment geometry once
+    geometry_code, unique_geometry = pd.factorize(
+        shapely.to_wkb(segment_geometry.to_numpy())
+    )
+
+    matches = match_segments_to_roads(
+        shapely.from_wkb(np.asarray(unique_geometry)),
+        roads.geometry.to_numpy()
+    )
+
+    # Expand unique geometries back to every trip-segment speed
+    speed_order = np.argsort(geometry_code, kind="stable")
+    geometry_starts = np.searchsorted(
+        geometry_code[speed_order], np.arange(len(unique_geometry))
+    )
+    n_speeds = np.bincount(geometry_code, minlength=len(unique_geometry))
+
+    match_n = n_speeds[matches.segment_idx.to_numpy()]
+    match_num = np.repeat(np.arange(len(matches)), match_n)
+    within = np.arange(len(match_num)) - np.repeat(np.cumsum(match_n) - match_n, match_n)
+
+    speed_idx = speed_order[
+        geometry_starts[matches.segment_idx.to_numpy()[match_num]] + within
+    ]
+    road_idx = matches.road_idx.to_numpy()[match_num]
+    weight = matches.overlap_meters.to_numpy()[match_num]
+    speed = gdf.speed_mph.to_numpy()[speed_idx]
+
+    # One sort by road, then speed
+    order = np.lexsort([speed, road_idx])
+    road_idx, speed, weight, speed_idx = (
+        road_idx[order], speed[order], weight[order], speed_idx[order]
+    )
+
+    is_start = np.ones(len(road_idx), dtype=bool)
+    is_start[1:] = road_idx[1:] != road_idx[:-1]
+    starts = np.flatnonzero(is_start)
+
+    if len(starts) == 0:
+        return roads.iloc[0:0]
+
+    trip_codes = pd.factorize(gdf.trip_instance_key)[0][speed_idx]
+    operator_codes = pd.factorize(gdf.schedule_gtfs_dataset_key)[0][speed_idx]
+
+    pct = weighted_percentiles(starts, speed, weight, percentiles)
+
+    road_df = pd.DataFrame({
+        "road_idx": road_idx[starts],
+        "n_obs": np.diff(np.append(starts, len(road_idx))),
+        "n_trips": speed_rollups.count_unique_per_group(starts, trip_codes),
+        "n_operators": speed_rollups.count_unique_per_group(starts, operator_codes),
+        "avg_speed_mph": (
+            np.add.reduceat(speed * weight, starts)
+            / np.add.reduceat(weight, starts)
+        ),
+        **{f"p{p}_speed_mph": v for p, v in pct.items()}
+    })
+
+    return pd.merge(
+        roads,
+        road_df,
+        on = "road_idx",
+        how = "inner"
+    )
+
+
+if __name__ == "__main__":
+    import backfill
+
+    start = datetime.datetime.now()
+
+    speed_gdf = backfill.read_backfill("speeds", analysis_date, analysis_date)
+    roads = get_roads()
+
+    gdf = road_segment_speeds(speed_gdf, roads)
+    geo_io.write_geoparquet(gdf, f"{OUTPUT_FOLDER}road_speeds.parquet")
+
+    end = datetime.datetime.now()
+    print(f"roads with speeds: {len(gdf)} / {len(roads)}")
+    print(f"execution time: {end - start}")
@@ -0,0 +1,193 @@
+"""
+Schedule adherence: compare interpolated stop arrivals
+against the scheduled arrival_sec from stop_times.
+
+This runs inside calculate_speed_from_stop_arrivals,
+on the frame that's already sorted by trip and stop_sequence,
+so the scheduled and actual arrival are already on the same row
+and there's no extra join.
+
+- delay_sec: actual - scheduled arrival (positive is late)
+- is_early / is_on_time / is_late: against the on-time window
+- delay_added_sec: how much delay the trip picked up (or recovered)
+since the prior stop, which is how delay propagates along a trip
+"""
+import numpy as np
+import pandas as pd
+
+import group_kernels
+import speed_rollups
+import utils
+from update_vars import OUTPUT_FOLDER, ROLLUP_FOLDER
+
+# On-time is up to 1 min early and up to 5 min late
+ON_TIME_EARLY_SEC = 60
+ON_TIME_LATE_SEC = 300
+
+ADHERENCE_LEVELS = {
+    "operator": ["service_date", "schedule_gtfs_dataset_key"],
+    "route_direction": [
+        "service_date", "schedule_gtfs_dataset_key", "route_id", "direction_id"
+    ],
+}
+
+def seconds_to_int(values: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Cast seconds to int64, with a mask for where it's missing.
+    """
+    values = values.to_numpy(dtype="float64", na_value=np.nan)
+    is_valid = np.isfinite(values)
+
+    return np.where(is_valid, values, 0).round().astype("int64"), is_valid
+
+
+def stop_delay(
+    scheduled_sec: np.ndarray,
+    actual_sec: np.ndarray
+) -> np.ndarray:
+    """
+    Scheduled arrival_sec and the actual arrival are both seconds
+    since the start of the service day, and both keep counting
+    past 24 hours for trips after midnight (ex: 25:10:00 is 90_600),
+    so the delay is just the difference.
+    """
+    return actual_sec - scheduled_sec
+
+
+def add_stop_delay(
+    df: pd.DataFrame,
+    sorted_groups: tuple,
+    scheduled_col: str = "arrival_sec",
+    actual_col: str = "arrival_time_sec",
+    early_sec: int = ON_TIME_EARLY_SEC,
+    late_sec: int = ON_TIME_LATE_SEC
+) -> pd.DataFrame:
+    """
+    Add delay_sec, is_early, is_on_time, is_late, delay_added_sec.
+    sorted_groups is the trip sort from group_kernels.sort_groups,
+    reused from the speed calculation.
+    Stops without an arrival (or schedule) get missing values.
+    """
+    scheduled, has_scheduled = seconds_to_int(df[scheduled_col])
+    actual, has_actual = seconds_to_int(df[actual_col])
+
+    is_valid = has_scheduled & has_actual
+    delay = stop_delay(scheduled, actual)
+
+    df = df.assign(
+        delay_sec = pd.arrays.IntegerArray(
+            np.where(is_valid, delay, 0).astype("int32"), ~is_valid
+        ),
+        is_early = is_valid & (delay < -early_sec),
+        is_on_time = is_valid & (delay >= -early_sec) & (delay <= late_sec),
+        is_late = is_valid & (delay > late_sec),
+    )
+
+    prior_delay = group_kernels.grouped_shift(
+        df,
+        {"prior_delay_sec": ("delay_sec", 1)},
+        sorted_groups = sorted_groups
+    )["prior_delay_sec"]
+
+    df = df.assign(
+        delay_added_sec = df.delay_sec - prior_delay
+    )
+
+    return df
+
+
+def rollup_adherence(
+    df: pd.DataFrame,
+    levels: dict = ADHERENCE_LEVELS,
+) -> dict:
+    """
+    Summarize stop delays for each level (operator, route_direction)
+    from a single sort, same as speed_rollups.rollup_speeds.
+
+    For each group:
+    - n_arrivals: stop arrivals with a delay
+    - n_trips: number of unique trips
+    - pct_early / pct_on_time / pct_late
+    - mean_delay_sec, p50_delay_sec (finest grain only)
+    - mean_delay_added_sec: average delay picked up between stops
+    """
+    df = df[df.delay_sec.notna()].reset_index(drop=True)
+
+    finest_cols = max(levels.values(), key=len)
+    order, sorted_codes = speed_rollups.sorted_group_codes(
+        df, finest_cols, "delay_sec"
+    )
+
+    delay = df.delay_sec.to_numpy(dtype="int64")[order]
+    delay_added = df.delay_added_sec.to_numpy(
+        dtype="float64", na_value=np.nan)[order]
+    trip_codes = pd.factorize(df.trip_instance_key)[0][order]
+
+    flags = {
+        c: df[c].to_numpy().astype("int64")[order]
+        for c in ["is_early", "is_on_time", "is_late"]
+    }
+
+    # The first stop of a trip has no delay_added_sec
+    has_added = np.isfinite(delay_added)
+    delay_added = np.where(has_added, delay_added, 0)
+
+    results = {}
+
+    for level, level_cols in levels.items():
+        starts = speed_rollups.level_starts(sorted_codes, level_cols)
+
+        if len(starts) == 0:
+            results[level] = df[level_cols].iloc[0:0]
+            continue
+
+        n_arrivals = np.diff(np.append(starts, len(delay)))
+        n_added = np.add.reduceat(has_added.astype("int64"), starts)
+
+        summary = df[level_cols].iloc[order[starts]].reset_index(drop=True)
+
+        summary = summary.assign(
+            n_arrivals = n_arrivals,
+            n_trips = speed_rollups.count_unique_per_group(starts, trip_codes),
+            **{
+                f"pct_{c.replace('is_', '')}": (
+                    np.add.reduceat(v, starts) / n_arrivals * 100
+                ).round(1)
+                for c, v in flags.items()
+            },
+            mean_delay_sec = np.add.reduceat(delay, starts) / n_arrivals,
+            mean_delay_added_sec = np.divide(
+                np.add.reduceat(delay_added, starts), n_added,
+                out = np.full(len(starts), np.nan), where = n_added > 0
+            ),
+        )
+
+        # Delays are sorted within the finest grain only
+        if level_cols == finest_cols:
+            summary = summary.assign(
+                p50_delay_sec = delay[starts + (n_arrivals - 1) // 2]
+            )
+
+        results[level] = utils.add_operator_name(summary)
+
+    return results
+
+
+def write_adherence_rollups(
+    speed_gdf: pd.DataFrame,
+    output_folder: str = ROLLUP_FOLDER,
+    folder_path: str = OUTPUT_FOLDER
+) -> dict:
+    """
+    Attach route info, summarize schedule adherence,
+    and write each level as a partitioned parquet table:
+    {output_folder}{level}_adherence/.
+    """
+    speed_gdf = speed_rollups.attach_route_info(speed_gdf, folder_path)
+
+    results = rollup_adherence(speed_gdf)
+
+    for level, df in results.items():
+        speed_rollups.write_partitioned(df, f"{output_folder}{level}_adherence")
+
+    return results
@@ -0,0 +1,336 @@
+"""
+Schema layer for the GTFS tables.
+
+Keys like schedule_gtfs_dataset_key, trip_instance_key are 32-char hex strings,
+and trip_id, shape_id, stop_id are free-form strings. Carried around as
+object columns, every merge has to hash these strings again.
+
+Here, we build one shared dictionary of key values,
+and load the keys as categoricals that all share the same categories.
+Merges between categoricals with identical categories
+happen on the integer codes, not the strings.
+"""
+import numpy as np
+import pandas as pd
+import warnings
+
+from typing import Union
+
+KEY_COLS = [
+    "schedule_gtfs_dataset_key",
+    "trip_instance_key",
+    "trip_id",
+    "shape_id",
+    "stop_id",
+]
+
+# Columns derived from a key column share that key column's dictionary
+KEY_ALIASES = {
+    "stop_id1": "stop_id",
+    "stop_id2": "stop_id",
+}
+
+# Columns hashed into stable int64 keys (see add_hash_keys)
+HASH_KEY_COLS = {
+    "trip_instance_key": ["schedule_gtfs_dataset_key", "service_date", "trip_id"],
+    "shape_array_key": ["schedule_gtfs_dataset_key", "shape_id"],
+}
+
+NUMERIC_DTYPES = {
+    "stop_sequence": "int32",
+    "subseq_stop_sequence": "Int32",
+    "arrival_sec": "float32",
+}
+
+def build_key_dictionary(
+    df_list: list,
+    key_cols: list = KEY_COLS
+) -> dict:
+    """
+    Gather the unique values of each key column across all the
+    dfs (trips, stops, vp, etc) into one sorted index per key.
+    Every table encoded with this dictionary will share categories.
+    """
+    key_dictionary = {}
+
+    for c in key_cols:
+        values = [
+            pd.Series(df[c].unique()).dropna().astype(str)
+            for df in df_list if c in df.columns and not is_hash_key(df[c])
+        ]
+
+        if len(values) > 0:
+            key_dictionary[c] = pd.Index(
+                pd.concat(values, ignore_index=True).unique()
+            ).sort_values()
+
+    return key_dictionary
+
+
+def update_key_dictionary(
+    key_dictionary: dict,
+    df_list: list,
+    key_cols: list = KEY_COLS
+) -> dict:
+    """
+    Add any new key values found in df_list.
+    Existing values keep their codes, new values are appended.
+    """
+    new_dictionary = build_key_dictionary(df_list, key_cols)
+
+    for c, new_values in new_dictionary.items():
+        if c in key_dictionary:
+            key_dictionary[c] = key_dictionary[c].append(
+                new_values.difference(key_dictionary[c])
+            )
+        else:
+            key_dictionary[c] = new_values
+
+    return key_dictionary
+
+
+def write_key_dictionary(
+    key_dictionary: dict,
+    path: str
+):
+    """
+    Save dictionary as long table, where position within
+    each key_col is the code.
+    """
+    df = pd.concat(
+        [pd.DataFrame({
+            "key_col": c,
+            "code": np.arange(len(values), dtype="int32"),
+            "value": values.astype(str)
+        }) for c, values in key_dictionary.items()],
+        axis=0, ignore_index=True
+    )
+
+    df.to_parquet(path)
+
+    return
+
+
+def read_key_dictionary(path: str) -> dict:
+    """
+    Read in the long table saved by write_key_dictionary.
+    """
+    df = pd.read_parquet(path).sort_values(["key_col", "code"])
+
+    return {
+        c: pd.Index(subset_df.value.tolist())
+        for c, subset_df in df.groupby("key_col", sort=False)
+    }
+
+
+def is_hash_key(series: pd.Series) -> bool:
+    """
+    int64 keys from add_hash_keys are already integers,
+    and aren't in the key dictionary.
+    """
+    return series.dtype == "int64"
+
+
+def get_categories(
+    key_dictionary: dict,
+    col: str
+) -> Union[pd.Index, None]:
+    return key_dictionary.get(KEY_ALIASES.get(col, col))
+
+
+def encode_keys(
+    df: pd.DataFrame,
+    key_dictionary: dict,
+    as_codes: bool = False,
+    raise_on_missing: bool = False
+) -> pd.DataFrame:
+    """
+    Convert key columns into categoricals using the
+    shared key_dictionary. Merges across tables encoded
+    with the same dictionary happen on integer codes.
+
+    If as_codes is True, return the int32 surrogate keys instead
+    (-1 for values not found in the dictionary).
+
+    Values that aren't in the dictionary become missing, so we warn
+    with how many there are. If raise_on_missing is True, raise instead
+    (build the dictionary with update_key_dictionary to add them).
+    """
+    encoded_cols = {}
+
+    for c in df.columns:
+        categories = get_categories(key_dictionary, c)
+
+        if categories is None or is_hash_key(df[c]):
+            continue
+
+        encoded = df[c].astype(pd.CategoricalDtype(categories))
+
+        n_missing = int((encoded.isna() & df[c].notna()).sum())
+
+        if n_missing > 0:
+            message = (
+                f"{c}: {n_missing} rows have values that aren't "
+                "in the key dictionary, encoded as missing"
+            )
+            if raise_on_missing:
+                raise ValueError(message)
+            warnings.warn(message)
+
+        if as_codes:
+            encoded = encoded.cat.codes.astype("int32")
+
+        encoded_cols[c] = encoded
+
+    return df.assign(**encoded_cols)
+
+
+def decode_keys(
+    df: pd.DataFrame,
+    key_dictionary: dict,
+    key_cols: list = KEY_COLS + list(KEY_ALIASES.keys())
+) -> pd.DataFrame:
+    """
+    Convert int32 surrogate keys or categoricals back into strings.
+    """
+    decoded_cols = {}
+
+    for c in [c for c in key_cols if c in df.columns]:
+        if is_hash_key(df[c]):
+            continue
+        elif isinstance(df[c].dtype, pd.CategoricalDtype):
+            decoded_cols[c] = df[c].astype(object)
+        else:
+            decoded_cols[c] = pd.Categorical.from_codes(
+                df[c].to_numpy(),
+                categories = get_categories(key_dictionary, c)
+            ).astype(object)
+
+    return df.assign(**decoded_cols)
+
+
+def downcast_dtypes(
+    df: pd.DataFrame,
+    dtypes_dict: dict = NUMERIC_DTYPES
+) -> pd.DataFrame:
+    """
+    Use smaller numeric dtypes for columns we know the range of.
+    """
+    return df.astype({
+        c: dtype for c, dtype in dtypes_dict.items()
+        if c in df.columns
+    })
+
+
+def key_codes(series: pd.Series) -> np.ndarray:
+    """
+    Get the integer codes for a key column,
+    whether it's categorical or already int32 surrogate keys.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy().astype("int32")
+
+    return series.to_numpy()
+
+
+def pair_key(
+    first: Union[pd.Series, np.ndarray],
+    second: Union[pd.Series, np.ndarray]
+) -> np.ndarray:
+    """
+    Pack 2 int32 keys (stop_id1/stop_id2 codes or
+    stop_sequence/subseq_stop_sequence) into a single int64,
+    so a stop pair can be sorted or used in np.unique as one value.
+    Missing values (last stop of a trip) are packed as -1.
+    """
+    first = pd.Series(first).fillna(-1).to_numpy(dtype="int64")
+    second = pd.Series(second).fillna(-1).to_numpy(dtype="int64")
+
+    return (first << 32) | (second & 0xFFFFFFFF)
+
+
+def add_stop_pair_labels(
+    df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    stop_seq_pair and stop_id_pair used to be carried as
+    string columns. Now the pairs are the 2 columns themselves
+    (stop_sequence/subseq_stop_sequence, stop_id1/stop_id2).
+    Only build the readable labels when we need them, like for a map.
+    """
+    df = df.assign(
+        stop_seq_pair = df.stop_sequence.astype(str).str.cat(
+            df.subseq_stop_sequence.astype(str), sep="__"
+        ),
+        stop_id_pair = df.stop_id1.astype(str).str.cat(
+            df.stop_id2.astype(str), sep="__"
+        ).where(df.stop_id2.notna())
+    )
+
+    return df
+
+
+def hash_key(
+    df: pd.DataFrame,
+    cols: list
+) -> np.ndarray:
+    """
+    Stable 64-bit integer key from the values in cols.
+
+    pd.util.hash_pandas_object hashes each column in C with a fixed
+    hash key and combines them by row. Arrow-backed and object strings
+    hash the same, and categoricals hash their values (not codes),
+    so the same (operator, service_date, trip_id) gets the same key
+    in every run and every batch of operators.
+    Dates are hashed as YYYY-MM-DD, whatever their dtype.
+    """
+    parts = {}
+
+    for c in cols:
+        if pd.api.types.is_datetime64_any_dtype(df[c]):
+            parts[c] = df[c].dt.strftime("%Y-%m-%d")
+        else:
+            parts[c] = df[c]
+
+    return pd.util.hash_pandas_object(
+        pd.DataFrame(parts), index=False
+    ).to_numpy().view("int64")
+
+
+def add_hash_keys(
+    df: pd.DataFrame,
+    hash_key_cols: dict = HASH_KEY_COLS
+) -> pd.DataFrame:
+    """
+    Add trip_instance_key and shape_array_key (int64) for
+    every key whose columns are all present in df.
+    These are unique across operators, so feeds can be concatenated
+    and merged on these instead of trip_id / shape_id.
+    """
+    return df.assign(**{
+        key: hash_key(df, cols)
+        for key, cols in hash_key_cols.items()
+        if all(c in df.columns for c in cols)
+    })
+
+
+def check_hash_keys(
+    df: pd.DataFrame,
+    hash_key_cols: dict = HASH_KEY_COLS
+):
+    """
+    Raise if 2 different sets of values hashed to the same key.
+    """
+    for key, cols in hash_key_cols.items():
+        if key not in df.columns:
+            continue
+
+        n_keys = df[key].nunique()
+        n_values = len(df[cols].drop_duplicates())
+
+        if n_keys != n_values:
+            raise ValueError(
+                f"{key}: {n_values} unique {cols} but {n_keys} keys"
+            )
+
+    return
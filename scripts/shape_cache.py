@@ -0,0 +1,414 @@
+"""
+On-disk cache of per-shape arrays, reused across runs and service dates.
+
+Shapes rarely change from one service date to the next, but every run
+projects stops and vp against them from scratch.
+For each shape (keyed by a hash of its WKB), we save:
+- coords: the line's vertices
+- cum_meters: meters along the line at each vertex
+- cell_keys / cell_offsets / cell_segments: a grid of GRID_METERS cells,
+and the line segments whose bounding box touches each cell
+- grid: x, y origin, grid_meters, number of columns and rows
+
+as .npy files in {SHAPE_CACHE_FOLDER}{hash}/.
+Entries are memory-mapped read-only, so workers on the same machine
+share the same pages. An entry's folder is touched whenever it's opened,
+and the least recently used entries are removed once the cache
+is over max_bytes.
+
+Projecting a point only looks at segments in the 3x3 cells around it.
+If the nearest of those is within grid_meters, it's the nearest segment
+on the whole line. Points farther away than that fall back to shapely.
+
+Compare against shapely on the LADOT partridge feed:
+python shape_cache.py
+"""
+import concurrent.futures
+import datetime
+import functools
+import geopandas as gpd
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import shapely
+import threading
+
+import geo_threads
+from update_vars import SHAPE_CACHE_FOLDER
+
+GRID_METERS = 100
+MAX_CACHE_BYTES = 1024 ** 3
+CHUNK_SIZE = 20_000
+
+SHAPE_ARRAYS = [
+    "coords", "cum_meters", "cell_keys", "cell_offsets", "cell_segments", "grid"
+]
+
+def shape_hash(line: shapely.LineString) -> str:
+    return hashlib.sha1(shapely.to_wkb(line)).hexdigest()[:20]
+
+
+def build_shape_arrays(
+    line: shapely.LineString,
+    grid_meters: float = GRID_METERS
+) -> dict:
+    """
+    Vertices, cumulative meters, and the segments in each grid cell.
+    Cells are numbered row * n_cols + column, from the line's
+    lower left corner, and stored sorted, with each cell's segments at
+    cell_segments[cell_offsets[i]: cell_offsets[i + 1]].
+    """
+    coords = shapely.get_coordinates(line)
+    segment_meters = np.hypot(*np.diff(coords, axis=0).T)
+    cum_meters = np.concatenate([[0], np.cumsum(segment_meters)])
+
+    x0, y0 = coords.min(axis=0)
+    x1, y1 = coords.max(axis=0)
+    n_cols = int((x1 - x0) // grid_meters) + 1
+    n_rows = int((y1 - y0) // grid_meters) + 1
+
+    # Cells covered by each segment's bounding box
+    cols = ((coords[:, 0] - x0) // grid_meters).astype("int64")
+    rows = ((coords[:, 1] - y0) // grid_meters).astype("int64")
+
+    col_start = np.minimum(cols[:-1], cols[1:])
+    row_start = np.minimum(rows[:-1], rows[1:])
+    width = np.abs(np.diff(cols)) + 1
+    n_cells = width * (np.abs(np.diff(rows)) + 1)
+
+    segment = np.repeat(np.arange(len(n_cells)), n_cells)
+    position = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+
+    keys = (
+        (row_start[segment] + position // width[segment]) * n_cols
+        + col_start[segment] + position % width[segment]
+    )
+
+    order = np.lexsort([segment, keys])
+    cell_keys, cell_starts = np.unique(keys[order], return_index=True)
+
+    return {
+        "coords": coords,
+        "cum_meters": cum_meters,
+        "cell_keys": cell_keys.astype("int64"),
+        "cell_offsets": np.append(cell_starts, len(keys)).astype("int64"),
+        "cell_segments": segment[order].astype("int32"),
+        "grid": np.array([x0, y0, grid_meters, n_cols, n_rows], dtype="float64"),
+    }
+
+
+def write_shape_entry(
+    arrays: dict,
+    entry_path: str
+):
+    """
+    Write to a temporary folder and rename it, so other workers
+    never see a partly written entry.
+    """
+    tmp_path = f"{entry_path}.tmp{os.getpid()}_{threading.get_ident()}"
+    os.makedirs(tmp_path, exist_ok=True)
+
+    for name, values in arrays.items():
+        np.save(f"{tmp_path}/{name}.npy", values)
+
+    try:
+        os.rename(tmp_path, entry_path)
+    except OSError:
+        # Another worker wrote the same shape first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return
+
+
+@functools.lru_cache(maxsize=4096)
+def open_shape_entry(entry_path: str) -> dict:
+    """
+    Memory-map an entry's arrays (read-only), and touch it for LRU eviction.
+    """
+    arrays = {
+        name: np.load(f"{entry_path}/{name}.npy", mmap_mode="r")
+        for name in SHAPE_ARRAYS
+    }
+    os.utime(entry_path)
+
+    return arrays
+
+
+def get_shape(
+    line: shapely.LineString,
+    cache_folder: str = SHAPE_CACHE_FOLDER,
+    grid_meters: float = GRID_METERS
+) -> tuple[dict, bool]:
+    """
+    The shape's cached arrays, built and written if they're not cached yet.
+    Also returns whether the entry was written.
+    """
+    entry_path = f"{cache_folder}{shape_hash(line)}_{grid_meters}"
+
+    try:
+        return open_shape_entry(entry_path), False
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(cache_folder, exist_ok=True)
+    write_shape_entry(build_shape_arrays(line, grid_meters), entry_path)
+
+    return open_shape_entry(entry_path), True
+
+
+def evict(
+    cache_folder: str = SHAPE_CACHE_FOLDER,
+    max_bytes: int = MAX_CACHE_BYTES
+) -> list:
+    """
+    Remove the least recently opened entries until the cache
+    is under max_bytes. Returns the entries removed.
+    Workers that already mapped a removed entry can keep reading it.
+    """
+    entries = []
+
+    for entry in os.scandir(cache_folder):
+        if entry.is_dir() and ".tmp" not in entry.name:
+            n_bytes = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, n_bytes, entry.path))
+
+    total_bytes = sum(n_bytes for _, n_bytes, _ in entries)
+    removed = []
+
+    for _, n_bytes, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+
+        shutil.rmtree(path, ignore_errors=True)
+        total_bytes -= n_bytes
+        removed.append(path)
+
+    return removed
+
+
+def project_points(
+    shape: dict,
+    line: shapely.LineString,
+    xy: np.ndarray
+) -> np.ndarray:
+    """
+    Same as shapely.line_locate_point(line, points) for 1 shape,
+    using its cached arrays (from get_shape). xy is an (n, 2) array.
+    """
+    coords, cum_meters = shape["coords"], shape["cum_meters"]
+    cell_keys, cell_offsets = shape["cell_keys"], shape["cell_offsets"]
+    cell_segments = shape["cell_segments"]
+    x0, y0, grid_meters, n_cols, n_rows = shape["grid"]
+
+    meters = np.full(len(xy), np.nan)
+    fallback = np.ones(len(xy), dtype=bool)
+
+    for start in range(0, len(xy), CHUNK_SIZE):
+        chunk = xy[start: start + CHUNK_SIZE]
+        point_num = np.arange(len(chunk))
+
+        with np.errstate(invalid="ignore"):
+            col = np.floor((chunk[:, 0] - x0) / grid_meters)
+            row = np.floor((chunk[:, 1] - y0) / grid_meters)
+
+        # Segments in the 3x3 cells around each point
+        cand_point, cand_start, cand_count = [], [], []
+
+        for d_row in [-1, 0, 1]:
+            for d_col in [-1, 0, 1]:
+                c, r = col + d_col, row + d_row
+                in_grid = (c >= 0) & (c < n_cols) & (r >= 0) & (r < n_rows)
+
+                keys = (r[in_grid] * n_cols + c[in_grid]).astype("int64")
+                pos = np.searchsorted(cell_keys, keys)
+                found = pos < len(cell_keys)
+                found[found] = cell_keys[pos[found]] == keys[found]
+
+                cand_point.append(point_num[in_grid][found])
+                cand_start.append(cell_offsets[pos[found]])
+                cand_count.append(cell_offsets[pos[found] + 1] - cell_offsets[pos[found]])
+
+        cand_count = np.concatenate(cand_count)
+        n_cand = cand_count.sum()
+
+        if n_cand == 0:
+            continue
+
+        cand_point = np.repeat(np.concatenate(cand_point), cand_count)
+        cand_segment = cell_segments[
+            np.repeat(np.concatenate(cand_start), cand_count)
+            + np.arange(n_cand) - np.repeat(np.cumsum(cand_count) - cand_count, cand_count)
+        ]
+
+        # Closest point on each candidate segment
+        a = coords[cand_segment]
+        b = coords[cand_segment + 1]
+        ab = b - a
+        p = chunk[cand_point]
+        length_sq = (ab ** 2).sum(axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(
+                length_sq > 0,
+                np.clip(((p - a) * ab).sum(axis=1) / length_sq, 0, 1),
+                0
+            )
+
+        # Segment ends exactly, so a vertex shared by 2 segments is a tie
+        closest = np.where(
+            (t == 1)[:, None], b, a + t[:, None] * ab
+        )
+        dist_sq = ((p - closest) ** 2).sum(axis=1)
+
+        # Nearest segment per point, ties go to the first one along the line
+        min_dist_sq = np.full(len(chunk), np.inf)
+        np.minimum.at(min_dist_sq, cand_point, dist_sq)
+
+        is_min = dist_sq == min_dist_sq[cand_point]
+        first_segment = np.full(len(chunk), np.iinfo("int32").max)
+        np.minimum.at(first_segment, cand_point[is_min], cand_segment[is_min])
+
+        best = is_min & (cand_segment == first_segment[cand_point])
+        meters[start + cand_point[best]] = (
+            cum_meters[cand_segment[best]] + t[best] * np.sqrt(length_sq[best])
+        )
+
+        fallback[start: start + len(chunk)] = ~(min_dist_sq <= grid_meters ** 2)
+
+    # Missing points stay NaN
+    fallback &= np.isfinite(xy).all(axis=1)
+
+    if fallback.any():
+        meters[fallback] = shapely.line_locate_point(
+            line, shapely.points(xy[fallback]))
+
+    return meters
+
+
+def project_line(
+    line: shapely.LineString,
+    xy: np.ndarray,
+    cache_folder: str = SHAPE_CACHE_FOLDER,
+    grid_meters: float = GRID_METERS
+) -> np.ndarray:
+    """
+    Project an (n, 2) array of coordinates against 1 line,
+    with the cache if it's on (cache_folder isn't None).
+    """
+    if cache_folder is None or not isinstance(line, shapely.LineString) or line.is_empty:
+        return shapely.line_locate_point(line, shapely.points(xy))
+
+    shape, _ = get_shape(line, cache_folder, grid_meters)
+
+    return project_points(shape, line, xy)
+
+
+def project(
+    lines: gpd.GeoSeries,
+    points: gpd.GeoSeries,
+    line_keys: pd.DataFrame = None,
+    cache_folder: str = SHAPE_CACHE_FOLDER,
+    grid_meters: float = GRID_METERS,
+    max_bytes: int = MAX_CACHE_BYTES,
+    n_threads: int = None
+) -> np.ndarray:
+    """
+    Same as lines.project(points) (rows already aligned).
+    Rows are grouped by line, and each line is looked up in the cache once.
+    line_keys (ex: shape_array_key, or operator + shape_id) says which
+    rows share a line. Without it, rows are grouped by the line's WKB.
+    Lines are projected on a geo_threads thread pool (n_threads).
+    Without a cache_folder, this is geo_threads.project.
+    """
+    if cache_folder is None:
+        return geo_threads.project(lines, points, n_threads)
+
+    line_array = np.asarray(lines.to_numpy())
+    xy = np.column_stack([
+        geo_threads.get_x(points, n_threads), geo_threads.get_y(points, n_threads)
+    ])
+
+    if line_keys is not None:
+        line_keys = pd.DataFrame(line_keys).reset_index(drop=True)
+        line_codes = line_keys.groupby(
+            list(line_keys.columns), sort=False, dropna=False
+        ).ngroup().to_numpy()
+    else:
+        line_codes, _ = pd.factorize(shapely.to_wkb(line_array))
+
+    order = np.argsort(line_codes, kind="stable")
+    group_starts = np.flatnonzero(np.diff(line_codes[order], prepend=-1))
+
+    def project_group(rows: np.ndarray) -> tuple[np.ndarray, bool]:
+        line = line_array[rows[0]]
+
+        if isinstance(line, shapely.LineString) and not line.is_empty:
+            shape, written = get_shape(line, cache_folder, grid_meters)
+            return project_points(shape, line, xy[rows]), written
+
+        return shapely.line_locate_point(line, shapely.points(xy[rows])), False
+
+    groups = np.split(order, group_starts[1:]) if len(order) > 0 else []
+    n_threads = geo_threads.get_n_threads(n_threads)
+
+    if n_threads <= 1 or len(groups) <= 1:
+        results = [project_group(rows) for rows in groups]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as pool:
+            results = list(pool.map(project_group, groups))
+
+    meters = np.full(len(line_array), np.nan)
+    any_written = False
+
+    for rows, (group_meters, written) in zip(groups, results):
+        meters[rows] = group_meters
+        any_written |= written
+
+    if any_written:
+        evict(cache_folder, max_bytes)
+
+    return meters
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    import partridge_gtfs_wrangling
+    from update_vars import PARTRIDGE_FOLDER
+
+    stop_times, stops, trips, shapes = partridge_gtfs_wrangling.read_partridge_tables("LADOT")
+
+    gdf = partridge_gtfs_wrangling.merge_stop_times_trips_shapes_stops(
+        stop_times,
+        stops,
+        trips[["trip_instance_key", "shape_id", "shape_array_key"]],
+        shapes[["shape_array_key", "geometry"]],
+        stop_group = ["schedule_gtfs_dataset_key", "stop_id"],
+        trip_group = ["trip_instance_key"],
+        shape_group = ["shape_array_key"]
+    )
+
+    lines = gpd.GeoSeries(gdf.shape_geometry)
+    print(f"{len(gdf)} stop_times rows, {shapes.shape_array_key.nunique()} shapes "
+          f"from {PARTRIDGE_FOLDER}LADOT")
+
+    start = datetime.datetime.now()
+    expected = geo_threads.project(lines, gdf.geometry, n_threads=1)
+    end = datetime.datetime.now()
+    print(f"shapely: {end - start}")
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        cache_folder = f"{tmp_folder}/"
+
+        for run in ["cold cache", "warm cache"]:
+            # A new run starts without any entries opened
+            open_shape_entry.cache_clear()
+
+            start = datetime.datetime.now()
+            result = project(lines, gdf.geometry, gdf[["shape_array_key"]], cache_folder)
+            end = datetime.datetime.now()
+
+            print(f"{run}: {end - start}, "
+                  f"max abs diff: {np.nanmax(np.abs(result - expected)):.2e} meters")
@@ -0,0 +1,133 @@
+"""
+Shape-progress QA for stop_times_direction.
+
+Based on stop_meters, the stop's position projected against the shape,
+check whether each trip's stops progress monotonically along the shape.
+Trips that jump backwards are loopy or inlining shapes, and those are
+the ones the nearest neighbor method is for.
+
+Everything runs on flat arrays sorted once by trip and stop_sequence:
+one np.diff over stop_meters, with the diffs across trip boundaries masked out.
+"""
+import datetime
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import group_kernels
+import schema
+from update_vars import OUTPUT_FOLDER
+
+TRIP_COLS = ["schedule_gtfs_dataset_key", "trip_id", "shape_id"]
+
+# If the first and last stop are this close (meters), the trip is a loop
+LOOP_METERS = 150
+
+def shape_progress_qa(
+    gdf: gpd.GeoDataFrame,
+    trip_cols: list = TRIP_COLS,
+    loop_meters: float = LOOP_METERS
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Returns 2 tables:
+    1. trip grain:
+    - is_monotonic: every stop_meters is greater than the prior stop's
+    - n_backward_jumps: how many stops are behind the prior stop
+    - max_backward_meters: largest backward jump
+    - first_backward_stop_sequence: where the first backward jump happens
+    - is_loop: first and last stop are within loop_meters of each other
+    - has_repeated_stop: a stop_id is visited more than once (out-and-back)
+    2. backward jumps: 1 row per stop that's behind the prior stop.
+    """
+    order, is_trip_start, _ = group_kernels.sort_groups(
+        gdf, trip_cols, ["stop_sequence"]
+    )
+
+    stop_meters = gdf.stop_meters.to_numpy()[order]
+    stop_sequence = gdf.stop_sequence.to_numpy()[order]
+
+    diffs = np.diff(stop_meters, prepend=np.nan)
+    diffs[is_trip_start] = np.nan
+
+    starts = np.flatnonzero(is_trip_start)
+    ends = np.append(starts[1:], len(order)) - 1
+    trip_num = np.cumsum(is_trip_start) - 1
+
+    is_backward = diffs <= 0  # NaN compares False, so trip starts are excluded
+    n_backward = np.bincount(trip_num[is_backward], minlength=len(starts))
+
+    backward_meters = np.where(is_backward, -diffs, 0)
+    max_backward = np.maximum.reduceat(backward_meters, starts)
+
+    # First backward jump in each trip: the smallest sorted position per trip
+    first_backward_pos = np.full(len(starts), len(order), dtype="int64")
+    np.minimum.at(first_backward_pos, trip_num[is_backward], np.flatnonzero(is_backward))
+    first_backward_seq = np.where(
+        n_backward > 0,
+        stop_sequence[np.minimum(first_backward_pos, len(order) - 1)],
+        -1
+    )
+
+    geometry = gdf.geometry.to_numpy()[order]
+    is_loop = (
+        gpd.GeoSeries(geometry[starts], crs=gdf.crs).distance(
+            gpd.GeoSeries(geometry[ends], crs=gdf.crs)
+        ).to_numpy() <= loop_meters
+    ) & (ends > starts)
+
+    stop_col = "stop_id1" if "stop_id1" in gdf.columns else "stop_id"
+    stop_codes = pd.factorize(gdf[stop_col])[0][order]
+    n_unique_stops = np.bincount(
+        np.unique(schema.pair_key(trip_num, stop_codes)) >> 32,
+        minlength=len(starts)
+    )
+
+    trip_df = gdf[trip_cols].iloc[order[starts]].reset_index(drop=True)
+
+    trip_df = trip_df.assign(
+        n_stops = (ends - starts + 1).astype("int32"),
+        is_monotonic = n_backward == 0,
+        n_backward_jumps = n_backward.astype("int32"),
+        max_backward_meters = max_backward,
+        first_backward_stop_sequence = first_backward_seq.astype("int32"),
+        is_loop = is_loop,
+        has_repeated_stop = n_unique_stops < (ends - starts + 1),
+    )
+
+    jumps_df = gdf[trip_cols + ["stop_sequence", "stop_meters"]].iloc[
+        order[is_backward]
+    ].reset_index(drop=True).assign(
+        backward_meters = -diffs[is_backward]
+    )
+
+    return trip_df, jumps_df
+
+
+def trips_for_neighbor_stage(
+    qa_df: pd.DataFrame,
+    trip_cols: list = TRIP_COLS
+) -> pd.DataFrame:
+    """
+    Trips whose stops don't progress monotonically along the shape
+    are the ones that need the nearest neighbor method.
+    """
+    return qa_df[~qa_df.is_monotonic][trip_cols].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+
+    start = datetime.datetime.now()
+
+    gdf = gpd.read_parquet(
+        f"{OUTPUT_FOLDER}stop_times_direction.parquet",
+        columns = TRIP_COLS + ["stop_id1", "stop_sequence", "stop_meters", "geometry"]
+    )
+
+    qa_df, jumps_df = shape_progress_qa(gdf)
+
+    qa_df.to_parquet(f"{OUTPUT_FOLDER}shape_progress_qa.parquet")
+    jumps_df.to_parquet(f"{OUTPUT_FOLDER}shape_progress_backward_jumps.parquet")
+
+    end = datetime.datetime.now()
+    print(f"trips: {len(qa_df)}, not monotonic: {(~qa_df.is_monotonic).sum()}")
+    print(f"execution time: {end - start}")
@@ -0,0 +1,276 @@
+"""
+Roll up segment speeds from enforce_monotonicity_calculate_speeds
+into small tables that dashboards and maps can read directly.
+
+3 levels, nested within each other:
+- operator
+- route_direction: operator + route_id + direction_id
+- segment: route_direction + stop_id1 + stop_id2
+
+We sort once by all the grouping columns (and speed_mph last),
+and every level's groups are contiguous slices of that same sort order.
+Sums come from np.add.reduceat over the slice starts, and
+percentiles at the segment grain are read off by position.
+"""
+import geopandas as gpd
+import numpy as np
+import os
+import pandas as pd
+
+import schema
+import utils
+from update_vars import OUTPUT_FOLDER, ROLLUP_FOLDER
+
+ROLLUP_LEVELS = {
+    "operator": ["service_date", "schedule_gtfs_dataset_key"],
+    "route_direction": [
+        "service_date", "schedule_gtfs_dataset_key", "route_id", "direction_id"
+    ],
+    "segment": [
+        "service_date", "schedule_gtfs_dataset_key", "route_id", "direction_id",
+        "stop_id1", "stop_id2"
+    ],
+}
+
+PERCENTILES = [20, 50, 80]
+
+def attach_route_info(
+    speed_gdf: gpd.GeoDataFrame,
+    folder_path: str = OUTPUT_FOLDER,
+    route_cols: list = ["route_id", "direction_id"]
+) -> gpd.GeoDataFrame:
+    """
+    Speeds don't carry route info, bring it in from trips.
+    """
+    missing_cols = [c for c in route_cols if c not in speed_gdf.columns]
+
+    if len(missing_cols) == 0:
+        return speed_gdf
+
+    trips = pd.read_parquet(
+        f"{folder_path}trips.parquet",
+        columns = ["trip_instance_key"] + missing_cols
+    ).drop_duplicates("trip_instance_key")
+
+    trips = trips.astype({
+        "trip_instance_key": speed_gdf.trip_instance_key.dtype
+    })
+
+    return pd.merge(
+        speed_gdf,
+        trips,
+        on = "trip_instance_key",
+        how = "left"
+    )
+
+
+def valid_speeds(speed_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Keep segments where speed could be calculated.
+    """
+    return speed_gdf[
+        (speed_gdf.speed_mph.notna()) &
+        (np.isfinite(speed_gdf.speed_mph)) &
+        (speed_gdf.speed_mph > 0) &
+        (speed_gdf.sec_elapsed > 0)
+    ].reset_index(drop=True)
+
+
+def sorted_group_codes(
+    df: pd.DataFrame,
+    group_cols: list,
+    value_col: str = "speed_mph"
+) -> tuple[np.ndarray, dict]:
+    """
+    Factorize each grouping column into integer codes and
+    get the one sort order shared by every rollup level
+    (value_col is the last sort key, so values are sorted within the finest grain).
+    Returns the sort order and the codes (already in sorted order).
+    """
+    codes = {
+        c: pd.factorize(df[c], sort=True)[0]
+        for c in group_cols
+    }
+
+    # np.lexsort uses the last key as the primary key
+    order = np.lexsort(
+        [df[value_col].to_numpy()] + [codes[c] for c in reversed(group_cols)]
+    )
+
+    return order, {c: code[order] for c, code in codes.items()}
+
+
+def level_starts(
+    sorted_codes: dict,
+    level_cols: list
+) -> np.ndarray:
+    """
+    Positions (in sorted order) where a new group starts for this level.
+    """
+    n = len(next(iter(sorted_codes.values())))
+    is_start = np.zeros(n, dtype=bool)
+
+    if n == 0:
+        return np.flatnonzero(is_start)
+
+    is_start[0] = True
+
+    for c in level_cols:
+        is_start[1:] |= (sorted_codes[c][1:] != sorted_codes[c][:-1])
+
+    return np.flatnonzero(is_start)
+
+
+def count_unique_per_group(
+    starts: np.ndarray,
+    sorted_values: np.ndarray,
+) -> np.ndarray:
+    """
+    Number of unique values (like trips) within each group.
+    Pack (group, value) into one int64 and count uniques per group.
+    """
+    group_id = np.zeros(len(sorted_values), dtype="int64")
+    group_id[starts[1:]] = 1
+    group_id = np.cumsum(group_id)
+
+    unique_pairs = np.unique(schema.pair_key(group_id, sorted_values))
+
+    return np.bincount(unique_pairs >> 32, minlength=len(starts))
+
+
+def rollup_speeds(
+    speed_gdf: gpd.GeoDataFrame,
+    levels: dict = ROLLUP_LEVELS,
+    percentiles: list = PERCENTILES
+) -> dict:
+    """
+    Compute every rollup level from a single sort.
+
+    For each group:
+    - n_obs: number of trip-segment speeds
+    - n_trips: number of unique trips
+    - avg_speed_mph: total meters / total seconds (weighted by time spent)
+    - mean_speed_mph: simple average of trip-segment speeds
+    - p20/p50/p80_speed_mph: segment grain only, read off the sorted speeds
+    """
+    gdf = valid_speeds(speed_gdf)
+
+    finest_cols = max(levels.values(), key=len)
+    order, sorted_codes = sorted_group_codes(gdf, finest_cols, "speed_mph")
+
+    speed = gdf.speed_mph.to_numpy()[order]
+    meters = gdf.meters_elapsed.to_numpy()[order]
+    sec = gdf.sec_elapsed.to_numpy()[order]
+    trip_codes = pd.factorize(gdf.trip_instance_key)[0][order]
+
+    results = {}
+
+    for level, level_cols in levels.items():
+        starts = level_starts(sorted_codes, level_cols)
+
+        if len(starts) == 0:
+            results[level] = gdf[level_cols].iloc[0:0]
+            continue
+
+        n_obs = np.diff(np.append(starts, len(speed)))
+
+        df = gdf[level_cols].iloc[order[starts]].reset_index(drop=True)
+
+        df = df.assign(
+            n_obs = n_obs,
+            n_trips = count_unique_per_group(starts, trip_codes),
+            avg_speed_mph = utils.calculate_speed(
+                np.add.reduceat(meters, starts),
+                np.add.reduceat(sec, starts)
+            ),
+            mean_speed_mph = np.add.reduceat(speed, starts) / n_obs,
+        )
+
+        # Speeds are sorted within the finest grain only
+        if level_cols == finest_cols:
+            df = df.assign(**{
+                f"p{p}_speed_mph": speed[starts + ((n_obs - 1) * p // 100)]
+                for p in percentiles
+            })
+
+            if "segment_geometry" in gdf.columns:
+                df = gpd.GeoDataFrame(
+                    df,
+                    geometry = gdf.segment_geometry.iloc[order[starts]].to_numpy(),
+                    crs = gdf.segment_geometry.crs
+                ).rename_geometry("segment_geometry")
+
+        results[level] = utils.add_operator_name(df)
+
+    return results
+
+
+def write_partitioned(
+    df: pd.DataFrame,
+    path: str,
+    partition_cols: list = ["service_date", "operator_name"]
+):
+    """
+    Write hive-style partitions (path/service_date=.../operator_name=.../).
+    GeoDataFrame.to_parquet doesn't take partition_cols,
+    so write each partition as its own file.
+    """
+    df = df.assign(
+        operator_name = df.operator_name.astype(object).fillna(
+            df.schedule_gtfs_dataset_key.astype(str)
+        )
+    )
+    
+    if pd.api.types.is_datetime64_any_dtype(df.service_date):
+        df = df.assign(service_date = df.service_date.dt.strftime("%Y-%m-%d"))
+
+    for partition_values, part_df in df.groupby(partition_cols, observed=True):
+        partition_path = "/".join(
+            f"{c}={v}" for c, v in zip(partition_cols, partition_values)
+        )
+        part_folder = f"{path}/{partition_path}"
+        os.makedirs(part_folder, exist_ok=True)
+
+        part_df.drop(columns = partition_cols).to_parquet(
+            f"{part_folder}/part-0.parquet"
+        )
+
+    return
+
+
+def write_speed_rollups(
+    speed_gdf: gpd.GeoDataFrame,
+    output_folder: str = ROLLUP_FOLDER,
+    folder_path: str = OUTPUT_FOLDER
+) -> dict:
+    """
+    Attach route info, compute all rollup levels,
+    and write each one as a partitioned parquet table:
+    {output_folder}{level}_speeds/.
+    """
+    speed_gdf = attach_route_info(speed_gdf, folder_path)
+
+    results = rollup_speeds(speed_gdf)
+
+    for level, df in results.items():
+        write_partitioned(df, f"{output_folder}{level}_speeds")
+
+    return results
+
+
+def read_speed_rollup(
+    level: str = "segment",
+    output_folder: str = ROLLUP_FOLDER,
+    **kwargs
+) -> pd.DataFrame:
+    """
+    Read a rollup level back in.
+    filters can be used on the partition columns,
+    ex: filters = [[("operator_name", "==", "LADOT")]].
+    """
+    path = f"{output_folder}{level}_speeds"
+
+    if level == "segment":
+        return gpd.read_parquet(path, **kwargs)
+
+    return pd.read_parquet(path, **kwargs)
@@ -0,0 +1,499 @@
+"""
+Local HTTP/JSON service for querying segment speeds.
+
+Load the speeds (output of enforce_monotonicity_calculate_speeds) once,
+and keep each column as a numpy array. Queries don't scan the table:
+- sorted indexes on operator, route_id, stop pair and time bin:
+rows are sorted by the column's codes once, so a value's rows are
+one slice of that sort order (found with searchsorted)
+- a grid index on segment bounding boxes, so a bbox query
+only checks segments in the grid cells it touches
+Responses are cached (LRU) by the normalized query.
+
+GET /speeds?operator=LADOT&route_id=2&start_hour=7&end_hour=9
+GET /speeds?bbox=-118.30,34.03,-118.25,34.06   (WGS84 minx,miny,maxx,maxy)
+GET /speeds?stop_id1=123&stop_id2=456
+Returns 1 row per stop pair with n_obs, n_trips, avg_speed_mph, p50_speed_mph.
+
+Benchmark with a local load generator:
+python speed_service.py --bench
+"""
+import argparse
+import concurrent.futures
+import datetime
+import functools
+import geopandas as gpd
+import http.server
+import json
+import numpy as np
+import pandas as pd
+import pyproj
+import shapely
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import speed_rollups
+import utils
+from update_vars import PROJECT_CRS, WGS84, analysis_date
+
+TIME_BIN_SEC = 3_600
+
+# Grid cell size (meters in PROJECT_CRS) for the spatial index
+GRID_METERS = 1_000
+
+CACHE_SIZE = 1_024
+
+INDEX_COLS = ["schedule_gtfs_dataset_key", "route_id", "stop_pair", "time_bin"]
+
+class SortedIndex:
+    """
+    Rows sorted by a column's codes. Rows for code k are
+    order[starts[k]: starts[k + 1]].
+    """
+    def __init__(self, values: np.ndarray):
+        self.codes, uniques = pd.factorize(values, sort=True)
+        self.values = np.asarray(uniques)
+        self.lookup = {v: i for i, v in enumerate(self.values)}
+        self.order = np.argsort(self.codes, kind="stable")
+        self.starts = np.searchsorted(
+            self.codes[self.order], np.arange(len(uniques) + 1)
+        )
+
+    def rows(self, value) -> np.ndarray:
+        code = self.lookup.get(value)
+        if code is None:
+            return np.zeros(0, dtype="int64")
+        return self.order[self.starts[code]: self.starts[code + 1]]
+
+    def rows_between(self, low, high) -> np.ndarray:
+        """
+        Rows where low <= value < high (codes are sorted like the values).
+        """
+        lo = np.searchsorted(self.values, low, side="left")
+        hi = np.searchsorted(self.values, high, side="left")
+        return self.order[self.starts[lo]: self.starts[hi]]
+
+
+class GridIndex:
+    """
+    Each segment is listed in every grid cell its bounding box covers.
+    """
+    def __init__(self, bounds: np.ndarray, cell_size: float = GRID_METERS):
+        self.bounds = bounds
+        self.cell_size = cell_size
+
+        has_bounds = np.isfinite(bounds).all(axis=1)
+        rows = np.flatnonzero(has_bounds)
+        cells = np.floor(bounds[has_bounds] / cell_size).astype("int64")
+        self.origin = cells[:, :2].min(axis=0) if len(rows) else np.zeros(2, "int64")
+        self.n_cols = int(cells[:, 2].max() - self.origin[0] + 1) if len(rows) else 1
+        self.n_rows = int(cells[:, 3].max() - self.origin[1] + 1) if len(rows) else 1
+
+        # Expand each segment to all the cells in its bbox
+        nx = cells[:, 2] - cells[:, 0] + 1
+        ny = cells[:, 3] - cells[:, 1] + 1
+        n_cells = nx * ny
+        seg = np.repeat(np.arange(len(rows)), n_cells)
+        k = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+
+        cell_x = cells[seg, 0] + k % nx[seg] - self.origin[0]
+        cell_y = cells[seg, 1] + k // nx[seg] - self.origin[1]
+
+        self.index = SortedIndex(cell_y * self.n_cols + cell_x)
+        self.cell_rows = rows[seg]
+
+    def query(self, minx, miny, maxx, maxy) -> np.ndarray:
+        x0, y0, x1, y1 = (
+            np.floor(np.array([minx, miny, maxx, maxy]) / self.cell_size).astype("int64")
+            - np.array([*self.origin, *self.origin])
+        )
+        x0, x1 = max(x0, 0), min(x1, self.n_cols - 1)
+        y0, y1 = max(y0, 0), min(y1, self.n_rows - 1)
+
+        candidates = [
+            self.cell_rows[self.index.rows(y * self.n_cols + x)]
+            for y in range(y0, y1 + 1)
+            for x in range(x0, x1 + 1)
+        ]
+
+        if not candidates:
+            return np.zeros(0, dtype="int64")
+
+        rows = np.unique(np.concatenate(candidates))
+        b = self.bounds[rows]
+
+        # Keep segments whose bbox actually overlaps the query bbox
+        overlaps = (b[:, 0] <= maxx) & (b[:, 2] >= minx) & (b[:, 1] <= maxy) & (b[:, 3] >= miny)
+
+        return rows[overlaps]
+
+
+class SpeedIndex:
+    """
+    Columnar speeds with the sorted and grid indexes.
+    """
+    def __init__(
+        self,
+        speed_gdf: gpd.GeoDataFrame,
+        time_bin_sec: int = TIME_BIN_SEC,
+        grid_meters: float = GRID_METERS
+    ):
+        gdf = speed_rollups.valid_speeds(speed_gdf)
+
+        self.time_bin_sec = time_bin_sec
+        self.stop_id1 = gdf.stop_id1.astype(str).to_numpy()
+        self.stop_id2 = gdf.stop_id2.astype(str).to_numpy()
+        self.speed = gdf.speed_mph.to_numpy()
+        self.meters = gdf.meters_elapsed.to_numpy()
+        self.sec = gdf.sec_elapsed.to_numpy()
+        self.trip_codes = pd.factorize(gdf.trip_instance_key)[0]
+
+        columns = {
+            "schedule_gtfs_dataset_key": gdf.schedule_gtfs_dataset_key.astype(str).to_numpy(),
+            "route_id": (gdf.route_id.astype(str).to_numpy()
+                         if "route_id" in gdf.columns else np.full(len(gdf), "")),
+            "stop_pair": self.stop_id1 + "__" + self.stop_id2,
+            "time_bin": (gdf.arrival_time_sec.to_numpy() // time_bin_sec).astype("int64"),
+        }
+        self.indexes = {c: SortedIndex(v) for c, v in columns.items()}
+
+        segment_geometry = gpd.GeoSeries(gdf.segment_geometry).to_crs(PROJECT_CRS)
+        self.grid = GridIndex(shapely.bounds(segment_geometry.to_numpy()), grid_meters)
+        self.to_project_crs = pyproj.Transformer.from_crs(WGS84, PROJECT_CRS, always_xy=True)
+        # pyproj sets up the transformer again (~15 ms) the first time
+        # each thread uses it, and the server starts a thread per request,
+        # so all transforms run on 1 long-lived thread
+        self.transform_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.n_rows = len(gdf)
+
+    def query_rows(
+        self,
+        operator: str = None,
+        route_id: str = None,
+        stop_id1: str = None,
+        stop_id2: str = None,
+        start_hour: float = None,
+        end_hour: float = None,
+        bbox: tuple = None,
+    ) -> np.ndarray:
+        """
+        Get rows from each index that's used, and intersect them
+        starting from the smallest set.
+        """
+        row_sets = []
+
+        if operator is not None:
+            name_to_key = {v: k for k, v in utils.OPERATOR_NAMES_DICT.items()}
+            row_sets.append(self.indexes["schedule_gtfs_dataset_key"].rows(
+                name_to_key.get(operator, operator)))
+
+        if route_id is not None:
+            row_sets.append(self.indexes["route_id"].rows(route_id))
+
+        if stop_id1 is not None and stop_id2 is not None:
+            row_sets.append(self.indexes["stop_pair"].rows(f"{stop_id1}__{stop_id2}"))
+        elif stop_id1 is not None or stop_id2 is not None:
+            raise ValueError("stop_id1 and stop_id2 are used together")
+
+        if start_hour is not None or end_hour is not None:
+            start_bin = int((start_hour or 0) * 3_600 // self.time_bin_sec)
+            end_bin = int(np.ceil((end_hour if end_hour is not None else 48)
+                                  * 3_600 / self.time_bin_sec))
+            row_sets.append(self.indexes["time_bin"].rows_between(start_bin, end_bin))
+
+        if bbox is not None:
+            # The projected bbox of the WGS84 bbox's edges, not just its 2 corners
+            minx, miny, maxx, maxy = self.transform_thread.submit(
+                self.to_project_crs.transform_bounds, *bbox).result()
+            row_sets.append(self.grid.query(minx, miny, maxx, maxy))
+
+        if not row_sets:
+            return np.arange(self.n_rows)
+
+        row_sets = sorted(row_sets, key=len)
+        rows = np.sort(row_sets[0])
+
+        for other in row_sets[1:]:
+            rows = rows[np.isin(rows, other, assume_unique=True)]
+
+        return rows
+
+    def summarize(self, rows: np.ndarray) -> list:
+        """
+        1 dict per stop pair for the rows.
+        """
+        if len(rows) == 0:
+            return []
+
+        pair_index = self.indexes["stop_pair"]
+        pair_codes = pair_index.codes[rows]
+
+        # Sort by stop pair, then speed, to read off medians by position
+        order = np.lexsort([self.speed[rows], pair_codes])
+        rows, pair_codes = rows[order], pair_codes[order]
+
+        is_start = np.ones(len(rows), dtype=bool)
+        is_start[1:] = pair_codes[1:] != pair_codes[:-1]
+        starts = np.flatnonzero(is_start)
+        n_obs = np.diff(np.append(starts, len(rows)))
+
+        avg_speed = utils.calculate_speed(
+            np.add.reduceat(self.meters[rows], starts),
+            np.add.reduceat(self.sec[rows], starts)
+        )
+        p50_speed = self.speed[rows][starts + (n_obs - 1) // 2]
+        n_trips = speed_rollups.count_unique_per_group(starts, self.trip_codes[rows])
+
+        return [
+            {
+                "stop_id1": self.stop_id1[rows[s]],
+                "stop_id2": self.stop_id2[rows[s]],
+                "n_obs": int(n),
+                "n_trips": int(t),
+                "avg_speed_mph": round(float(a), 2),
+                "p50_speed_mph": round(float(p), 2),
+            }
+            for s, n, t, a, p in zip(starts, n_obs, n_trips, avg_speed, p50_speed)
+        ]
+
+
+QUERY_PARAMS = {
+    "operator": str,
+    "route_id": str,
+    "stop_id1": str,
+    "stop_id2": str,
+    "start_hour": float,
+    "end_hour": float,
+    "bbox": lambda x: tuple(float(v) for v in x.split(",")),
+}
+
+def parse_query(query_string: str) -> tuple:
+    """
+    Normalize the query string into a sorted tuple of (param, value),
+    which is also the cache key.
+    """
+    params = urllib.parse.parse_qs(query_string)
+    unknown = set(params) - set(QUERY_PARAMS)
+
+    if unknown:
+        raise ValueError(f"unknown parameters: {sorted(unknown)}")
+
+    parsed = tuple(sorted(
+        (k, QUERY_PARAMS[k](v[-1])) for k, v in params.items()
+    ))
+
+    if any(k == "bbox" and len(v) != 4 for k, v in parsed):
+        raise ValueError("bbox is minx,miny,maxx,maxy")
+
+    return parsed
+
+
+def make_query_handler(
+    speed_index: SpeedIndex,
+    cache_size: int = CACHE_SIZE
+):
+    """
+    Returns a function from the normalized query to the JSON response bytes,
+    with an LRU cache in front of it.
+    """
+    @functools.lru_cache(maxsize=cache_size)
+    def respond(query: tuple) -> bytes:
+        rows = speed_index.query_rows(**dict(query))
+        segments = speed_index.summarize(rows)
+
+        return json.dumps({
+            "query": dict(query),
+            "n_obs": int(len(rows)),
+            "segments": segments,
+        }).encode()
+
+    return respond
+
+
+class SpeedRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /speeds?... returns the JSON summary, GET /health returns the row count.
+    """
+    # Headers and body are separate writes, so without TCP_NODELAY
+    # the body can wait on the client's delayed ACK (~40 ms)
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, respond, n_rows: int, **kwargs):
+        self.respond = respond
+        self.n_rows = n_rows
+        super().__init__(*args, **kwargs)
+
+    def send_json(self, status: int, content: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+
+        if url.path == "/health":
+            self.send_json(200, json.dumps({"n_rows": self.n_rows}).encode())
+            return
+
+        if url.path != "/speeds":
+            self.send_error(404)
+            return
+
+        try:
+            content = self.respond(parse_query(url.query))
+        except (ValueError, TypeError) as e:
+            self.send_json(400, json.dumps({"error": str(e)}).encode())
+            return
+        except Exception as e:
+            self.send_json(500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode())
+            return
+
+        self.send_json(200, content)
+
+    def log_message(self, format, *args):
+        return
+
+
+class SpeedServer(http.server.ThreadingHTTPServer):
+    """
+    The default listen backlog (5) drops connections under concurrent load,
+    and a dropped SYN is retried after ~1 second.
+    """
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve_speeds(
+    speed_gdf: gpd.GeoDataFrame,
+    port: int = 8050,
+    cache_size: int = CACHE_SIZE,
+) -> tuple[SpeedServer, str]:
+    """
+    Build the indexes and start the service in a background thread.
+    Returns the server (call server.shutdown() when done) and its base url.
+    """
+    speed_gdf = speed_rollups.attach_route_info(speed_gdf)
+    speed_index = SpeedIndex(speed_gdf)
+
+    handler = functools.partial(
+        SpeedRequestHandler,
+        respond = make_query_handler(speed_index, cache_size),
+        n_rows = speed_index.n_rows
+    )
+
+    server = SpeedServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def sample_queries(
+    speed_gdf: gpd.GeoDataFrame,
+    n_queries: int = 200,
+    seed: int = 0
+) -> list:
+    """
+    A mix of route + time window, stop pair, and bbox queries
+    drawn from values in the data.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(speed_gdf), n_queries)
+    bounds = gpd.GeoSeries(speed_gdf.segment_geometry).to_crs(WGS84).bounds.to_numpy()
+
+    queries = []
+
+    for i, row in enumerate(rows):
+        r = speed_gdf.iloc[row]
+
+        if i % 3 == 0:
+            hour = int(rng.integers(5, 20))
+            params = {
+                "operator": r.schedule_gtfs_dataset_key,
+                "route_id": r.get("route_id", ""),
+                "start_hour": hour, "end_hour": hour + 2
+            }
+        elif i % 3 == 1:
+            params = {"stop_id1": r.stop_id1, "stop_id2": r.stop_id2}
+        else:
+            minx, miny, maxx, maxy = bounds[row]
+            params = {"bbox": f"{minx - 0.01},{miny - 0.01},{maxx + 0.01},{maxy + 0.01}"}
+
+        queries.append(f"speeds?{urllib.parse.urlencode(params)}")
+
+    return queries
+
+
+def fetch_latencies(base_url: str, queries: list) -> list:
+    """
+    Send the queries one at a time, and return each latency in milliseconds.
+    """
+    latencies = []
+
+    for query in queries:
+        start = time.perf_counter()
+        with urllib.request.urlopen(f"{base_url}{query}") as response:
+            response.read()
+        latencies.append((time.perf_counter() - start) * 1_000)
+
+    return latencies
+
+
+def benchmark(
+    base_url: str,
+    queries: list,
+    n_requests: int = 2_000,
+    concurrency: int = 8
+) -> dict:
+    """
+    Send n_requests (cycling through queries) from concurrency client processes,
+    and report latency percentiles in milliseconds.
+    Clients run in their own processes so they don't compete with
+    the server's threads for the GIL.
+    """
+    requests = [queries[i % len(queries)] for i in range(n_requests)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=concurrency) as pool:
+        # Start the workers before timing
+        list(pool.map(fetch_latencies, [base_url] * concurrency, [[]] * concurrency))
+
+        start = time.perf_counter()
+        latencies = np.concatenate(list(pool.map(
+            fetch_latencies,
+            [base_url] * concurrency,
+            [requests[i::concurrency] for i in range(concurrency)]
+        )))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "n_requests": n_requests,
+        "requests_per_sec": round(n_requests / elapsed, 1),
+        **{f"p{p}_ms": round(float(np.percentile(latencies, p)), 2) for p in [50, 90, 99]},
+    }
+
+
+if __name__ == "__main__":
+    import backfill
+
+    parser = argparse.ArgumentParser(description="Serve segment speeds over HTTP.")
+    parser.add_argument("--date", default=analysis_date)
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--bench", action="store_true",
+                        help="run the load generator against the service and exit")
+    args = parser.parse_args()
+
+    start = datetime.datetime.now()
+    speed_gdf = backfill.read_backfill("speeds", args.date, args.date)
+
+    server, base_url = serve_speeds(speed_gdf, port = 0 if args.bench else args.port)
+    print(f"{len(speed_gdf)} speeds loaded in {datetime.datetime.now() - start}, serving {base_url}")
+
+    if args.bench:
+        print(benchmark(base_url, sample_queries(speed_rollups.attach_route_info(speed_gdf))))
+        server.shutdown()
+    else:
+        threading.Event().wait()
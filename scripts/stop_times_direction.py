@@ -3,6 +3,7 @@ import geopandas as gpd
 import pandas as pd
 
 import create_table
+import geo_io
 from update_vars import OUTPUT_FOLDER, PROJECT_CRS
 
 if __name__ == "__main__":
@@ -14,7 +15,7 @@ if __name__ == "__main__":
         folder_path = OUTPUT_FOLDER,
     )
     
-    gdf.to_parquet(f"{OUTPUT_FOLDER}stop_times_direction.parquet")    
+    geo_io.write_geoparquet(gdf, f"{OUTPUT_FOLDER}stop_times_direction.parquet")    
     
     end = datetime.datetime.now()
     print(f"execution time: {end - start}")
\ No newline at end of file
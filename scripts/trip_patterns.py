@@ -0,0 +1,195 @@
+"""
+Trip patterns for stop_times.
+
+Many trips in a day share the same shape_id and the same ordered stop_ids.
+Projecting stops against the shape, getting the stop's primary direction,
+and the next stop_id are the same for all of them.
+
+A trip's pattern_key is a hash of (shape_id, ordered stop_ids).
+If there are many operators or service_dates, the shape columns should include
+those too, since shape_id alone isn't unique.
+We run stop_times_preprocessing on 1 representative trip per pattern,
+and broadcast the stop-level attributes back to every trip
+with an integer gather: pattern offset + the stop's rank within the trip.
+
+The same split is used to store stop_times_direction:
+split_pattern_stops keeps 1 row per pattern stop and 1 row per trip,
+and join_pattern_stops puts them back together with stop_times.
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import group_kernels
+
+# Stop-level attributes that depend only on the pattern
+PATTERN_STOP_COLS = [
+    "stop_primary_direction", "stop_meters", "stop_id2", "subseq_stop_meters"
+]
+
+def add_pattern_key(
+    gdf: gpd.GeoDataFrame,
+    trip_group: list = ["trip_id"],
+    shape_group: list = ["shape_id"],
+    stop_col: str = "stop_id",
+    order_col: str = "stop_sequence"
+) -> gpd.GeoDataFrame:
+    """
+    Add pattern_key (int32, same for trips sharing shape and ordered stops)
+    and stop_rank (int32, 0-based position of the stop within its trip).
+
+    Each row hashes (stop_id, stop_rank), so the trip hash
+    (the wrapping uint64 sum of its rows) depends on stop order.
+    Combine that with the shape_group columns and the number of stops 
+    for the pattern hash.
+    """
+    order, is_trip_start, _ = group_kernels.sort_groups(
+        gdf, trip_group, [order_col]
+    )
+
+    starts = np.flatnonzero(is_trip_start)
+    trip_num = np.cumsum(is_trip_start) - 1
+    stop_rank = np.arange(len(order)) - starts[trip_num]
+
+    row_hash = pd.util.hash_pandas_object(
+        pd.DataFrame({
+            "stop": gdf[stop_col].astype(str).to_numpy()[order],
+            "rank": stop_rank
+        }),
+        index=False
+    ).to_numpy()
+
+    trip_hash = pd.util.hash_pandas_object(
+        pd.DataFrame({
+            "stops": np.add.reduceat(row_hash, starts),
+            "n_stops": np.diff(np.append(starts, len(order))),
+            **{c: gdf[c].astype(str).to_numpy()[order[starts]] for c in shape_group}
+        }),
+        index=False
+    ).to_numpy()
+
+    trip_pattern = pd.factorize(trip_hash)[0].astype("int32")
+
+    # Scatter from sorted order back to the gdf's row order
+    pattern_key = np.empty(len(order), dtype="int32")
+    pattern_key[order] = trip_pattern[trip_num]
+
+    rank = np.empty(len(order), dtype="int32")
+    rank[order] = stop_rank
+
+    return gdf.assign(
+        pattern_key = pattern_key,
+        stop_rank = rank
+    )
+
+
+def representative_trips(
+    gdf: gpd.GeoDataFrame,
+    trip_group: list = ["trip_id"],
+) -> gpd.GeoDataFrame:
+    """
+    Keep the rows for the first trip of every pattern.
+    gdf needs pattern_key (see add_pattern_key).
+    """
+    trips = gdf[trip_group + ["pattern_key"]].drop_duplicates(trip_group)
+    first_trips = trips.drop_duplicates("pattern_key")
+
+    return pd.merge(
+        gdf,
+        first_trips[trip_group],
+        on = trip_group,
+        how = "inner"
+    ).sort_values(["pattern_key", "stop_rank"]).reset_index(drop=True)
+
+
+def broadcast_pattern_stops(
+    gdf: gpd.GeoDataFrame,
+    pattern_stops: pd.DataFrame,
+    pattern_cols: list = PATTERN_STOP_COLS
+) -> gpd.GeoDataFrame:
+    """
+    pattern_stops is sorted by pattern_key, stop_rank
+    with every stop of every pattern, so the row holding a trip's stop is
+    pattern_offset[pattern_key] + stop_rank.
+    """
+    pattern_stops = pattern_stops.sort_values(
+        ["pattern_key", "stop_rank"]
+    ).reset_index(drop=True)
+
+    n_patterns = pattern_stops.pattern_key.max() + 1
+    offsets = np.searchsorted(
+        pattern_stops.pattern_key.to_numpy(), np.arange(n_patterns)
+    )
+
+    idx = offsets[gdf.pattern_key.to_numpy()] + gdf.stop_rank.to_numpy()
+
+    return gdf.assign(**{
+        c: pattern_stops[c].iloc[idx].set_axis(gdf.index)
+        for c in pattern_cols
+    })
+
+
+def split_pattern_stops(
+    gdf: gpd.GeoDataFrame,
+    trip_cols: list,
+    pattern_cols: list,
+    trip_group: list = ["trip_id"],
+) -> tuple[gpd.GeoDataFrame, pd.DataFrame]:
+    """
+    From preprocessed stop_times (with pattern_key and stop_rank),
+    keep the pattern_cols once per pattern stop,
+    and the trip_cols and pattern_key once per trip.
+    """
+    pattern_stops = representative_trips(gdf, trip_group)[
+        ["pattern_key", "stop_rank"] + pattern_cols
+    ]
+
+    trips = gdf[trip_cols + ["pattern_key"]].drop_duplicates(
+        trip_group
+    ).reset_index(drop=True)
+
+    return pattern_stops, trips
+
+
+def join_pattern_stops(
+    stop_times: pd.DataFrame,
+    trips: pd.DataFrame,
+    pattern_stops: gpd.GeoDataFrame,
+    trip_group: list = ["trip_id"],
+    order_col: str = "stop_sequence"
+) -> gpd.GeoDataFrame:
+    """
+    Undo split_pattern_stops: attach each stop_time's trip (and pattern),
+    rank its stops, and gather the pattern stop columns.
+    Only stop_times for trips in trips are kept.
+    """
+    gdf = pd.merge(
+        stop_times,
+        trips,
+        on = trip_group,
+        how = "inner"
+    )
+
+    order, is_trip_start, _ = group_kernels.sort_groups(
+        gdf, trip_group, [order_col]
+    )
+    gdf = gdf.iloc[order].reset_index(drop=True)
+
+    starts = np.flatnonzero(is_trip_start)
+    trip_num = np.cumsum(is_trip_start) - 1
+
+    gdf = gdf.assign(
+        stop_rank = (np.arange(len(gdf)) - starts[trip_num]).astype("int32")
+    )
+
+    gdf = broadcast_pattern_stops(
+        gdf,
+        pattern_stops,
+        pattern_cols = [
+            c for c in pattern_stops.columns if c not in ["pattern_key", "stop_rank"]
+        ]
+    )
+
+    return gpd.GeoDataFrame(
+        gdf, geometry = pattern_stops.geometry.name, crs = pattern_stops.crs
+    )
@@ -0,0 +1,654 @@
+"""
+Live arrival predictions, published as a GTFS-RT TripUpdates feed.
+
+The pipeline only gets arrival times after the service day is over,
+but the same pieces can predict arrivals while trips are running:
+- stop_meters for every trip's stops (stop_times_direction stage)
+- each vp projected against its trip's shape, and arrivals at the stops
+it passed interpolated between the vp before and after (like neighbor.py)
+- historical speeds by stop pair (stop_id1, stop_id2) from past speeds
+
+PredictionEngine keeps every trip's stops as flat arrays, sorted by trip and
+stop_sequence, along with the seconds it historically takes to get
+from the trip's first stop to each stop (cum_sec).
+Active trips have a small TripState. On each new vp for a trip:
+- the trip's progress (vp_meters) moves forward (never back)
+- stops between the prior and new vp_meters get an observed arrival
+- the remaining stops are predicted: the time to the next stop at the current
+segment's historical speed, plus the cum_sec difference after that.
+Times are seconds since the service day started, like arrival_time_sec.
+
+A trip's TripUpdate entity is serialized when the trip is updated.
+Serialized protobuf messages merge when they're concatenated,
+so the feed is the header's bytes plus every active trip's entity bytes.
+
+Replay a recorded vp parquet (from gtfs_rt_ingest, or vp.parquet) as a stream:
+python trip_updates.py --replay ../sample_data/vp_rt/
+Run against the live RT_FEEDS:
+python trip_updates.py --output ../sample_data/trip_updates.pb
+"""
+import argparse
+import asyncio
+import datetime
+import geopandas as gpd
+import numpy as np
+import os
+import pandas as pd
+import pyproj
+import shapely
+import time
+
+import group_kernels
+import gtfs_rt_ingest
+import speed_rollups
+import utils
+from update_vars import OUTPUT_FOLDER, PROJECT_CRS, RT_FEEDS, analysis_date
+
+DEFAULT_SPEED_MPH = 10
+
+# A vp that would put the bus further along than this is snapped
+# to the wrong part of the shape (ex: loops), and is skipped
+MAX_SPEED_MPH = 70
+HISTORY_DAYS = 14
+
+# Trips without a new vp for this long are dropped from the feed
+TRIP_TIMEOUT_SEC = 30 * 60
+
+REPLAY_BATCH_SEC = gtfs_rt_ingest.POLL_INTERVAL_SEC
+HORIZON_BINS_MIN = [0, 5, 10, 20, 30, 60, 180]
+
+SPEED_LEVELS = {
+    "operator": ["schedule_gtfs_dataset_key"],
+    "stop_pair": ["schedule_gtfs_dataset_key", "stop_id1", "stop_id2"],
+}
+
+def historical_speeds(speed_gdf: pd.DataFrame) -> pd.DataFrame:
+    """
+    Average speed (total meters / total seconds) by operator and stop pair,
+    across every date in speed_gdf (output of enforce_monotonicity_calculate_speeds).
+    Operator averages are used for stop pairs we haven't seen.
+    """
+    rollups = speed_rollups.rollup_speeds(
+        speed_gdf, levels = SPEED_LEVELS, percentiles = []
+    )
+
+    pair_cols = SPEED_LEVELS["stop_pair"]
+
+    stop_pair_speeds = rollups["stop_pair"].astype(
+        {c: str for c in pair_cols}
+    )[pair_cols + ["avg_speed_mph"]]
+
+    operator_speeds = rollups["operator"].astype(
+        {"schedule_gtfs_dataset_key": str}
+    ).assign(stop_id1 = np.nan, stop_id2 = np.nan)[pair_cols + ["avg_speed_mph"]]
+
+    # Operator rows have no stop pair
+    return pd.concat(
+        [stop_pair_speeds, operator_speeds], axis=0, ignore_index=True
+    )
+
+
+class TripState:
+    """
+    What we know about 1 active trip: its last vp (in seconds since
+    the service day started, and meters along the shape),
+    and the first stop it hasn't passed yet.
+    """
+    __slots__ = ("vehicle_id", "last_sec", "last_meters", "next_stop")
+
+    def __init__(self, vehicle_id: str):
+        self.vehicle_id = vehicle_id
+        self.last_sec = -np.inf
+        self.last_meters = -np.inf
+        self.next_stop = 0
+
+
+class PredictionEngine:
+    """
+    Predict arrivals for active trips from a stream of vp.
+
+    stop_times: projected stop_times (stop_times_direction stage) with
+    schedule_gtfs_dataset_key, service_date, trip_instance_key, trip_id,
+    shape_id, stop_id1, stop_sequence, stop_meters.
+    shapes: shape_id (and schedule_gtfs_dataset_key) with geometry.
+    speeds: output of historical_speeds.
+    If record is True, every prediction is kept for evaluate_predictions.
+    """
+    def __init__(
+        self,
+        stop_times: pd.DataFrame,
+        shapes: gpd.GeoDataFrame,
+        speeds: pd.DataFrame = None,
+        crs: str = PROJECT_CRS,
+        default_speed_mph: float = DEFAULT_SPEED_MPH,
+        trip_timeout_sec: float = TRIP_TIMEOUT_SEC,
+        max_speed_mph: float = MAX_SPEED_MPH,
+        record: bool = False
+    ):
+        key_cols = ["schedule_gtfs_dataset_key", "trip_instance_key", "trip_id", "shape_id", "stop_id1"]
+
+        stop_times = stop_times.assign(**{
+            c: stop_times[c].astype(str) for c in key_cols
+        })
+
+        order, is_trip_start, _ = group_kernels.sort_groups(
+            stop_times, ["trip_instance_key"], ["stop_sequence"]
+        )
+        df = stop_times.iloc[order].reset_index(drop=True)
+
+        trip_starts = np.flatnonzero(is_trip_start)
+        trip_num = np.cumsum(is_trip_start) - 1
+        is_trip_end = np.append(is_trip_start[1:], True)
+
+        # stop_meters can dip on loops or noisy shapes,
+        # progress along the trip only counts the running max
+        stop_meters = df.stop_meters.to_numpy().astype("float64")
+        offset = np.nanmax(np.abs(stop_meters), initial=0) * 2 + 1
+        progress_meters = np.maximum.accumulate(
+            np.nan_to_num(stop_meters) + trip_num * offset
+        ) - trip_num * offset
+
+        next_stop_id = np.append(df.stop_id1.to_numpy()[1:], None)
+        next_stop_id[is_trip_end] = None
+
+        df = df.assign(stop_id2 = next_stop_id)
+
+        # Historical speed for the segment that starts at each stop
+        if speeds is None:
+            speed_mph = np.full(len(df), np.nan)
+        else:
+            pair_cols = SPEED_LEVELS["stop_pair"]
+            is_pair = speeds.stop_id1.notna()
+
+            operator_speed_mph = df.schedule_gtfs_dataset_key.map(
+                speeds[~is_pair].set_index("schedule_gtfs_dataset_key").avg_speed_mph
+            )
+
+            speed_mph = pd.merge(
+                df[pair_cols].astype(str),
+                speeds[is_pair],
+                on = pair_cols,
+                how = "left"
+            ).avg_speed_mph.fillna(operator_speed_mph).to_numpy().astype("float64")
+
+        speed_mph = np.where(
+            np.isfinite(speed_mph) & (speed_mph > 0), speed_mph, default_speed_mph)
+        self.speed_mps = speed_mph / utils.MPH_PER_MPS
+
+        segment_sec = np.zeros(len(df))
+        segment_sec[:-1] = np.diff(progress_meters) / self.speed_mps[:-1]
+        segment_sec[is_trip_end] = 0
+
+        # Seconds from the trip's first stop
+        cum_sec = np.cumsum(segment_sec) - segment_sec
+        self.cum_sec = cum_sec - cum_sec[trip_starts][trip_num]
+
+        self.progress_meters = progress_meters
+        self.stop_sequence = df.stop_sequence.to_numpy().astype("int64")
+        self.stop_id = df.stop_id1.to_numpy()
+        self.observed_sec = np.full(len(df), np.nan)
+
+        # 1 row per trip
+        trips = df.iloc[trip_starts].reset_index(drop=True)
+        shape_cols = [
+            c for c in ["schedule_gtfs_dataset_key", "shape_id"] if c in shapes.columns
+        ]
+
+        trip_lines = pd.merge(
+            trips[shape_cols],
+            shapes.to_crs(crs).assign(**{c: shapes[c].astype(str) for c in shape_cols})[
+                shape_cols + ["geometry"]].drop_duplicates(shape_cols),
+            on = shape_cols,
+            how = "left"
+        ).geometry
+
+        service_date = pd.to_datetime(trips.service_date)
+
+        self.trip_lookup = dict(zip(trips.trip_instance_key, range(len(trips))))
+        self.trip_keys = trips.trip_instance_key.to_numpy()
+        self.trip_ids = trips.trip_id.to_numpy()
+        self.trip_start_dates = service_date.dt.strftime("%Y%m%d").to_numpy()
+        self.trip_service_dates = service_date.to_numpy()
+        self.trip_lines = np.asarray(trip_lines.to_numpy())
+        self.trip_bounds = np.column_stack([
+            trip_starts, np.append(trip_starts[1:], len(df))
+        ])
+        self.service_day_epoch = (
+            service_date.dt.tz_localize(gtfs_rt_ingest.LOCAL_TIMEZONE)
+            - pd.Timestamp(0, tz="UTC")
+        ).dt.total_seconds().to_numpy().astype("int64")
+
+        self.crs = pyproj.CRS(crs)
+        self.transformers = {}
+        self.trip_timeout_sec = trip_timeout_sec
+        self.max_speed_mps = max_speed_mph / utils.MPH_PER_MPS
+
+        self.states = {}
+        self.entities = {}
+        self.finished = set()
+        self.now_epoch = 0
+
+        self.record = record
+        self.prediction_log = []
+
+    def to_engine_xy(self, vp: gpd.GeoDataFrame) -> np.ndarray:
+        """
+        vp coordinates in the engine's crs (a transformer is kept per input crs).
+        """
+        xy = shapely.get_coordinates(vp.geometry.to_numpy())
+
+        if vp.crs is None or pyproj.CRS(vp.crs) == self.crs:
+            return xy
+
+        key = pyproj.CRS(vp.crs).to_string()
+
+        if key not in self.transformers:
+            self.transformers[key] = pyproj.Transformer.from_crs(
+                vp.crs, self.crs, always_xy=True)
+
+        return np.column_stack(self.transformers[key].transform(xy[:, 0], xy[:, 1]))
+
+    def update(self, vp: gpd.GeoDataFrame) -> int:
+        """
+        Take a batch of new vp (trip_instance_key, location_timestamp_local,
+        geometry, and vehicle_id if present), in any order.
+        Projection against shapes and timestamps are done for the whole batch,
+        then each vp updates its trip's state in timestamp order.
+        Returns the number of vp that updated a trip.
+        """
+        trip_num = vp.trip_instance_key.astype(str).map(self.trip_lookup)
+        vp = vp[trip_num.notna()]
+        trip_num = trip_num[trip_num.notna()].to_numpy().astype("int64")
+
+        if len(vp) == 0:
+            return 0
+
+        location_sec = utils.seconds_since_service_day(
+            vp.location_timestamp_local.reset_index(drop=True),
+            pd.Series(self.trip_service_dates[trip_num])
+        )
+
+        vp_meters = shapely.line_locate_point(
+            self.trip_lines[trip_num], shapely.points(self.to_engine_xy(vp))
+        )
+
+        vehicle_id = (
+            vp.vehicle_id.astype(str).to_numpy() if "vehicle_id" in vp.columns
+            else np.full(len(vp), "")
+        )
+
+        n_updated = 0
+
+        for i in np.argsort(location_sec, kind="stable"):
+            n_updated += self.update_trip(
+                trip_num[i], vehicle_id[i], location_sec[i], vp_meters[i])
+
+        self.expire_trips()
+
+        return n_updated
+
+    def update_trip(
+        self,
+        trip_num: int,
+        vehicle_id: str,
+        sec: float,
+        meters: float
+    ) -> bool:
+        """
+        Move 1 trip forward to a new vp, and predict its remaining stops.
+        """
+        if trip_num in self.finished:
+            return False
+
+        state = self.states.get(trip_num)
+        is_first = state is None
+
+        if is_first:
+            state = TripState(vehicle_id)
+
+        if sec <= state.last_sec or np.isnan(meters):
+            return False
+
+        if (
+            not is_first and
+            (meters - state.last_meters) / (sec - state.last_sec) > self.max_speed_mps
+        ):
+            return False
+
+        start, end = self.trip_bounds[trip_num]
+        progress_meters = self.progress_meters[start:end]
+
+        meters = max(meters, state.last_meters)
+        next_stop = int(np.searchsorted(progress_meters, meters, side="right"))
+
+        if is_first:
+            # On loops, the first and last stops are in the same place,
+            # so a trip's first vp can't finish it
+            if next_stop == end - start:
+                return False
+
+            self.states[trip_num] = state
+
+        # Stops passed since the last vp, interpolated between the 2 vp
+        if next_stop > state.next_stop and not is_first:
+            passed = slice(state.next_stop, next_stop)
+            fraction = (
+                (progress_meters[passed] - state.last_meters)
+                / (meters - state.last_meters)
+            )
+            self.observed_sec[start + state.next_stop: start + next_stop] = (
+                state.last_sec + fraction * (sec - state.last_sec)
+            )
+
+        state.vehicle_id = vehicle_id or state.vehicle_id
+        state.last_sec = sec
+        state.last_meters = meters
+        state.next_stop = next_stop
+
+        self.now_epoch = max(self.now_epoch, self.service_day_epoch[trip_num] + sec)
+
+        if next_stop == end - start:
+            # Trip is done, later vp (ex: at the layover) are ignored
+            del self.states[trip_num]
+            self.finished.add(trip_num)
+            self.entities.pop(trip_num, None)
+            return True
+
+        rows = slice(start + next_stop, end)
+        segment = start + max(next_stop - 1, 0)
+
+        to_next_stop = max(progress_meters[next_stop] - meters, 0) / self.speed_mps[segment]
+        predicted_sec = sec + to_next_stop + (self.cum_sec[rows] - self.cum_sec[rows.start])
+
+        self.entities[trip_num] = self.trip_update_entity(trip_num, state, rows, predicted_sec)
+
+        if self.record:
+            self.prediction_log.append((rows.start, predicted_sec, sec))
+
+        return True
+
+    def trip_update_entity(
+        self,
+        trip_num: int,
+        state: TripState,
+        rows: slice,
+        predicted_sec: np.ndarray
+    ) -> bytes:
+        """
+        A FeedMessage with just this trip's TripUpdate entity, serialized
+        (without the header, which feed adds).
+        """
+        from google.transit import gtfs_realtime_pb2
+
+        service_day_epoch = self.service_day_epoch[trip_num]
+
+        message = gtfs_realtime_pb2.FeedMessage()
+        entity = message.entity.add()
+        entity.id = self.trip_keys[trip_num]
+
+        trip_update = entity.trip_update
+        trip_update.trip.trip_id = self.trip_ids[trip_num]
+        trip_update.trip.start_date = self.trip_start_dates[trip_num]
+        trip_update.timestamp = int(service_day_epoch + state.last_sec)
+
+        if state.vehicle_id:
+            trip_update.vehicle.id = state.vehicle_id
+
+        arrival_epoch = (service_day_epoch + np.round(predicted_sec)).astype("int64")
+
+        for stop_sequence, stop_id, arrival in zip(
+            self.stop_sequence[rows].tolist(),
+            self.stop_id[rows].tolist(),
+            arrival_epoch.tolist()
+        ):
+            stop_time_update = trip_update.stop_time_update.add()
+            stop_time_update.stop_sequence = stop_sequence
+            stop_time_update.stop_id = stop_id
+            stop_time_update.arrival.time = arrival
+
+        return message.SerializePartialToString()
+
+    def expire_trips(self):
+        """
+        Drop trips that haven't had a vp in trip_timeout_sec.
+        """
+        expired = [
+            t for t, state in self.states.items()
+            if self.service_day_epoch[t] + state.last_sec < self.now_epoch - self.trip_timeout_sec
+        ]
+
+        for t in expired:
+            del self.states[t]
+            self.entities.pop(t, None)
+
+        return
+
+    def feed(self) -> bytes:
+        """
+        The TripUpdates FeedMessage for every active trip, serialized.
+        """
+        from google.transit import gtfs_realtime_pb2
+
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.header.gtfs_realtime_version = "2.0"
+        message.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        message.header.timestamp = int(self.now_epoch)
+
+        return message.SerializeToString() + b"".join(self.entities.values())
+
+
+def write_feed(content: bytes, output_path: str):
+    """
+    Replace the feed file in 1 step, so readers never get a partial feed.
+    """
+    tmp_path = f"{output_path}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+
+    os.replace(tmp_path, output_path)
+
+    return
+
+
+def evaluate_predictions(
+    engine: PredictionEngine,
+    horizon_bins_min: list = HORIZON_BINS_MIN
+) -> pd.DataFrame:
+    """
+    For an engine run with record=True, compare every prediction against the
+    arrival we observed later, by how far ahead the prediction was made.
+    """
+    rows, predicted_sec, made_sec = [], [], []
+
+    for start, predicted, sec in engine.prediction_log:
+        rows.append(np.arange(start, start + len(predicted)))
+        predicted_sec.append(predicted)
+        made_sec.append(np.full(len(predicted), sec))
+
+    rows = np.concatenate(rows)
+    observed_sec = engine.observed_sec[rows]
+    made_sec = np.concatenate(made_sec)
+
+    df = pd.DataFrame({
+        "horizon_min": (observed_sec - made_sec) / 60,
+        "error_sec": np.concatenate(predicted_sec) - observed_sec,
+    }).dropna()
+
+    df = df.assign(
+        horizon = pd.cut(df.horizon_min, horizon_bins_min),
+        abs_error_sec = df.error_sec.abs()
+    )
+
+    return df.groupby("horizon", observed=True).agg(
+        n = ("error_sec", "size"),
+        mean_error_sec = ("error_sec", "mean"),
+        mean_abs_error_sec = ("abs_error_sec", "mean"),
+        p90_abs_error_sec = ("abs_error_sec", lambda x: x.quantile(0.9)),
+    ).reset_index()
+
+
+def replay_vp(
+    engine: PredictionEngine,
+    vp: gpd.GeoDataFrame,
+    batch_sec: float = REPLAY_BATCH_SEC,
+    output_path: str = None
+) -> pd.DataFrame:
+    """
+    Play back recorded vp in timestamp order, batch_sec of vp at a time
+    (like polling a feed), updating the engine and building the feed after each batch.
+    Returns 1 row per batch with n_vp, n_active_trips,
+    update_ms, feed_ms and feed_bytes.
+    """
+    vp = vp.sort_values("location_timestamp_local", kind="stable").reset_index(drop=True)
+
+    elapsed_sec = (
+        vp.location_timestamp_local - vp.location_timestamp_local.iloc[0]
+    ).dt.total_seconds().to_numpy()
+    batch_starts = np.flatnonzero(np.diff(elapsed_sec // batch_sec, prepend=-1))
+
+    results = []
+
+    for batch_start, batch_end in zip(batch_starts, np.append(batch_starts[1:], len(vp))):
+        batch = vp.iloc[batch_start: batch_end]
+
+        t0 = time.perf_counter()
+        engine.update(batch)
+        t1 = time.perf_counter()
+        content = engine.feed()
+        t2 = time.perf_counter()
+
+        if output_path is not None:
+            write_feed(content, output_path)
+
+        results.append({
+            "location_timestamp_local": batch.location_timestamp_local.iloc[0],
+            "n_vp": len(batch),
+            "n_active_trips": len(engine.states),
+            "update_ms": (t1 - t0) * 1_000,
+            "feed_ms": (t2 - t1) * 1_000,
+            "feed_bytes": len(content),
+        })
+
+    return pd.DataFrame(results)
+
+
+async def run_live(
+    engine: PredictionEngine,
+    output_path: str,
+    feeds: dict = RT_FEEDS,
+    trip_key_lookup: pd.DataFrame = None,
+    interval: int = gtfs_rt_ingest.POLL_INTERVAL_SEC,
+    duration_sec: float = None
+):
+    """
+    Poll the VehiclePositions feeds (see gtfs_rt_ingest), and every second,
+    update the engine with new vp and rewrite the TripUpdates feed at output_path.
+    """
+    buffer = gtfs_rt_ingest.VehiclePositionBuffer()
+    stop_event = asyncio.Event()
+    stats = {"polls": 0, "rows": 0, "errors": 0}
+
+    async def predict():
+        while not stop_event.is_set():
+            rows = buffer.drain()
+
+            if len(rows) > 0:
+                await asyncio.to_thread(
+                    lambda: engine.update(gtfs_rt_ingest.rows_to_vp(rows, trip_key_lookup))
+                )
+                write_feed(engine.feed(), output_path)
+
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout = 1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop_after():
+        if duration_sec is not None:
+            await asyncio.sleep(duration_sec)
+            stop_event.set()
+
+    await asyncio.gather(
+        *[
+            gtfs_rt_ingest.poll_feed(key, url, buffer, stop_event, interval, stats)
+            for key, url in feeds.items()
+        ],
+        predict(),
+        stop_after()
+    )
+
+    return stats
+
+
+def load_engine(
+    service_date: str = analysis_date,
+    history_days: int = HISTORY_DAYS,
+    folder_path: str = OUTPUT_FOLDER,
+    **kwargs
+) -> PredictionEngine:
+    """
+    Build the engine from the pipeline's outputs: stop_times_direction
+    for service_date, and speeds from the history_days before it.
+    """
+    import backfill
+    import create_table
+
+    stop_times = backfill.read_backfill(
+        "stop_times_direction", service_date, service_date)
+
+    history_end = pd.Timestamp(service_date) - pd.Timedelta(days=1)
+
+    try:
+        speeds = historical_speeds(backfill.read_backfill(
+            "speeds",
+            history_end - pd.Timedelta(days=history_days - 1),
+            history_end
+        ))
+    except (FileNotFoundError, ValueError):
+        # No speeds yet, use DEFAULT_SPEED_MPH
+        speeds = None
+
+    shapes = create_table.get_calitp_table(
+        "shapes",
+        folder_path = folder_path,
+        columns = ["schedule_gtfs_dataset_key", "shape_id", "geometry"]
+    )
+
+    return PredictionEngine(stop_times, shapes, speeds, **kwargs)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Predict arrivals as a GTFS-RT TripUpdates feed.")
+    parser.add_argument("--date", default=analysis_date)
+    parser.add_argument("--replay", default=None,
+                        help="recorded vp parquet to play back instead of polling feeds")
+    parser.add_argument("--output", default=f"{OUTPUT_FOLDER}trip_updates.pb")
+    parser.add_argument("--duration", type=float, default=None)
+    args = parser.parse_args()
+
+    start = datetime.datetime.now()
+    engine = load_engine(args.date, record = args.replay is not None)
+    print(f"{len(engine.trip_keys)} trips loaded in {datetime.datetime.now() - start}")
+
+    if args.replay is not None:
+        vp = gpd.read_parquet(args.replay)
+
+        batches = replay_vp(engine, vp, output_path = args.output)
+        per_vp_ms = (batches.update_ms.sum() / batches.n_vp.sum())
+
+        print(f"{batches.n_vp.sum()} vp in {len(batches)} batches, "
+              f"{per_vp_ms:.3f} ms per vp, max active trips {batches.n_active_trips.max()}")
+        print(batches[["n_vp", "update_ms", "feed_ms", "feed_bytes"]].describe(
+            percentiles = [0.5, 0.9, 0.99]).round(2))
+        print(evaluate_predictions(engine))
+
+    else:
+        stats = asyncio.run(run_live(
+            engine,
+            args.output,
+            trip_key_lookup = gtfs_rt_ingest.get_trip_key_lookup(),
+            duration_sec = args.duration
+        ))
+        print(stats)
@@ -1,11 +1,23 @@
 INPUT_FOLDER = "../full_data/"
 OUTPUT_FOLDER = "../sample_data/"
 PARTRIDGE_FOLDER = "../partridge_data/"
+ROLLUP_FOLDER = "../sample_data/rollups/"
+PIPELINE_FOLDER = "../sample_data/pipeline/"
 
 analysis_date = "2024-10-16"
 
 PROJECT_CRS = "EPSG:3310"
 WGS84 = "EPSG:4326"
 
+# Threads for bulk shapely / pyproj operations (see geo_threads.py), None uses every CPU
+GEO_THREADS = None
+
+# Per-shape arrays reused across runs (see shape_cache.py), None turns the cache off.
+# The folder is in .gitignore.
+SHAPE_CACHE_FOLDER = "../sample_data/shape_cache/"
+
 operators_list = ["LADOT", "Big Blue Bus"]
-gtfs_tables_list = ["trips", "shapes", "stops", "stop_times", "stop_times_direction", "vp"] 
+
+# GTFS-RT VehiclePositions feeds to ingest, {schedule_gtfs_dataset_key: url}
+RT_FEEDS = {}
+gtfs_tables_list = ["trips", "shapes", "stops", "stop_times", "stop_times_direction", "vp", "vp_rt"] 
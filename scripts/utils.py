@@ -1,17 +1,16 @@
 """
 Utility functions
+
+Keep this module light: it's imported by every pipeline stage.
+Plotting helpers live in compare_utils.
 """
-import folium
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import shapely
 
-from typing import Literal, Union
-
-import create_table
-from update_vars import (OUTPUT_FOLDER, PROJECT_CRS, WGS84,
-                         gtfs_tables_list)
+import shape_qa
+from update_vars import OUTPUT_FOLDER
 
 MPH_PER_MPS = 2.237  # use to convert meters/second to miles/hour
 
@@ -42,7 +41,7 @@ def condense_by_trip(
     """
     orig_crs = df.crs.to_epsg()
     
-    atleast2_rows = (df.groupby(group_cols)
+    atleast2_rows = (df.groupby(group_cols, observed=True)
                      .agg({geometry_col: "count"})
                      .reset_index()
                      .query(f"{geometry_col} > 1")
@@ -60,7 +59,7 @@ def condense_by_trip(
     df2 = (
         df
         .sort_values(sort_cols)
-        .groupby(group_cols)
+        .groupby(group_cols, observed=True)
         .agg({
             geometry_col: lambda x: shapely.LineString(list(x)),
             **{c: lambda x: list(x) for c in array_cols}
@@ -116,54 +115,53 @@ def scheduled_and_vp_trips() -> list:
     return list(set(scheduled_trips).intersection(rt_trips))
 
 
-def plot_vp_shape_stops(
-    vp: gpd.GeoDataFrame,
-    shapes: gpd.GeoDataFrame,
-    stops: gpd.GeoDataFrame,
-    vp_as_line: bool = True
-) -> folium.Map:
-    """
-    vp: raw vp that's long will get condensed into a linestring path
-    shapes: shapes linestring
-    stops: any stop gdf, either stops or stop_times_direction
-    """    
-    if vp_as_line:
-        vp_condensed = condense_by_trip(
-            vp.to_crs(WGS84),
-            group_cols = ["trip_id"],
-            sort_cols = ["trip_id", "location_timestamp_local"],
-            geometry_col = "geometry",
-            array_cols = ["location_timestamp_local"]
-        )
-    else:
-        vp_condensed = vp.to_crs(WGS84)
+def calculate_speed(meters_elapsed: float, sec_elapsed: float) -> float:
+    """
+    Convert meters and seconds elapsed into speed_mph.
+    """
+    return meters_elapsed / sec_elapsed * MPH_PER_MPS
 
-    m = vp_condensed.drop(columns = "location_timestamp_local").explore(
-        vp_condensed.index,
-        tiles = "CartoDB Positron", 
-        categorical=True, legend=False, name = "vp"
-    )
 
-    m = stops.to_crs(WGS84).explore(
-        "stop_sequence", m=m, categorical=True, legend=False,
-        name="stops"
-    )
+def seconds_since_service_day(
+    timestamps: pd.Series,
+    service_date: pd.Series
+) -> np.ndarray:
+    """
+    Seconds since the start (local midnight) of the service day.
+    Trips that run past midnight keep counting up (1 am the next day is 90_000),
+    the same way GTFS arrival times do.
+    Timestamps are local wall clock time.
+    Returned as float64, so a missing timestamp or service_date is NaN.
+    """
+    if getattr(timestamps.dt, "tz", None) is not None:
+        timestamps = timestamps.dt.tz_localize(None)
 
-    m = shapes[["shape_id", "geometry"]].to_crs(WGS84).explore(
-        "shape_id", color = "orange", name="Shape",
-        m=m
-    )
+    timestamps = timestamps.to_numpy().astype("datetime64[ns]")
+    service_day_start = pd.to_datetime(service_date).to_numpy().astype("datetime64[ns]")
 
-    folium.LayerControl().add_to(m)
+    is_missing = np.isnat(timestamps) | np.isnat(service_day_start)
 
-    return m
+    delta = timestamps - service_day_start
+    delta[is_missing] = np.timedelta64(0, "ns")
 
+    sec = (delta // np.timedelta64(1, "s")).astype("float64")
+    sec[is_missing] = np.nan
 
-def calculate_speed(meters_elapsed: float, sec_elapsed: float) -> float:
+    return sec
+
+
+def seconds_to_timestamp(
+    service_date: pd.Series,
+    sec: np.ndarray
+) -> pd.Series:
     """
-    Convert meters and seconds elapsed into speed_mph.
+    Back from seconds since the service day started to
+    local timestamps (missing seconds are NaT).
     """
-    return meters_elapsed / sec_elapsed * MPH_PER_MPS
+    return (
+        pd.to_datetime(service_date).reset_index(drop=True)
+        + pd.to_timedelta(np.asarray(sec, dtype="float64"), unit="s")
+    ).set_axis(service_date.index)
 
 
 def monotonic_check(arr: np.ndarray) -> bool:
@@ -192,21 +190,12 @@ def monotonic_trips(
     points on the line, because numbers jump around,
     reflecting a pattern in how buses travel on roads,
     which isn't wrong, but we need a method that handles this.
+    
+    See shape_qa.shape_progress_qa for the full QA table
+    (backward jumps, loops, repeated stops).
     """
     trip_cols = ["schedule_gtfs_dataset_key", "trip_id", "shape_id"]
 
-    gdf = (stop_times_gdf
-               .sort_values(trip_cols + ["stop_sequence"])
-               .groupby(trip_cols)
-               .agg({"stop_meters": lambda x: list(x)})
-               .reset_index()
-              )
-
-    gdf = gdf.assign(
-        is_monotonic = gdf.apply(lambda x: monotonic_check(x.stop_meters), axis=1)
-    )[trip_cols + ["is_monotonic"]
-    ].drop_duplicates().reset_index(drop=True)
-
-    return gdf
-
+    qa_df, _ = shape_qa.shape_progress_qa(stop_times_gdf, trip_cols)
 
+    return qa_df[trip_cols + ["is_monotonic"]]
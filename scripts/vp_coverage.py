@@ -0,0 +1,127 @@
+"""
+How well each trip's vp cover its shape.
+
+A trip with a handful of pings, or pings along a small part
+of its shape, or a long gap between pings, leaves most of its
+stops without a vp on both sides, so every stop comes out NaN
+after the neighbor search.
+
+From the projected vp (vp_meters), 1 sort by trip and timestamp gives per trip:
+- n_vp: number of pings
+- shape_coverage: fraction of the shape between the first and last vp_meters
+- max_gap_sec: longest time between consecutive pings
+(with collapsed dwells, from when the prior dwell ended)
+Trips below the thresholds are dropped before vp are merged with stop_times.
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import group_kernels
+
+MIN_N_VP = 5
+MIN_SHAPE_COVERAGE = 0.25
+MAX_GAP_SEC = 15 * 60
+
+def trip_coverage(
+    vp: gpd.GeoDataFrame,
+    trip_cols: list = ["service_date", "trip_instance_key"],
+    meters_col: str = "vp_meters",
+    sec_col: str = "location_sec",
+    moving_sec_col: str = "moving_sec",
+) -> pd.DataFrame:
+    """
+    1 row per trip with n_vp, shape_meters, min / max vp_meters,
+    shape_coverage, and max_gap_sec. vp is the output of vp_preprocessing.
+    If dwells were collapsed, a gap starts when the bus left the prior
+    position (moving_sec_col), not when it got there, so a long dwell
+    doesn't count as missing pings.
+    """
+    order, is_trip_start, _ = group_kernels.sort_groups(
+        vp, trip_cols, [sec_col]
+    )
+    starts = np.flatnonzero(is_trip_start)
+
+    if len(starts) == 0:
+        return pd.DataFrame(columns = trip_cols + [
+            "n_vp", "shape_meters", "min_vp_meters", "max_vp_meters",
+            "shape_coverage", "max_gap_sec"
+        ])
+
+    vp_meters = vp[meters_col].to_numpy().astype("float64")[order]
+    vp_sec = vp[sec_col].to_numpy().astype("float64")[order]
+
+    if moving_sec_col in vp.columns:
+        prior_end_sec = vp[moving_sec_col].to_numpy().astype("float64")[order]
+    else:
+        prior_end_sec = vp_sec
+
+    # Gap since the prior ping (or dwell) ended, 0 for the first ping of a trip
+    gap_sec = np.zeros(len(order))
+    gap_sec[1:] = vp_sec[1:] - prior_end_sec[:-1]
+    gap_sec[is_trip_start] = 0
+
+    trips = vp.iloc[order[starts]][trip_cols].reset_index(drop=True)
+
+    shape_meters = shapely.length(
+        np.asarray(vp.shape_geometry.to_numpy()[order[starts]])
+    )
+    min_meters = np.fmin.reduceat(vp_meters, starts)
+    max_meters = np.fmax.reduceat(vp_meters, starts)
+
+    return trips.assign(
+        n_vp = np.diff(np.append(starts, len(order))),
+        shape_meters = shape_meters,
+        min_vp_meters = min_meters,
+        max_vp_meters = max_meters,
+        shape_coverage = np.clip(
+            np.nan_to_num((max_meters - min_meters) / shape_meters), 0, 1
+        ),
+        max_gap_sec = np.fmax.reduceat(gap_sec, starts),
+    )
+
+
+def flag_usable_trips(
+    coverage: pd.DataFrame,
+    min_n_vp: int = MIN_N_VP,
+    min_shape_coverage: float = MIN_SHAPE_COVERAGE,
+    max_gap_sec: float = MAX_GAP_SEC
+) -> pd.DataFrame:
+    """
+    Add is_usable: trips that meet every threshold.
+    """
+    return coverage.assign(
+        is_usable = (
+            (coverage.n_vp >= min_n_vp) &
+            (coverage.shape_coverage >= min_shape_coverage) &
+            (coverage.max_gap_sec <= max_gap_sec)
+        )
+    )
+
+
+def gate_vp_by_coverage(
+    vp: gpd.GeoDataFrame,
+    trip_cols: list = ["service_date", "trip_instance_key"],
+    coverage_path: str = None,
+    **thresholds
+) -> gpd.GeoDataFrame:
+    """
+    Keep vp for usable trips only.
+    If coverage_path is given, write the coverage table (every trip) there.
+    """
+    coverage = trip_coverage(vp, trip_cols).pipe(
+        flag_usable_trips, **thresholds
+    )
+
+    if coverage_path is not None:
+        coverage.to_parquet(coverage_path)
+
+    usable = coverage[coverage.is_usable][trip_cols]
+
+    return pd.merge(
+        vp,
+        usable,
+        on = trip_cols,
+        how = "inner"
+    )
@@ -0,0 +1,365 @@
+"""
+Trip vp pack: projected vp for a service date, written once
+as flat binary arrays that can be memory-mapped.
+
+stop_times_with_vp_table re-reads, re-projects and re-condenses vp
+on every run. A pack stores the output of vp_projected_table
+sorted by trip and vp_idx, one .bin file per array:
+- x, y, vp_meters (float64): coordinates and position along the shape
+- timestamp (int64 ns): location_timestamp_local
+(and moving_timestamp if dwells were collapsed)
+- direction (int8): vp_primary_direction as codes into DIRECTIONS
+- vp_idx (int64)
+plus index.parquet (1 row per trip, with its offset and n_vp into the arrays),
+shapes.parquet, and meta.json.
+
+Readers np.memmap the arrays and slice [offset: offset + n_vp] per trip,
+so reading a handful of trips, or splitting trips across workers,
+only touches those bytes.
+"""
+import geopandas as gpd
+import json
+import numpy as np
+import os
+import pandas as pd
+import shapely
+
+import group_kernels
+from update_vars import OUTPUT_FOLDER, PROJECT_CRS
+
+VP_PACK_FOLDER = f"{OUTPUT_FOLDER}vp_pack/"
+
+VP_TRIP_COLS = [
+    "service_date", "schedule_gtfs_dataset_key", "trip_instance_key", "trip_id"
+]
+
+DIRECTIONS = ["Northbound", "Southbound", "Eastbound", "Westbound", "Unknown"]
+
+# file name: numpy dtype
+PACK_ARRAYS = {
+    "x": "float64",
+    "y": "float64",
+    "vp_meters": "float64",
+    "timestamp": "int64",
+    "direction": "int8",
+    "vp_idx": "int64",
+}
+
+def pack_folder(
+    service_date: str,
+    folder: str = VP_PACK_FOLDER
+) -> str:
+    return f"{folder}service_date={pd.Timestamp(service_date).date()}/"
+
+
+def timestamps_to_int(series: pd.Series) -> tuple[np.ndarray, str]:
+    """
+    Store timestamps as int64 nanoseconds of local (wall clock) time,
+    and keep the timezone to restore them.
+    """
+    tz = getattr(series.dt, "tz", None)
+
+    if tz is not None:
+        series = series.dt.tz_localize(None)
+
+    return series.astype("datetime64[ns]").to_numpy().view("int64"), (
+        str(tz) if tz is not None else None
+    )
+
+
+def write_vp_pack(
+    vp_projected: gpd.GeoDataFrame,
+    output_folder: str,
+    trip_cols: list = VP_TRIP_COLS,
+) -> pd.DataFrame:
+    """
+    vp_projected is the output of create_table.vp_projected_table
+    for one service date.
+    Sort by trip and vp_idx once, write each column as a flat array,
+    and write the trip index. Returns the trip index.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    order, is_trip_start, _ = group_kernels.sort_groups(
+        vp_projected, trip_cols, ["vp_idx"]
+    )
+    gdf = vp_projected.iloc[order].reset_index(drop=True)
+
+    starts = np.flatnonzero(is_trip_start)
+
+    timestamps, tz = timestamps_to_int(gdf.location_timestamp_local)
+
+    arrays = {
+        "x": gdf.geometry.x.to_numpy(),
+        "y": gdf.geometry.y.to_numpy(),
+        "vp_meters": gdf.vp_meters.to_numpy(),
+        "timestamp": timestamps,
+        "direction": pd.Categorical(
+            gdf.vp_primary_direction, categories=DIRECTIONS
+        ).codes,
+        "vp_idx": gdf.vp_idx.to_numpy(),
+    }
+
+    if "moving_timestamp_local" in gdf.columns:
+        arrays["moving_timestamp"], _ = timestamps_to_int(gdf.moving_timestamp_local)
+
+    for name, values in arrays.items():
+        np.ascontiguousarray(
+            values, dtype=PACK_ARRAYS.get(name, "int64")
+        ).tofile(f"{output_folder}{name}.bin")
+
+    index = gdf[trip_cols + ["shape_id"]].iloc[starts].reset_index(drop=True)
+    index = index.assign(
+        offset = starts.astype("int64"),
+        n_vp = np.diff(np.append(starts, len(gdf))).astype("int64"),
+    )
+    index.to_parquet(f"{output_folder}index.parquet")
+
+    shape_cols = ["schedule_gtfs_dataset_key", "shape_id"]
+    shapes = gpd.GeoDataFrame(
+        gdf[shape_cols + ["shape_geometry"]].drop_duplicates(shape_cols),
+        geometry = "shape_geometry",
+        crs = gdf.crs
+    ).reset_index(drop=True)
+    shapes.to_parquet(f"{output_folder}shapes.parquet")
+
+    with open(f"{output_folder}meta.json", "w") as f:
+        json.dump({
+            "n_vp": len(gdf),
+            "crs": gdf.crs.to_string(),
+            "tz": tz,
+            "arrays": {
+                name: PACK_ARRAYS.get(name, "int64") for name in arrays
+            },
+        }, f)
+
+    return index
+
+
+def open_vp_pack(pack_path: str) -> tuple[pd.DataFrame, dict, dict]:
+    """
+    Returns the trip index, the memory-mapped arrays, and the metadata.
+    Nothing is read from the arrays until they're sliced.
+    """
+    with open(f"{pack_path}meta.json") as f:
+        meta = json.load(f)
+
+    index = pd.read_parquet(f"{pack_path}index.parquet")
+
+    arrays = {
+        name: np.memmap(
+            f"{pack_path}{name}.bin", dtype=dtype, mode="r", shape=(meta["n_vp"],)
+        ) if meta["n_vp"] > 0 else np.zeros(0, dtype=dtype)
+        for name, dtype in meta["arrays"].items()
+    }
+
+    return index, arrays, meta
+
+
+def int_to_timestamps(
+    values: np.ndarray,
+    tz: str = None
+) -> pd.DatetimeIndex:
+    timestamps = pd.DatetimeIndex(np.asarray(values).view("datetime64[ns]"))
+
+    if tz is not None:
+        timestamps = timestamps.tz_localize(tz, ambiguous="NaT", nonexistent="NaT")
+
+    return timestamps
+
+
+def service_day_seconds(
+    timestamps: np.ndarray,
+    service_date: pd.Series
+) -> np.ndarray:
+    """
+    Stored timestamps (int64 ns, wall clock) to seconds
+    since the service day started (see utils.seconds_since_service_day).
+    service_date is aligned with timestamps.
+    Like utils.seconds_since_service_day, this is float64,
+    and NaT timestamps or service dates are NaN.
+    """
+    timestamps = np.asarray(timestamps).astype("int64")
+    service_day_start = (
+        pd.to_datetime(service_date).to_numpy().astype("datetime64[ns]")
+    )
+
+    is_missing = (
+        (timestamps == np.iinfo("int64").min) | np.isnat(service_day_start)
+    )
+
+    sec = (
+        (timestamps - service_day_start.astype("int64")) // 1_000_000_000
+    ).astype("float64")
+    sec[is_missing] = np.nan
+
+    return sec
+
+
+def to_object_array(arrays: list) -> np.ndarray:
+    """
+    1 array per row (like condense_by_trip's list columns).
+    Fill by position so equal-length arrays don't become a 2D array.
+    """
+    values = np.empty(len(arrays), dtype=object)
+
+    for i, arr in enumerate(arrays):
+        values[i] = arr
+
+    return values
+
+
+def gather_trip_rows(
+    index: pd.DataFrame
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    For the trips in index, the positions in the pack arrays
+    and which trip (row in index) each position belongs to.
+    """
+    n_vp = index.n_vp.to_numpy()
+    trip_num = np.repeat(np.arange(len(index)), n_vp)
+
+    # Within-trip position: 0, 1, 2, ... restarting for every trip
+    trip_starts = np.cumsum(n_vp) - n_vp
+    positions = (
+        index.offset.to_numpy()[trip_num]
+        + np.arange(len(trip_num)) - trip_starts[trip_num]
+    )
+
+    return positions, trip_num
+
+
+def read_trips(
+    pack_path: str,
+    trip_instance_keys: list = None,
+) -> gpd.GeoDataFrame:
+    """
+    Read vp rows (1 row per vp) for the selected trips,
+    or all trips if trip_instance_keys is None.
+    """
+    index, arrays, meta = open_vp_pack(pack_path)
+
+    if trip_instance_keys is not None:
+        index = index[index.trip_instance_key.isin(trip_instance_keys)]
+
+    positions, trip_num = gather_trip_rows(index)
+
+    gdf = gpd.GeoDataFrame(
+        index.drop(columns = ["offset", "n_vp"]).iloc[trip_num].reset_index(drop=True),
+        geometry = shapely.points(arrays["x"][positions], arrays["y"][positions]),
+        crs = meta["crs"]
+    ).assign(
+        location_timestamp_local = int_to_timestamps(
+            arrays["timestamp"][positions], meta["tz"]),
+        vp_primary_direction = np.asarray(DIRECTIONS)[arrays["direction"][positions]],
+        vp_meters = arrays["vp_meters"][positions],
+        vp_idx = arrays["vp_idx"][positions],
+    )
+    
+    gdf = gdf.assign(
+        location_sec = service_day_seconds(
+            arrays["timestamp"][positions], gdf.service_date)
+    )
+
+    if "moving_timestamp" in arrays:
+        gdf = gdf.assign(
+            moving_timestamp_local = int_to_timestamps(
+                arrays["moving_timestamp"][positions], meta["tz"]),
+            moving_sec = service_day_seconds(
+                arrays["moving_timestamp"][positions], gdf.service_date)
+        )
+
+    return gdf
+
+
+def condensed_vp_from_pack(
+    pack_path: str,
+    trip_instance_keys: list = None,
+) -> gpd.GeoDataFrame:
+    """
+    Same as the vp_nn table in create_table.stop_times_with_vp_table
+    (utils.condense_by_trip over vp_projected):
+    1 row per trip with a linestring of vp coords, shape_geometry,
+    and arrays of vp_idx, vp_primary_direction and timestamps.
+    Trips with fewer than 2 vp are dropped.
+    Timestamp arrays are local wall clock time (datetime64).
+    location_sec / moving_sec are seconds since the service day started.
+    """
+    index, arrays, meta = open_vp_pack(pack_path)
+
+    index = index[index.n_vp > 1]
+
+    if trip_instance_keys is not None:
+        index = index[index.trip_instance_key.isin(trip_instance_keys)]
+
+    index = index.reset_index(drop=True)
+
+    positions, trip_num = gather_trip_rows(index)
+    splits = np.cumsum(index.n_vp.to_numpy())[:-1]
+
+    geometry = shapely.linestrings(
+        np.column_stack([arrays["x"][positions], arrays["y"][positions]]),
+        indices = trip_num
+    ) if len(index) > 0 else []
+
+    array_cols = {
+        "vp_idx": np.split(np.asarray(arrays["vp_idx"][positions]), splits),
+        "vp_primary_direction": np.split(
+            np.asarray(DIRECTIONS)[arrays["direction"][positions]], splits),
+        "location_timestamp_local": np.split(
+            int_to_timestamps(arrays["timestamp"][positions]).to_numpy(), splits),
+        "location_sec": np.split(
+            service_day_seconds(
+                arrays["timestamp"][positions], index.service_date.iloc[trip_num]),
+            splits),
+    }
+
+    if "moving_timestamp" in arrays:
+        array_cols["moving_timestamp_local"] = np.split(
+            int_to_timestamps(arrays["moving_timestamp"][positions]).to_numpy(),
+            splits
+        )
+        array_cols["moving_sec"] = np.split(
+            service_day_seconds(
+                arrays["moving_timestamp"][positions], index.service_date.iloc[trip_num]),
+            splits
+        )
+
+    shapes = gpd.read_parquet(f"{pack_path}shapes.parquet")
+
+    gdf = gpd.GeoDataFrame(
+        index[["service_date", "trip_instance_key", "schedule_gtfs_dataset_key", "shape_id"]],
+        geometry = geometry,
+        crs = meta["crs"]
+    ).assign(**{
+        c: to_object_array(v if len(index) > 0 else [])
+        for c, v in array_cols.items()
+    })
+
+    gdf = pd.merge(
+        gdf,
+        shapes,
+        on = ["schedule_gtfs_dataset_key", "shape_id"],
+        how = "inner"
+    ).drop(columns = ["schedule_gtfs_dataset_key", "shape_id"])
+
+    return gdf
+
+
+if __name__ == "__main__":
+    import datetime
+    import create_table
+    from update_vars import analysis_date
+
+    start = datetime.datetime.now()
+
+    vp_projected = create_table.vp_projected_table(
+        crs = PROJECT_CRS,
+        folder_path = OUTPUT_FOLDER,
+    )
+
+    index = write_vp_pack(vp_projected, pack_folder(analysis_date))
+
+    end = datetime.datetime.now()
+    print(f"trips: {len(index)}, vp: {index.n_vp.sum()}")
+    print(f"execution time: {end - start}")
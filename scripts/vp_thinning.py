@@ -0,0 +1,227 @@
+"""
+Thin high-frequency vehicle positions before condense_by_trip.
+
+Some operators ping every 1-5 seconds, and between stops most of
+those pings sit on a straight line in (vp_meters, timestamp):
+interpolating between their neighbors gives nearly the same position and time.
+
+Drop pings like that, with Douglas-Peucker on each trip's
+(vp_meters, timestamp) series, vectorized across all trips:
+every round, each span between 2 kept pings keeps its worst ping
+if that ping is off by more than the bound.
+A dropped ping is within max_meters_error of where interpolating
+its kept neighbors puts it at that time, and within max_sec_error
+of when they put it at that position.
+
+Pings that flank a stop (consecutive pings on either side of its stop_meters)
+are always kept, since those are what arrival times are interpolated from.
+
+Compare arrival times with and without thinning:
+python vp_thinning.py
+"""
+import datetime
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import group_kernels
+
+MAX_METERS_ERROR = 15
+MAX_SEC_ERROR = 5
+
+def flanks_stop(
+    trip_code: np.ndarray,
+    vp_meters: np.ndarray,
+    stop_trip_code: np.ndarray,
+    stop_meters: np.ndarray
+) -> np.ndarray:
+    """
+    vp are sorted by trip and timestamp.
+    Flag both pings of every consecutive pair (within a trip)
+    whose vp_meters span 1 of the trip's stops.
+    """
+    # Offset meters by trip, so 1 searchsorted covers all trips
+    offset = max(
+        np.nanmax(np.abs(vp_meters), initial=0),
+        np.nanmax(np.abs(stop_meters), initial=0)
+    ) * 2 + 1
+
+    stop_keys = np.sort(stop_trip_code * offset + stop_meters)
+
+    low = np.minimum(vp_meters[:-1], vp_meters[1:]) + trip_code[:-1] * offset
+    high = np.maximum(vp_meters[:-1], vp_meters[1:]) + trip_code[:-1] * offset
+
+    spans_stop = (
+        (trip_code[:-1] == trip_code[1:]) &
+        (np.searchsorted(stop_keys, high, side="right")
+         > np.searchsorted(stop_keys, low, side="left"))
+    )
+
+    is_flank = np.zeros(len(vp_meters), dtype=bool)
+    is_flank[:-1] |= spans_stop
+    is_flank[1:] |= spans_stop
+
+    return is_flank
+
+
+def interpolation_error(
+    keep: np.ndarray,
+    vp_meters: np.ndarray,
+    vp_sec: np.ndarray,
+    max_meters_error: float = MAX_METERS_ERROR,
+    max_sec_error: float = MAX_SEC_ERROR
+) -> np.ndarray:
+    """
+    For pings that aren't kept, the error of interpolating between
+    the kept pings on either side, as a multiple of the bound
+    (> 1 is over the bound). Kept pings are 0.
+    The first and last ping of every trip must be kept.
+    """
+    n = len(keep)
+    positions = np.arange(n)
+
+    left = np.maximum.accumulate(np.where(keep, positions, 0))
+    right = np.minimum.accumulate(np.where(keep, positions, n - 1)[::-1])[::-1]
+
+    meters_span = vp_meters[right] - vp_meters[left]
+    sec_span = vp_sec[right] - vp_sec[left]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Where interpolating puts the ping at its timestamp
+        time_fraction = np.where(
+            sec_span > 0, (vp_sec - vp_sec[left]) / sec_span, 0)
+        meters_error = np.abs(
+            vp_meters - (vp_meters[left] + time_fraction * meters_span))
+
+        # When interpolating puts the ping at its position
+        meters_fraction = (vp_meters - vp_meters[left]) / meters_span
+        sec_error = np.where(
+            meters_span != 0,
+            np.abs(vp_sec - (vp_sec[left] + meters_fraction * sec_span)),
+            0
+        )
+
+    error = np.maximum(meters_error / max_meters_error, sec_error / max_sec_error)
+
+    return np.where(keep, 0, np.nan_to_num(error, nan=np.inf))
+
+
+def thin_vp(
+    vp: gpd.GeoDataFrame,
+    stops: pd.DataFrame,
+    trip_cols: list = ["service_date", "trip_instance_key"],
+    meters_col: str = "vp_meters",
+    sec_col: str = "location_sec",
+    max_meters_error: float = MAX_METERS_ERROR,
+    max_sec_error: float = MAX_SEC_ERROR
+) -> gpd.GeoDataFrame:
+    """
+    Drop redundant vp (output of vp_preprocessing), keeping
+    each trip's first and last ping, pings that flank a stop
+    (stops has trip_cols and stop_meters), and enough pings to keep
+    interpolation error under max_meters_error and max_sec_error.
+    Kept rows stay in their original order.
+    """
+    if len(vp) == 0:
+        return vp
+
+    # Shared trip codes for vp and stops
+    trip_code = pd.concat(
+        [vp[trip_cols], stops[trip_cols]], axis=0, ignore_index=True
+    ).groupby(trip_cols, observed=True, sort=False).ngroup().to_numpy()
+
+    vp_trip_code = trip_code[:len(vp)]
+    stop_trip_code = trip_code[len(vp):]
+
+    order, is_trip_start, _ = group_kernels.sort_groups(
+        vp.assign(trip_code = vp_trip_code), ["trip_code"], [sec_col]
+    )
+
+    vp_meters = vp[meters_col].to_numpy().astype("float64")[order]
+    vp_sec = vp[sec_col].to_numpy().astype("float64")[order]
+
+    is_trip_end = np.append(is_trip_start[1:], True)
+
+    keep = (
+        is_trip_start | is_trip_end |
+        flanks_stop(
+            vp_trip_code[order],
+            vp_meters,
+            stop_trip_code,
+            stops.stop_meters.to_numpy().astype("float64")
+        )
+    )
+
+    while True:
+        error = interpolation_error(
+            keep, vp_meters, vp_sec, max_meters_error, max_sec_error)
+
+        # Worst ping in each span between kept pings
+        span = np.cumsum(keep) - 1
+        span_starts = np.flatnonzero(keep)
+        worst = np.maximum.reduceat(error, span_starts)[span]
+
+        over = np.flatnonzero((error > 1) & (error == worst))
+
+        if len(over) == 0:
+            break
+
+        # 1 ping per span (ties keep the first)
+        _, first = np.unique(span[over], return_index=True)
+        keep[over[first]] = True
+
+    return vp.iloc[np.sort(order[keep])]
+
+
+def arrival_time_comparison(
+    full_arrivals: pd.DataFrame,
+    thinned_arrivals: pd.DataFrame,
+    trip_stop_cols: list = ["trip_instance_key", "stop_sequence"]
+) -> pd.DataFrame:
+    """
+    Compare interpolated arrival times (nearest_neighbor_and_interpolate)
+    from all vp against thinned vp: how many stops got an arrival,
+    and the absolute difference in seconds for stops with both.
+    """
+    df = pd.merge(
+        full_arrivals[trip_stop_cols + ["arrival_time_sec"]],
+        thinned_arrivals[trip_stop_cols + ["arrival_time_sec"]],
+        on = trip_stop_cols,
+        how = "outer",
+        suffixes = ["_full", "_thinned"]
+    )
+
+    diff_sec = (
+        df.arrival_time_sec_thinned - df.arrival_time_sec_full
+    ).abs().dropna()
+
+    return pd.DataFrame([{
+        "n_stops": len(df),
+        "n_arrivals_full": int(df.arrival_time_sec_full.notna().sum()),
+        "n_arrivals_thinned": int(df.arrival_time_sec_thinned.notna().sum()),
+        "mean_abs_diff_sec": diff_sec.mean(),
+        "p95_abs_diff_sec": diff_sec.quantile(0.95),
+        "max_abs_diff_sec": diff_sec.max(),
+    }])
+
+
+if __name__ == "__main__":
+    import create_table
+    import neighbor
+
+    results = {}
+
+    for thin in [False, True]:
+        start = datetime.datetime.now()
+
+        gdf = create_table.stop_times_with_vp_table(thin_vp = thin)
+        n_vp = gdf.drop_duplicates("trip_instance_key").vp_idx.map(len).sum()
+
+        gdf = neighbor.nearest_neighbor_and_interpolate(gdf)
+
+        end = datetime.datetime.now()
+        print(f"thin_vp={thin}: {n_vp} vp, execution time: {end - start}")
+
+        results[thin] = gdf
+
+    print(arrival_time_comparison(results[False], results[True]).T)